@@ -10,3 +10,79 @@ BOT_WEBHOOK_BASE_URL = os.getenv('BOT_WEBHOOK_BASE_URL')
 BOT_WEBHOOK_PATH = os.getenv('BOT_WEBHOOK_PATH')
 
 SUBSCRIPTION_PRICE = 1
+
+# Источник цены BTC/USDT: 'exchange', 'simulated' или 'replay'
+PRICE_FEED_SOURCE = os.getenv('PRICE_FEED_SOURCE', 'exchange')
+PRICE_FEED_URL = os.getenv('PRICE_FEED_URL', 'wss://stream.binance.com:9443/ws/btcusdt@trade')
+PRICE_FEED_REPLAY_FILE = os.getenv('PRICE_FEED_REPLAY_FILE')
+PRICE_FEED_HISTORY = int(os.getenv('PRICE_FEED_HISTORY', '1000'))
+
+# Исторические свечи OHLCV для /backtest (CSV: timestamp,open,high,low,close,volume)
+BACKTEST_CANDLES_FILE = os.getenv('BACKTEST_CANDLES_FILE', 'data/btcusdt_1m.csv')
+
+# Перечитывать locale/*.json при изменении файлов (для эксплуатации)
+LOCALE_AUTO_RELOAD = os.getenv('LOCALE_AUTO_RELOAD', '0') == '1'
+
+# Кэш состояния пользователей в SubscriptionMiddleware
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+
+# Состояния FSM старше этого срока (в секундах) удаляются
+FSM_STATE_TTL = int(os.getenv('FSM_STATE_TTL', '86400'))
+
+# Число рабочих процессов. При WEB_WORKERS > 1 основной процесс принимает вебхук
+# и направляет обновления рабочим по from_user.id
+WEB_WORKERS = int(os.getenv('WEB_WORKERS', '1'))
+WORKER_SOCKET_DIR = os.getenv('WORKER_SOCKET_DIR', '/tmp')
+
+# Приём вебхука: 'queue' - ответ Telegram сразу, обработка в очереди с порядком по пользователю,
+# 'background' - стандартная фоновая обработка aiogram
+WEBHOOK_INGESTION = os.getenv('WEBHOOK_INGESTION', 'queue')
+INGESTION_WORKERS = int(os.getenv('INGESTION_WORKERS', '64'))
+INGESTION_MAX_PENDING = int(os.getenv('INGESTION_MAX_PENDING', '10000'))
+
+# Биржа: REST API в формате Binance spot. EXCHANGE_TRADING=1 отправляет покупки на биржу
+# с API-ключом пользователя, иначе сделки эмулируются по текущей цене.
+# В режиме биржи балансы пишет только поток данных аккаунта: обработчики их не меняют
+EXCHANGE_TRADING = os.getenv('EXCHANGE_TRADING', '0') == '1'
+EXCHANGE_BASE_URL = os.getenv('EXCHANGE_BASE_URL', 'https://api.binance.com')
+EXCHANGE_SYMBOL = os.getenv('EXCHANGE_SYMBOL', 'BTCUSDT')
+EXCHANGE_POOL_SIZE = int(os.getenv('EXCHANGE_POOL_SIZE', '100'))
+# Лимиты: запросов в секунду на один ключ и вес запросов в секунду на весь процесс
+EXCHANGE_KEY_RATE = float(os.getenv('EXCHANGE_KEY_RATE', '10'))
+EXCHANGE_GLOBAL_RATE = float(os.getenv('EXCHANGE_GLOBAL_RATE', '100'))
+EXCHANGE_MAX_RETRIES = int(os.getenv('EXCHANGE_MAX_RETRIES', '3'))
+EXCHANGE_TIMEOUT = float(os.getenv('EXCHANGE_TIMEOUT', '10'))
+# Размер пакета batchOrders; 1 - площадка не поддерживает пакетные ордера.
+# У Binance spot пакетного размещения нет (batchOrders - только у фьючерсов), поэтому по умолчанию 1
+EXCHANGE_BATCH_SIZE = int(os.getenv('EXCHANGE_BATCH_SIZE', '1'))
+EXCHANGE_BASE_ASSET = os.getenv('EXCHANGE_BASE_ASSET', 'BTC')
+EXCHANGE_QUOTE_ASSET = os.getenv('EXCHANGE_QUOTE_ASSET', 'USDT')
+
+# Потоки данных аккаунтов (user data stream): до EXCHANGE_STREAMS_PER_CONNECTION
+# listen key на одно соединение WebSocket, события пишутся в базу пакетами раз в EXCHANGE_STREAM_FLUSH_INTERVAL секунд
+EXCHANGE_STREAM_URL = os.getenv('EXCHANGE_STREAM_URL', 'wss://stream.binance.com:9443')
+EXCHANGE_STREAMS_PER_CONNECTION = int(os.getenv('EXCHANGE_STREAMS_PER_CONNECTION', '200'))
+EXCHANGE_STREAM_FLUSH_INTERVAL = float(os.getenv('EXCHANGE_STREAM_FLUSH_INTERVAL', '0.5'))
+EXCHANGE_LISTEN_KEY_KEEPALIVE = int(os.getenv('EXCHANGE_LISTEN_KEY_KEEPALIVE', '1800'))
+# Ордер, оставшийся в статусе Pending дольше стольких секунд, ищется на бирже по clientOrderId
+EXCHANGE_PENDING_ORDER_TIMEOUT = float(os.getenv('EXCHANGE_PENDING_ORDER_TIMEOUT', '60'))
+
+# Не больше стольких уведомлений о цене на пользователя
+MAX_PRICE_ALERTS = int(os.getenv('MAX_PRICE_ALERTS', '20'))
+
+# Outbox: сообщений за один захват, срок аренды захваченных строк (с), интервал опроса (с),
+# попыток доставки и срок хранения отправленных строк для дедупликации (с)
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '500'))
+OUTBOX_LEASE = int(os.getenv('OUTBOX_LEASE', '120'))
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1.0'))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '5'))
+OUTBOX_RETENTION = int(os.getenv('OUTBOX_RETENTION', '86400'))
+
+# Аренда одиночных задач (вебхук, проверка подписок): срок аренды и интервал продления, с.
+# После падения держателя задачу подхватывает другая реплика не позже чем через LEASE_TTL + LEASE_RENEW_INTERVAL
+LEASE_TTL = int(os.getenv('LEASE_TTL', '15'))
+LEASE_RENEW_INTERVAL = float(os.getenv('LEASE_RENEW_INTERVAL', '5'))
+
+# Массовая смена команд чатов (например, при истечении подписок): вызовов set_my_commands в секунду
+COMMANDS_RATE = float(os.getenv('COMMANDS_RATE', '10'))
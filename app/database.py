@@ -1,14 +1,9 @@
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
-from config import DATABASE_URL
+from app.config import DATABASE_URL
 
 engine = create_async_engine(DATABASE_URL, echo=False)
 async_session = sessionmaker(
     engine, expire_on_commit=False, class_=AsyncSession
 )
-
-async def create_db_and_tables():
-    from models import Base
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
@@ -0,0 +1,340 @@
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import random
+import time
+import uuid
+from collections import OrderedDict
+from decimal import Decimal
+from typing import NamedTuple
+from urllib.parse import urlencode
+
+import aiohttp
+
+from app.config import (EXCHANGE_BASE_URL, EXCHANGE_SYMBOL, EXCHANGE_POOL_SIZE, EXCHANGE_KEY_RATE,
+                        EXCHANGE_GLOBAL_RATE, EXCHANGE_MAX_RETRIES, EXCHANGE_TIMEOUT, EXCHANGE_BATCH_SIZE)
+from app.utils import metrics
+from app.utils.rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Коды ошибок Binance
+UNKNOWN_ORDER = -2013
+
+BACKOFF_BASE = 0.2
+BACKOFF_MAX = 5.0
+
+
+class ExchangeError(Exception):
+    def __init__(self, status, code=None, message=''):
+        super().__init__(f"{status} {code}: {message}")
+        self.status = status
+        self.code = code
+        self.message = message
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status >= 500 or self.status in (418, 429)
+
+
+class RateLimitError(ExchangeError):
+    def __init__(self, status, retry_after, code=None, message=''):
+        super().__init__(status, code, message)
+        self.retry_after = retry_after
+
+
+class OrderStatusUnknown(ExchangeError):
+    """
+    Ордер мог быть принят биржей: ответ на размещение потерян, и найти его по clientOrderId
+    тоже не удалось. Повторять размещение нельзя - только искать ордер позже.
+    """
+    def __init__(self, client_order_id, cause):
+        super().__init__(cause.status, cause.code, cause.message)
+        self.client_order_id = client_order_id
+
+
+class MarketFill(NamedTuple):
+    order_id: int
+    client_order_id: str
+    quantity: Decimal  # BTC
+    quote: Decimal  # USDT
+
+    @property
+    def price(self):
+        return self.quote / self.quantity if self.quantity else Decimal(0)
+
+    @classmethod
+    def from_response(cls, order):
+        return cls(order['orderId'], order['clientOrderId'], Decimal(order['executedQty']), Decimal(order['cummulativeQuoteQty']))
+
+
+def new_client_order_id():
+    # По clientOrderId ордер находится, даже если ответ на его размещение потерян
+    return f'sctb-{uuid.uuid4().hex[:24]}'
+
+
+class ExchangeClient:
+    """
+    Клиент REST API биржи в формате Binance spot.
+    Одно общее соединение aiohttp на процесс, ведро токенов на каждый API-ключ
+    и общее ведро веса запросов процесса. Ответы 429/418 приостанавливают ведро на Retry-After,
+    ошибки сети и 5xx повторяются с экспоненциальной задержкой и случайным разбросом.
+    Размещение ордера вслепую не повторяется: после потерянного ответа ордер сначала ищется
+    по clientOrderId и отправляется снова, только если биржа его не знает.
+    """
+    def __init__(self, base_url=EXCHANGE_BASE_URL, symbol=EXCHANGE_SYMBOL, pool_size=EXCHANGE_POOL_SIZE,
+                 key_rate=EXCHANGE_KEY_RATE, global_rate=EXCHANGE_GLOBAL_RATE, max_retries=EXCHANGE_MAX_RETRIES,
+                 timeout=EXCHANGE_TIMEOUT, batch_size=EXCHANGE_BATCH_SIZE, max_keys=10000):
+        self.base_url = base_url.rstrip('/')
+        self.symbol = symbol
+        self.pool_size = pool_size
+        self.key_rate = key_rate
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.max_keys = max_keys
+        self._global = TokenBucket(global_rate)
+        self._keys = OrderedDict()  # api_key -> TokenBucket
+        self._session = None
+
+    async def start(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, ttl_dns_cache=300, enable_cleanup_closed=True)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def close(self):
+        if self._session:
+            await self._session.close()
+            self._session = None
+
+    def _bucket(self, api_key):
+        bucket = self._keys.get(api_key)
+        if bucket is None:
+            bucket = self._keys[api_key] = TokenBucket(self.key_rate)
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        else:
+            self._keys.move_to_end(api_key)
+        return bucket
+
+    @staticmethod
+    def _sign(params, secret):
+        params['timestamp'] = int(time.time() * 1000)
+        if secret:
+            params['signature'] = hmac.new(secret.encode(), urlencode(params).encode(), hashlib.sha256).hexdigest()
+        return params
+
+    async def _send(self, method, path, api_key, params, secret, tokens):
+        await self._global.acquire()
+        bucket = self._bucket(api_key) if api_key else None
+        if bucket:
+            await bucket.acquire(tokens)
+        headers = {'X-MBX-APIKEY': api_key} if api_key else {}
+        query = self._sign(dict(params), secret) if api_key and not path.endswith('/userDataStream') else params
+        started = time.perf_counter()
+        try:
+            async with self._session.request(method, f'{self.base_url}{path}', params=query, headers=headers) as response:
+                try:
+                    body = await response.json(content_type=None)
+                except ValueError:
+                    body = None
+                if response.status in (418, 429):
+                    retry_after = float(response.headers.get('Retry-After', 1))
+                    # 418 - бан по IP для всего процесса, 429 - лимит ключа
+                    (self._global if response.status == 418 or bucket is None else bucket).pause(retry_after)
+                    raise RateLimitError(response.status, retry_after, *_error_fields(body))
+                if response.status >= 400:
+                    raise ExchangeError(response.status, *_error_fields(body))
+                return body
+        finally:
+            metrics.exchange_request_duration.labels(path).observe(time.perf_counter() - started)
+
+    async def request(self, method, path, api_key=None, params=None, secret=None, tokens=1, idempotent=True):
+        """
+        idempotent=False - после ошибки сети или 5xx запрос мог быть исполнен, такая ошибка
+        возвращается сразу. Ответы 429/418 повторяются всегда: биржа такой запрос не обработала.
+        """
+        params = params or {}
+        for attempt in range(self.max_retries + 1):
+            try:
+                return await self._send(method, path, api_key, params, secret, tokens)
+            except RateLimitError as e:
+                metrics.exchange_errors.labels(path, 'rate_limited').inc()
+                error = e
+                # Ведро уже приостановлено на Retry-After, следующий acquire дождётся
+                if attempt < self.max_retries:
+                    continue
+            except ExchangeError as e:
+                metrics.exchange_errors.labels(path, str(e.status)).inc()
+                if not e.retryable or not idempotent:
+                    raise
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.exchange_errors.labels(path, type(e).__name__).inc()
+                error = ExchangeError(None, None, str(e) or type(e).__name__)
+                if not idempotent:
+                    raise error
+            if attempt < self.max_retries:
+                await _backoff(attempt)
+        raise error
+
+    async def place_order(self, api_key, side, order_type, quantity=None, quote_quantity=None, price=None,
+                          client_order_id=None, secret=None):
+        params = {
+            'symbol': self.symbol,
+            'side': side,
+            'type': order_type,
+            'newClientOrderId': client_order_id or new_client_order_id(),
+            'newOrderRespType': 'FULL',
+        }
+        if quantity is not None:
+            params['quantity'] = str(quantity)
+        if quote_quantity is not None:
+            params['quoteOrderQty'] = str(quote_quantity)
+        if price is not None:
+            params['price'] = str(price)
+            params['timeInForce'] = 'GTC'
+        try:
+            return await self.request('POST', '/api/v3/order', api_key, params, secret, idempotent=False)
+        except RateLimitError:
+            raise
+        except ExchangeError as e:
+            if not e.retryable:
+                raise
+            return await self._recover(api_key, params, secret, e)
+
+    async def _recover(self, api_key, params, secret, error):
+        """
+        Ответ на размещение потерян (сеть или 5xx): ордер ищется по clientOrderId
+        и отправляется снова, только если биржа ответила, что такого ордера нет.
+        Если статус выяснить не удалось, поднимается OrderStatusUnknown.
+        """
+        client_order_id = params['newClientOrderId']
+        for attempt in range(self.max_retries):
+            await _backoff(attempt)
+            try:
+                return await self.get_order(api_key, client_order_id=client_order_id, secret=secret)
+            except ExchangeError as e:
+                if e.code != UNKNOWN_ORDER:
+                    raise OrderStatusUnknown(client_order_id, e) from e
+            logger.info("Order %s was not received by the exchange, resubmitting", client_order_id)
+            try:
+                return await self.request('POST', '/api/v3/order', api_key, params, secret, idempotent=False)
+            except RateLimitError:
+                raise
+            except ExchangeError as e:
+                if not e.retryable:
+                    raise
+                error = e
+        raise OrderStatusUnknown(client_order_id, error)
+
+    async def market_buy(self, api_key, quote_amount, secret=None, client_order_id=None):
+        order = await self.place_order(api_key, 'BUY', 'MARKET', quote_quantity=quote_amount,
+                                       client_order_id=client_order_id, secret=secret)
+        return MarketFill.from_response(order)
+
+    async def place_orders(self, api_key, orders, secret=None):
+        """
+        Размещает несколько ордеров одного ключа пакетами по batch_size.
+        orders - словари параметров place_order. Возвращает список той же длины:
+        ответ биржи или ExchangeError для каждого ордера.
+        """
+        if self.batch_size <= 1:
+            return await asyncio.gather(*(self.place_order(api_key, secret=secret, **order) for order in orders), return_exceptions=True)
+        results = []
+        for start in range(0, len(orders), self.batch_size):
+            chunk = [_batch_item(self.symbol, order) for order in orders[start:start + self.batch_size]]
+            try:
+                response = await self.request('POST', '/api/v3/batchOrders', api_key,
+                                              {'batchOrders': json.dumps(chunk)}, secret, tokens=len(chunk), idempotent=False)
+            except RateLimitError as e:
+                results.extend([e] * len(chunk))
+                continue
+            except ExchangeError as e:
+                if not e.retryable:
+                    results.extend([e] * len(chunk))
+                    continue
+                # Пакет мог быть принят: каждый ордер ищется по своему clientOrderId
+                results.extend(await asyncio.gather(
+                    *(self._recover(api_key, _order_params(item), secret, e) for item in chunk), return_exceptions=True,
+                ))
+                continue
+            results.extend(
+                ExchangeError(400, *_error_fields(item)) if 'code' in item and 'orderId' not in item else item
+                for item in response
+            )
+        return results
+
+    async def cancel_order(self, api_key, order_id=None, client_order_id=None, secret=None):
+        params = {'symbol': self.symbol}
+        if order_id is not None:
+            params['orderId'] = order_id
+        if client_order_id is not None:
+            params['origClientOrderId'] = client_order_id
+        return await self.request('DELETE', '/api/v3/order', api_key, params, secret)
+
+    async def get_order(self, api_key, order_id=None, client_order_id=None, secret=None):
+        params = {'symbol': self.symbol}
+        if order_id is not None:
+            params['orderId'] = order_id
+        if client_order_id is not None:
+            params['origClientOrderId'] = client_order_id
+        return await self.request('GET', '/api/v3/order', api_key, params, secret)
+
+    async def account(self, api_key, secret=None):
+        return await self.request('GET', '/api/v3/account', api_key, {}, secret, tokens=10)
+
+    async def create_listen_key(self, api_key):
+        body = await self.request('POST', '/api/v3/userDataStream', api_key)
+        return body['listenKey']
+
+    async def keepalive_listen_key(self, api_key, listen_key):
+        await self.request('PUT', '/api/v3/userDataStream', api_key, {'listenKey': listen_key})
+
+    async def close_listen_key(self, api_key, listen_key):
+        await self.request('DELETE', '/api/v3/userDataStream', api_key, {'listenKey': listen_key})
+
+    def ws_connect(self, url, heartbeat=30):
+        # Потоки используют тот же пул соединений, что и REST
+        return self._session.ws_connect(url, heartbeat=heartbeat)
+
+    async def ticker_price(self):
+        body = await self.request('GET', '/api/v3/ticker/price', params={'symbol': self.symbol})
+        return float(body['price'])
+
+
+def _error_fields(body):
+    if isinstance(body, dict):
+        return body.get('code'), body.get('msg', '')
+    return None, ''
+
+
+async def _backoff(attempt):
+    await asyncio.sleep(random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt)))
+
+
+def _order_params(item):
+    # Элемент пакета в параметры одиночного POST /api/v3/order
+    return dict(item, newOrderRespType='FULL')
+
+
+def _batch_item(symbol, order):
+    item = {
+        'symbol': symbol,
+        'side': order['side'],
+        'type': order['order_type'],
+        'newClientOrderId': order.get('client_order_id') or new_client_order_id(),
+    }
+    if order.get('quantity') is not None:
+        item['quantity'] = str(order['quantity'])
+    if order.get('quote_quantity') is not None:
+        item['quoteOrderQty'] = str(order['quote_quantity'])
+    if order.get('price') is not None:
+        item['price'] = str(order['price'])
+        item['timeInForce'] = 'GTC'
+    return item
+
+
+exchange_client = ExchangeClient()
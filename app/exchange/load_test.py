@@ -0,0 +1,102 @@
+"""
+Нагрузочный тест клиента биржи против локальной биржи без сети:
+    python -m app.exchange.load_test --keys 500 --orders 10 --concurrency 200
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+
+from aiohttp import web
+
+from app.exchange.client import ExchangeClient, ExchangeError
+from app.exchange.mock_server import create_app, add_arguments, options_from
+from app.utils import metrics
+
+
+def percentile(values, q):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def run(args):
+    app = create_app(**options_from(args))
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    client = ExchangeClient(
+        base_url=f'http://127.0.0.1:{port}', pool_size=args.pool_size, key_rate=args.client_key_rate,
+        global_rate=args.global_rate, batch_size=args.batch_size,
+    )
+    await client.start()
+
+    keys = [f'loadkey{i:06d}' for i in range(args.keys)]
+    # Ордера каждого ключа идут по очереди, как покупки одного пользователя
+    queue = asyncio.Queue()
+    for key in keys:
+        queue.put_nowait(key)
+    latencies = []
+    failures = 0
+    rng = random.Random(args.seed)
+
+    async def worker():
+        nonlocal failures
+        while not queue.empty():
+            key = queue.get_nowait()
+            if args.batch_size > 1:
+                orders = [{'side': 'BUY', 'order_type': 'MARKET', 'quote_quantity': rng.randint(10, 500)} for _ in range(args.orders)]
+                started = time.perf_counter()
+                results = await client.place_orders(key, orders)
+                elapsed = time.perf_counter() - started
+                latencies.extend([elapsed / len(orders)] * len(orders))
+                failures += sum(isinstance(result, Exception) for result in results)
+                continue
+            for _ in range(args.orders):
+                started = time.perf_counter()
+                try:
+                    await client.market_buy(key, rng.randint(10, 500))
+                except ExchangeError:
+                    failures += 1
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+    await client.close()
+    counters = dict(app['exchange'].counters)
+    await runner.cleanup()
+
+    errors = metrics.exchange_errors
+    return {
+        'keys': args.keys,
+        'orders': len(latencies),
+        'failures': failures,
+        'seconds': round(elapsed, 3),
+        'orders_per_sec': round(len(latencies) / elapsed, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 2),
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+        'client_retries': sum(child.value for child in errors._children.values()),
+        'exchange': counters,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the exchange client against the mock exchange")
+    parser.add_argument('--keys', type=int, default=500)
+    parser.add_argument('--orders', type=int, default=10, help="orders per key")
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--pool-size', type=int, default=100)
+    parser.add_argument('--client-key-rate', type=float, default=10.0, help="client-side per-key rate limit")
+    parser.add_argument('--global-rate', type=float, default=10000.0)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    add_arguments(parser)
+    args = parser.parse_args()
+    print(json.dumps(asyncio.run(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,342 @@
+"""
+Локальная биржа для нагрузочных тестов: подмножество REST API Binance spot
+с настраиваемой задержкой, исполнением ордеров и ответами 429, а также
+потоки данных аккаунтов (listen key, WebSocket /stream с SUBSCRIBE).
+POST /mock/price?price=... двигает цену и исполняет пересечённые лимитные ордера,
+POST /mock/drop разрывает все соединения потоков.
+Как и Binance, биржа отклоняет clientOrderId только у ещё открытого ордера: повтор
+исполненного рыночного ордера исполнится второй раз. lost_rate - доля ордеров, которые
+исполняются, но отвечают 503, как при потерянном ответе.
+
+Запуск:
+    python -m app.exchange.mock_server --port 8081 --latency 0.02 --key-rate 10
+и EXCHANGE_BASE_URL=http://localhost:8081 для бота.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import secrets
+import time
+from decimal import Decimal, ROUND_DOWN
+
+from aiohttp import web
+
+from app.utils.rate_limit import TokenBucket
+
+QTY_STEP = Decimal('0.00000001')
+INITIAL_QUOTE = Decimal('10000')
+
+
+class MockExchange:
+    def __init__(self, latency=0.0, jitter=0.0, fill_rate=1.0, key_rate=10.0, error_rate=0.0, price=65000.0, seed=None,
+                 base_asset='BTC', quote_asset='USDT', lost_rate=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.fill_rate = fill_rate  # вероятность, что лимитный ордер исполнится сразу
+        self.key_rate = key_rate
+        self.error_rate = error_rate  # доля ответов 503
+        self.lost_rate = lost_rate  # доля принятых ордеров, на которые отвечается 503
+        self.price = Decimal(str(price))
+        self._random = random.Random(seed)
+        self._buckets = {}
+        self._order_ids = itertools.count(1)
+        self._orders = {}  # (api_key, orderId) -> order
+        self._client_ids = {}  # (api_key, clientOrderId) -> orderId
+        self.base_asset = base_asset
+        self.quote_asset = quote_asset
+        self._balances = {}  # api_key -> {актив: [свободно, заблокировано]}
+        self._listen_keys = {}  # listen_key -> api_key
+        self._sockets = {}  # WebSocketResponse -> подписанные listen key
+        self.counters = {'requests': 0, 'orders': 0, 'rate_limited': 0, 'errors': 0, 'duplicates': 0, 'events': 0, 'lost': 0}
+
+    def _limited(self, api_key, weight=1):
+        bucket = self._buckets.get(api_key)
+        if bucket is None:
+            bucket = self._buckets[api_key] = TokenBucket(self.key_rate)
+        wait = bucket.try_take(weight)
+        if wait:
+            self.counters['rate_limited'] += 1
+        return wait
+
+    @staticmethod
+    def _error(status, code, msg, headers=None):
+        return web.json_response({'code': code, 'msg': msg}, status=status, headers=headers)
+
+    def _new_order(self, api_key, params):
+        client_id = params.get('newClientOrderId') or f'mock-{next(self._order_ids)}'
+        existing = self._orders.get((api_key, self._client_ids.get((api_key, client_id))))
+        if existing is not None and existing['status'] == 'NEW':
+            self.counters['duplicates'] += 1
+            return None
+        side, order_type = params.get('side'), params.get('type')
+        if side not in ('BUY', 'SELL') or order_type not in ('MARKET', 'LIMIT'):
+            return {'code': -1102, 'msg': 'Invalid side or type'}
+        price = self.price if order_type == 'MARKET' else Decimal(params['price'])
+        if params.get('quoteOrderQty'):
+            quantity = (Decimal(params['quoteOrderQty']) / price).quantize(QTY_STEP, ROUND_DOWN)
+        else:
+            quantity = Decimal(params.get('quantity', '0'))
+        if quantity <= 0:
+            return {'code': -1013, 'msg': 'Invalid quantity'}
+        balances = self._account(api_key)
+        asset, amount = (self.base_asset, quantity) if side == 'SELL' else (self.quote_asset, quantity * price)
+        if balances[asset][0] < amount:
+            return {'code': -2010, 'msg': 'Account has insufficient balance for requested action.'}
+        filled = order_type == 'MARKET' or self._random.random() < self.fill_rate
+        if not filled:
+            # Средства лимитного ордера блокируются до исполнения или отмены
+            balances[asset][0] -= amount
+            balances[asset][1] += amount
+        order_id = next(self._order_ids)
+        order = {
+            'symbol': params.get('symbol'),
+            'orderId': order_id,
+            'clientOrderId': client_id,
+            'transactTime': int(time.time() * 1000),
+            'price': str(price if order_type == 'LIMIT' else 0),
+            'origQty': str(quantity),
+            'executedQty': str(quantity if filled else 0),
+            'cummulativeQuoteQty': str((quantity * price).quantize(QTY_STEP) if filled else 0),
+            'status': 'FILLED' if filled else 'NEW',
+            'type': order_type,
+            'side': side,
+        }
+        if filled:
+            self._settle(balances, side, quantity, quantity * price, locked=False)
+        self._orders[(api_key, order_id)] = order
+        self._client_ids[(api_key, client_id)] = order_id
+        self.counters['orders'] += 1
+        return order
+
+    def _account(self, api_key):
+        balances = self._balances.get(api_key)
+        if balances is None:
+            balances = self._balances[api_key] = {self.base_asset: [Decimal(0), Decimal(0)], self.quote_asset: [INITIAL_QUOTE, Decimal(0)]}
+        return balances
+
+    def _settle(self, balances, side, quantity, quote, locked):
+        base, quote_balance = balances[self.base_asset], balances[self.quote_asset]
+        if side == 'BUY':
+            quote_balance[1 if locked else 0] -= quote
+            base[0] += quantity
+        else:
+            base[1 if locked else 0] -= quantity
+            quote_balance[0] += quote
+
+    def _fill(self, api_key, order):
+        quantity, price = Decimal(order['origQty']), Decimal(order['price'])
+        self._settle(self._account(api_key), order['side'], quantity, quantity * price, locked=True)
+        order.update(status='FILLED', executedQty=str(quantity), cummulativeQuoteQty=str((quantity * price).quantize(QTY_STEP)))
+
+    async def publish(self, api_key, order):
+        """
+        События потока данных аккаунта: executionReport по ордеру и outboundAccountPosition по остаткам.
+        """
+        now = int(time.time() * 1000)
+        order['updateTime'] = now
+        events = [
+            {'e': 'executionReport', 'E': now, 's': order['symbol'], 'c': order['clientOrderId'], 'S': order['side'],
+             'o': order['type'], 'X': order['status'], 'i': order['orderId'], 'z': order['executedQty'],
+             'Z': order['cummulativeQuoteQty'], 'T': now},
+            {'e': 'outboundAccountPosition', 'E': now, 'u': now, 'B': [
+                {'a': asset, 'f': str(free), 'l': str(locked)} for asset, (free, locked) in self._account(api_key).items()
+            ]},
+        ]
+        for ws, listen_keys in list(self._sockets.items()):
+            for listen_key in listen_keys:
+                if self._listen_keys.get(listen_key) != api_key:
+                    continue
+                for event in events:
+                    self.counters['events'] += 1
+                    await ws.send_str(json.dumps({'stream': listen_key, 'data': event}))
+
+    def _find(self, api_key, query):
+        if 'orderId' in query:
+            return self._orders.get((api_key, int(query['orderId'])))
+        order_id = self._client_ids.get((api_key, query.get('origClientOrderId')))
+        return self._orders.get((api_key, order_id))
+
+    @web.middleware
+    async def middleware(self, request, handler):
+        delay = self.latency + self._random.uniform(0, self.jitter)
+        if delay:
+            await asyncio.sleep(delay)
+        if request.path == '/stream' or request.path.startswith('/mock/'):
+            return await handler(request)
+        self.counters['requests'] += 1
+        api_key = request.headers.get('X-MBX-APIKEY')
+        if request.path != '/api/v3/ticker/price':
+            if not api_key:
+                return self._error(401, -2014, 'API-key format invalid.')
+            weight = len(json.loads(request.query.get('batchOrders', '[]'))) or 1
+            wait = self._limited(api_key, weight)
+            if wait:
+                return self._error(429, -1003, 'Too many requests.', {'Retry-After': f'{wait:.3f}'})
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.counters['errors'] += 1
+            return self._error(503, -1001, 'Internal error; unable to process your request.')
+        request['api_key'] = api_key
+        return await handler(request)
+
+    async def post_order(self, request):
+        order = self._new_order(request['api_key'], request.query)
+        if order is None:
+            return self._error(400, -2010, 'Duplicate order sent.')
+        if 'code' in order:
+            return self._error(400, order['code'], order['msg'])
+        await self.publish(request['api_key'], order)
+        return self._lost() or web.json_response(order)
+
+    def _lost(self):
+        if self.lost_rate and self._random.random() < self.lost_rate:
+            self.counters['lost'] += 1
+            return self._error(503, -1007, 'Timeout waiting for response from backend server. Send status unknown; execution status unknown.')
+        return None
+
+    async def post_batch(self, request):
+        items = json.loads(request.query.get('batchOrders', '[]'))
+        results = []
+        for item in items:
+            order = self._new_order(request['api_key'], item)
+            results.append(order if order is not None else {'code': -2010, 'msg': 'Duplicate order sent.'})
+            if order is not None and 'code' not in order:
+                await self.publish(request['api_key'], order)
+        return self._lost() or web.json_response(results)
+
+    async def get_order(self, request):
+        order = self._find(request['api_key'], request.query)
+        if order is None:
+            return self._error(400, -2013, 'Order does not exist.')
+        return web.json_response(order)
+
+    async def delete_order(self, request):
+        order = self._find(request['api_key'], request.query)
+        if order is None or order['status'] != 'NEW':
+            return self._error(400, -2011, 'Unknown order sent.')
+        order['status'] = 'CANCELED'
+        quantity = Decimal(order['origQty'])
+        asset, amount = (self.base_asset, quantity) if order['side'] == 'SELL' else (self.quote_asset, quantity * Decimal(order['price']))
+        balance = self._account(request['api_key'])[asset]
+        balance[0] += amount
+        balance[1] -= amount
+        await self.publish(request['api_key'], order)
+        return web.json_response(order)
+
+    async def account(self, request):
+        return web.json_response({
+            'updateTime': int(time.time() * 1000),
+            'balances': [
+                {'asset': asset, 'free': str(free), 'locked': str(locked)}
+                for asset, (free, locked) in self._account(request['api_key']).items()
+            ],
+        })
+
+    async def create_listen_key(self, request):
+        listen_key = secrets.token_hex(16)
+        self._listen_keys[listen_key] = request['api_key']
+        return web.json_response({'listenKey': listen_key})
+
+    async def keepalive_listen_key(self, request):
+        if self._listen_keys.get(request.query.get('listenKey')) != request['api_key']:
+            return self._error(400, -1125, 'This listenKey does not exist.')
+        return web.json_response({})
+
+    async def close_listen_key(self, request):
+        self._listen_keys.pop(request.query.get('listenKey'), None)
+        return web.json_response({})
+
+    async def stream(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        listen_keys = self._sockets[ws] = set()
+        try:
+            async for message in ws:
+                if message.type != web.WSMsgType.TEXT:
+                    continue
+                command = json.loads(message.data)
+                if command.get('method') == 'SUBSCRIBE':
+                    listen_keys.update(command.get('params', ()))
+                elif command.get('method') == 'UNSUBSCRIBE':
+                    listen_keys.difference_update(command.get('params', ()))
+                await ws.send_str(json.dumps({'result': None, 'id': command.get('id')}))
+        finally:
+            self._sockets.pop(ws, None)
+        return ws
+
+    async def move_price(self, request):
+        self.price = Decimal(request.query['price'])
+        crossed = [
+            (api_key, order) for (api_key, _), order in self._orders.items()
+            if order['status'] == 'NEW' and (
+                (order['side'] == 'SELL' and Decimal(order['price']) <= self.price)
+                or (order['side'] == 'BUY' and Decimal(order['price']) >= self.price)
+            )
+        ]
+        for api_key, order in crossed:
+            self._fill(api_key, order)
+            await self.publish(api_key, order)
+        return web.json_response({'price': str(self.price), 'filled': len(crossed)})
+
+    async def drop_streams(self, request):
+        sockets = list(self._sockets)
+        for ws in sockets:
+            await ws.close()
+        return web.json_response({'dropped': len(sockets)})
+
+    async def ticker_price(self, request):
+        return web.json_response({'symbol': request.query.get('symbol', 'BTCUSDT'), 'price': str(self.price)})
+
+    async def stats(self, request):
+        return web.json_response(self.counters)
+
+
+def create_app(**options):
+    exchange = MockExchange(**options)
+    app = web.Application(middlewares=[exchange.middleware])
+    app['exchange'] = exchange
+    app.router.add_post('/api/v3/order', exchange.post_order)
+    app.router.add_get('/api/v3/order', exchange.get_order)
+    app.router.add_delete('/api/v3/order', exchange.delete_order)
+    app.router.add_post('/api/v3/batchOrders', exchange.post_batch)
+    app.router.add_get('/api/v3/ticker/price', exchange.ticker_price)
+    app.router.add_get('/api/v3/account', exchange.account)
+    app.router.add_post('/api/v3/userDataStream', exchange.create_listen_key)
+    app.router.add_put('/api/v3/userDataStream', exchange.keepalive_listen_key)
+    app.router.add_delete('/api/v3/userDataStream', exchange.close_listen_key)
+    app.router.add_get('/stream', exchange.stream)
+    app.router.add_get('/mock/stats', exchange.stats)
+    app.router.add_post('/mock/price', exchange.move_price)
+    app.router.add_post('/mock/drop', exchange.drop_streams)
+    return app
+
+
+def add_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.02, help="base response delay, seconds")
+    parser.add_argument('--jitter', type=float, default=0.01, help="random extra delay, seconds")
+    parser.add_argument('--fill-rate', type=float, default=1.0, help="probability a limit order fills immediately")
+    parser.add_argument('--key-rate', type=float, default=10.0, help="requests per second per API key before 429")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="share of 503 responses")
+    parser.add_argument('--lost-rate', type=float, default=0.0, help="share of accepted orders answered with 503")
+    parser.add_argument('--price', type=float, default=65000.0)
+
+
+def options_from(args):
+    return {
+        'latency': args.latency, 'jitter': args.jitter, 'fill_rate': args.fill_rate,
+        'key_rate': args.key_rate, 'error_rate': args.error_rate, 'price': args.price, 'lost_rate': args.lost_rate,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a local mock exchange")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(create_app(**options_from(args)), host=args.host, port=args.port)
+
+
+if __name__ == '__main__':
+    main()
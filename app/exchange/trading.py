@@ -0,0 +1,258 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import NamedTuple
+
+from sqlalchemy import select, update, values, column, BigInteger, Float
+
+from app.models import User, Order
+from app.utils.db import get_session
+from app.utils.sharding import user_filter
+from app.services import ledger, outbox
+from app.services.stats import Fill, record_fills
+from app.services.order_book import fill_message, sell_placed_message
+from app.exchange.client import exchange_client, ExchangeError, OrderStatusUnknown, MarketFill, UNKNOWN_ORDER
+
+logger = logging.getLogger(__name__)
+
+# Статусы ордера биржи, при которых он ещё исполняется
+LIVE_STATUSES = ('NEW', 'PARTIALLY_FILLED', 'PENDING_NEW')
+
+
+class BuyOutcome(NamedTuple):
+    filled: dict  # id ордера -> (сатоши, микро-USDT, цена, id ордера на бирже)
+    rejected: list  # id ордеров, которые биржа точно не исполнила
+
+
+def client_order_id(order_id):
+    # Ордер в базе создаётся до отправки, его id и есть clientOrderId на бирже:
+    # по нему ордер находится после потерянного ответа или перезапуска
+    return f'sctb-{order_id}'
+
+
+async def market_buys(orders):
+    """
+    Рыночные покупки на бирже для уже сохранённых ордеров со статусом Pending.
+    orders - {id ордера: (user_id, сумма в микро-USDT)}. Ордера, статус которых выяснить
+    не удалось, не попадают в результат и остаются Pending до resolve_pending.
+    Ключи читаются отдельной сессией, чтобы транзакция не держалась открытой во время запросов к бирже.
+    """
+    keys = await _api_keys({user_id for user_id, _ in orders.values()})
+    rejected = [order_id for order_id, (user_id, _) in orders.items() if user_id not in keys]
+    order_ids = [order_id for order_id, (user_id, _) in orders.items() if user_id in keys]
+    results = await asyncio.gather(
+        *(exchange_client.market_buy(keys[orders[order_id][0]][0], ledger.from_micro(orders[order_id][1]),
+                                     secret=keys[orders[order_id][0]][1], client_order_id=client_order_id(order_id))
+          for order_id in order_ids),
+        return_exceptions=True,
+    )
+    filled = {}
+    for order_id, fill in zip(order_ids, results):
+        if isinstance(fill, OrderStatusUnknown):
+            logger.warning("Exchange buy of order %s has unknown status: %s", order_id, fill)
+        elif isinstance(fill, ExchangeError):
+            logger.warning("Exchange buy of order %s failed: %s", order_id, fill)
+            rejected.append(order_id)
+        elif isinstance(fill, BaseException):
+            logger.error("Exchange buy of order %s failed", order_id, exc_info=fill)
+        elif fill.quantity > 0:
+            filled[order_id] = _fill_values(fill)
+        else:
+            rejected.append(order_id)
+    return BuyOutcome(filled, rejected)
+
+
+def _fill_values(fill):
+    return ledger.to_sat(fill.quantity), ledger.to_micro(fill.quote), float(fill.price), fill.order_id
+
+
+async def settle_buys(session, outcome):
+    """
+    Закрывает Pending-покупки по итогам market_buys в транзакции session: исполненные
+    становятся Completed с фактическим объёмом и ценой, отклонённые - Cancelled.
+    Возвращает исполненные ордера (id, user_id, amount, price).
+    """
+    if outcome.rejected:
+        await session.execute(
+            update(Order).where(Order.id.in_(outcome.rejected), Order.status == 'Pending').values(status='Cancelled')
+            .execution_options(synchronize_session=False)
+        )
+    if not outcome.filled:
+        return []
+    rows = values(
+        column('id', BigInteger), column('amount', Float), column('price', Float), column('exchange_order_id', BigInteger),
+        name='fills',
+    ).data([
+        (order_id, float(ledger.from_sat(bought_sat)), price, exchange_order_id)
+        for order_id, (bought_sat, _, price, exchange_order_id) in outcome.filled.items()
+    ])
+    result = await session.execute(
+        update(Order)
+        .where(Order.id == rows.c.id, Order.status == 'Pending')
+        .values(status='Completed', amount=rows.c.amount, price=rows.c.price, exchange_order_id=rows.c.exchange_order_id)
+        .returning(Order.id, Order.user_id, Order.amount, Order.price)
+        .execution_options(synchronize_session=False)
+    )
+    return result.all()
+
+
+async def resolve_pending(timeout):
+    """
+    Ордера, оставшиеся Pending дольше timeout секунд (ответ биржи потерян или процесс
+    остановился между сохранением и отправкой), ищутся на бирже по clientOrderId.
+    Найденные получают статус биржи, неизвестные бирже (-2013) - Cancelled.
+    Статистика и уведомления об исполненных пишутся в той же транзакции.
+    """
+    async with get_session() as session:
+        result = await session.execute(
+            select(Order.id, Order.user_id, Order.order_type)
+            .where(Order.status == 'Pending', Order.date_created < datetime.utcnow() - timedelta(seconds=timeout),
+                   user_filter(Order.user_id))
+        )
+        pending = result.all()
+    if not pending:
+        return
+    keys = await _api_keys({user_id for _, user_id, _ in pending})
+    rejected = [order_id for order_id, user_id, _ in pending if user_id not in keys]
+    pending = [row for row in pending if row.user_id in keys]
+    results = await asyncio.gather(
+        *(exchange_client.get_order(keys[user_id][0], client_order_id=client_order_id(order_id), secret=keys[user_id][1])
+          for order_id, user_id, _ in pending),
+        return_exceptions=True,
+    )
+    bought = {}
+    placed = []  # продажи, принятые биржей: (id, id ордера на бирже)
+    sold = []  # из них уже исполненные
+    for (order_id, _, order_type), order in zip(pending, results):
+        if isinstance(order, ExchangeError) and order.code == UNKNOWN_ORDER:
+            rejected.append(order_id)
+        elif isinstance(order, BaseException):
+            logger.warning("Lookup of pending order %s failed: %s", order_id, order)
+        elif order_type == 'sell':
+            if order['status'] in LIVE_STATUSES or order['status'] == 'FILLED':
+                placed.append((order_id, order['orderId']))
+                if order['status'] == 'FILLED':
+                    sold.append(order_id)
+            else:
+                rejected.append(order_id)
+        elif order['status'] not in LIVE_STATUSES:
+            fill = MarketFill.from_response(order)
+            if fill.quantity > 0:
+                bought[order_id] = _fill_values(fill)
+            else:
+                rejected.append(order_id)
+    async with get_session() as session:
+        settled = [(order_id, user_id, 'buy', amount, price)
+                   for order_id, user_id, amount, price in await settle_buys(session, BuyOutcome(bought, []))]
+        await open_sells(session, placed, rejected)
+        if sold:
+            result = await session.execute(
+                update(Order).where(Order.id.in_(sold), Order.status == 'Open').values(status='Completed')
+                .returning(Order.id, Order.user_id, Order.order_type, Order.amount, Order.price)
+                .execution_options(synchronize_session=False)
+            )
+            settled.extend(result.all())
+        today = datetime.utcnow().date()
+        await record_fills(session, [Fill(user_id, order_type, amount, price, today) for _, user_id, order_type, amount, price in settled])
+        await outbox.enqueue_many(session, [fill_message(*fill) for fill in settled])
+        await session.commit()
+    if settled or placed or rejected:
+        logger.info("Resolved pending orders: %d filled, %d placed, %d cancelled", len(settled), len(placed), len(rejected))
+
+
+async def _api_keys(user_ids):
+    """
+    {user_id: (api_key, api_secret)} пользователей, сохранивших ключ вместе с секретом.
+    """
+    async with get_session() as session:
+        result = await session.execute(
+            select(User.id, User.api_key, User.api_secret).where(User.id.in_(list(user_ids)))
+        )
+        return {user_id: (api_key, api_secret) for user_id, api_key, api_secret in result if api_key and api_secret}
+
+
+async def place_sell_orders(orders):
+    """
+    Выставляет на биржу лимитные продажи сохранённых ордеров со статусом Pending.
+    Принятые биржей становятся Open с exchange_order_id, отклонённые - Cancelled, ордера
+    с невыясненным статусом остаются Pending до resolve_pending. Исполнение и отмену
+    принятых затем приносит поток данных аккаунта.
+    Возвращает id отклонённых ордеров.
+    """
+    keys = await _api_keys({order.user_id for order in orders})
+    rejected = [order.id for order in orders if order.user_id not in keys]
+    orders = [order for order in orders if order.user_id in keys]
+    results = await asyncio.gather(
+        *(exchange_client.place_order(keys[order.user_id][0], 'SELL', 'LIMIT', quantity=ledger.format_btc(ledger.to_sat(order.amount)),
+                                      price=order.price, client_order_id=client_order_id(order.id), secret=keys[order.user_id][1])
+          for order in orders),
+        return_exceptions=True,
+    )
+    placed = []
+    for order, result in zip(orders, results):
+        if isinstance(result, OrderStatusUnknown):
+            logger.warning("Exchange sell of order %s has unknown status: %s", order.id, result)
+        elif isinstance(result, ExchangeError):
+            logger.warning("Exchange sell of order %s failed: %s", order.id, result)
+            rejected.append(order.id)
+        elif isinstance(result, BaseException):
+            logger.error("Exchange sell of order %s failed", order.id, exc_info=result)
+        else:
+            placed.append((order.id, result['orderId']))
+    async with get_session() as session:
+        await open_sells(session, placed, rejected)
+        await session.commit()
+    return rejected
+
+
+async def open_sells(session, placed, rejected):
+    """
+    Переводит Pending-продажи в транзакции session: размещённые - в Open с exchange_order_id
+    (placed - список (id, id ордера на бирже)), отклонённые - в Cancelled.
+    Подтверждение или отказ пользователю пишется в outbox в той же транзакции:
+    об ордере сообщается, только когда биржа его приняла.
+    """
+    messages = []
+    if rejected:
+        result = await session.execute(
+            update(Order).where(Order.id.in_(rejected), Order.status == 'Pending').values(status='Cancelled')
+            .returning(Order.id, Order.user_id, Order.order_type)
+            .execution_options(synchronize_session=False)
+        )
+        messages.extend(
+            outbox.Message(user_id, f"The exchange did not accept sell order №{order_id}. It has been cancelled.",
+                           dedupe_key=f"sell_rejected:{order_id}")
+            for order_id, user_id, order_type in result if order_type == 'sell'
+        )
+    if placed:
+        ids = values(column('id', BigInteger), column('exchange_order_id', BigInteger), name='ids').data(placed)
+        result = await session.execute(
+            update(Order).where(Order.id == ids.c.id, Order.status == 'Pending')
+            .values(status='Open', exchange_order_id=ids.c.exchange_order_id)
+            .returning(Order.id, Order.user_id, Order.amount, Order.price, Order.date_created)
+            .execution_options(synchronize_session=False)
+        )
+        messages.extend(sell_placed_message(*row) for row in result)
+    await outbox.enqueue_many(session, messages)
+
+
+async def cancel_order(order_id, user_id):
+    """
+    Отменяет на бирже открытый ордер пользователя. None - ордер не размещён на бирже,
+    False - отменить не удалось. Статус и балансы обновит поток данных аккаунта.
+    """
+    async with get_session() as session:
+        result = await session.execute(
+            select(Order.exchange_order_id, User.api_key, User.api_secret)
+            .join(User, User.id == Order.user_id)
+            .where(Order.id == order_id, Order.user_id == user_id, Order.status == 'Open')
+        )
+        row = result.first()
+    if row is None or row.exchange_order_id is None:
+        return None
+    try:
+        await exchange_client.cancel_order(row.api_key, order_id=row.exchange_order_id, secret=row.api_secret)
+    except ExchangeError as e:
+        logger.warning("Exchange cancel of order %s failed: %s", order_id, e)
+        return False
+    return True
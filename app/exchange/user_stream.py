@@ -0,0 +1,366 @@
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from datetime import datetime
+
+import aiohttp
+from sqlalchemy import select, update, values, column, BigInteger, String
+
+from app.config import (EXCHANGE_STREAM_URL, EXCHANGE_STREAMS_PER_CONNECTION, EXCHANGE_STREAM_FLUSH_INTERVAL,
+                        EXCHANGE_LISTEN_KEY_KEEPALIVE, EXCHANGE_BASE_ASSET, EXCHANGE_QUOTE_ASSET,
+                        EXCHANGE_PENDING_ORDER_TIMEOUT)
+from app.models import User, Order
+from app.utils.db import get_session
+from app.utils.sharding import user_filter
+from app.services import ledger, outbox
+from app.services.stats import Fill, record_fills
+from app.services.order_book import fill_message
+from app.exchange.client import exchange_client, ExchangeError
+from app.exchange.trading import resolve_pending
+
+logger = logging.getLogger(__name__)
+
+# Статусы ордеров биржи, после которых ордер закрыт
+ORDER_STATUSES = {
+    'FILLED': 'Completed',
+    'CANCELED': 'Cancelled',
+    'EXPIRED': 'Cancelled',
+    'EXPIRED_IN_MATCH': 'Cancelled',
+    'REJECTED': 'Cancelled',
+}
+# Актив -> (поле свободного остатка, поле заблокированного, перевод в целые единицы)
+ASSET_FIELDS = {
+    EXCHANGE_BASE_ASSET: ('btc_available_sat', 'btc_frozen_sat', ledger.to_sat),
+    EXCHANGE_QUOTE_ASSET: ('usdt_available_micro', 'usdt_frozen_micro', ledger.to_micro),
+}
+# Событие ордера, чей exchange_order_id ещё не записан (размещение и событие разминулись),
+# повторяется при следующих записях в течение этого срока, мс
+UNMATCHED_ORDER_TTL = 30000
+UNMATCHED_RETRY_INTERVAL = 2.0
+SUBSCRIBE_CHUNK = 100  # listen key в одном сообщении SUBSCRIBE
+RESYNC_CONCURRENCY = 20
+
+
+class StreamConnection:
+    """
+    Одно соединение WebSocket с подписками на listen key нескольких пользователей.
+    После каждого (пере)подключения запрашивает снимки состояния у REST API,
+    чтобы восполнить события, пропущенные за время разрыва.
+    """
+    def __init__(self, manager, index):
+        self.manager = manager
+        self.index = index
+        self.listen_keys = set()
+        self._ws = None
+        self._request_ids = itertools.count(1)
+        self._task = None
+
+    @property
+    def connected(self):
+        return self._ws is not None and not self._ws.closed
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def subscribe(self, listen_keys, method='SUBSCRIBE'):
+        # Без соединения подписка произойдёт при подключении
+        if not self.connected:
+            return
+        listen_keys = list(listen_keys)
+        for start in range(0, len(listen_keys), SUBSCRIBE_CHUNK):
+            await self._ws.send_str(json.dumps({
+                'method': method, 'params': listen_keys[start:start + SUBSCRIBE_CHUNK], 'id': next(self._request_ids),
+            }))
+
+    async def _run(self):
+        attempt = 0
+        while True:
+            try:
+                async with exchange_client.ws_connect(f'{self.manager.url}/stream') as ws:
+                    self._ws = ws
+                    attempt = 0
+                    await self.subscribe(self.listen_keys)
+                    self.manager.resync(self.listen_keys)
+                    async for message in ws:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            self.manager.on_message(json.loads(message.data))
+                        elif message.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                            break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("User data stream connection %d failed", self.index)
+            finally:
+                self._ws = None
+            attempt += 1
+            await asyncio.sleep(random.uniform(0, min(30.0, 0.5 * 2 ** attempt)))
+
+
+class UserStreamManager:
+    """
+    Потоки данных аккаунтов пользователей этого процесса на бирже.
+    Listen key пользователей распределяются по соединениям, до per_connection на соединение.
+    События складываются в буферы (по пользователю и по ордеру остаётся последнее)
+    и записываются в базу пакетами: одна транзакция на интервал flush_interval.
+    Ордера, оставшиеся Pending дольше pending_timeout, периодически ищутся на бирже (resolve_pending).
+    """
+    def __init__(self, url=EXCHANGE_STREAM_URL, per_connection=EXCHANGE_STREAMS_PER_CONNECTION,
+                 flush_interval=EXCHANGE_STREAM_FLUSH_INTERVAL, keepalive=EXCHANGE_LISTEN_KEY_KEEPALIVE,
+                 pending_timeout=EXCHANGE_PENDING_ORDER_TIMEOUT):
+        self.url = url.rstrip('/')
+        self.pending_timeout = pending_timeout
+        self.per_connection = per_connection
+        self.flush_interval = flush_interval
+        self.keepalive = keepalive
+        self._credentials = {}  # user_id -> (api_key, api_secret)
+        self._listen_keys = {}  # user_id -> listen_key
+        self._users = {}  # listen_key -> user_id
+        self._connection_of = {}  # listen_key -> StreamConnection
+        self._connections = []
+        self._balances = {}  # user_id -> {поле: (время события, значение)}
+        self._orders = {}  # exchange_order_id -> (время события, статус)
+        self._unmatched = {}  # события ордеров без сохранённого exchange_order_id, для повтора
+        self._retry_at = 0.0
+        self._resync_limit = asyncio.Semaphore(RESYNC_CONCURRENCY)
+        self._tasks = []
+        self._background = set()  # задачи переподписки и восполнения пропусков
+
+    def __len__(self):
+        return len(self._listen_keys)
+
+    async def start(self):
+        async with get_session() as session:
+            result = await session.execute(
+                select(User.id, User.api_key, User.api_secret)
+                .where(User.api_key.isnot(None), User.api_secret.isnot(None), user_filter(User.id))
+            )
+            accounts = result.all()
+        await asyncio.gather(*(self.add(user_id, api_key, api_secret) for user_id, api_key, api_secret in accounts))
+        self._tasks = [
+            asyncio.create_task(self._flush_loop()),
+            asyncio.create_task(self._keepalive_loop()),
+            asyncio.create_task(self._pending_loop()),
+        ]
+        logger.info("User data streams: %d accounts on %d connections", len(self), len(self._connections))
+
+    async def stop(self):
+        tasks = [*self._tasks, *self._background]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.gather(*(connection.stop() for connection in self._connections))
+        self._connections = []
+        await self.flush()
+
+    async def add(self, user_id, api_key, api_secret):
+        """
+        Подключает поток аккаунта пользователя или переключает его на новый ключ.
+        Секрет нужен для подписанных запросов восполнения пропусков.
+        """
+        if self._credentials.get(user_id) == (api_key, api_secret) and user_id in self._listen_keys:
+            return
+        self._credentials[user_id] = (api_key, api_secret)
+        try:
+            listen_key = await exchange_client.create_listen_key(api_key)
+        except ExchangeError as e:
+            logger.warning("No user data stream for user %s: %s", user_id, e)
+            return
+        await self._detach(user_id)
+        self._listen_keys[user_id] = listen_key
+        self._users[listen_key] = user_id
+        connection = self._connection_with_room()
+        connection.listen_keys.add(listen_key)
+        self._connection_of[listen_key] = connection
+        await connection.subscribe([listen_key])
+        if connection.connected:
+            self.resync([listen_key])
+
+    async def _detach(self, user_id):
+        listen_key = self._listen_keys.pop(user_id, None)
+        if listen_key is None:
+            return
+        self._users.pop(listen_key, None)
+        connection = self._connection_of.pop(listen_key)
+        connection.listen_keys.discard(listen_key)
+        await connection.subscribe([listen_key], 'UNSUBSCRIBE')
+
+    def _connection_with_room(self):
+        for connection in self._connections:
+            if len(connection.listen_keys) < self.per_connection:
+                return connection
+        connection = StreamConnection(self, len(self._connections))
+        self._connections.append(connection)
+        connection.start()
+        return connection
+
+    def on_message(self, message):
+        data = message.get('data')
+        user_id = self._users.get(message.get('stream'))
+        if not isinstance(data, dict) or user_id is None:
+            return  # ответы на SUBSCRIBE и события отключённых ключей
+        event = data.get('e')
+        if event == 'outboundAccountPosition':
+            self._buffer_balances(user_id, data['u'], data['B'], 'a', 'f', 'l')
+        elif event == 'executionReport':
+            self._buffer_order(data['i'], data['E'], data['X'])
+        elif event == 'listenKeyExpired':
+            self._spawn(self._renew(user_id))
+
+    def _buffer_balances(self, user_id, event_time, assets, asset_key, free_key, locked_key):
+        fields = self._balances.setdefault(user_id, {})
+        for asset in assets:
+            mapping = ASSET_FIELDS.get(asset[asset_key])
+            if mapping is None:
+                continue
+            free_field, locked_field, to_units = mapping
+            for field, value in ((free_field, asset[free_key]), (locked_field, asset[locked_key])):
+                # Снимок REST и событие потока могут прийти в любом порядке: остаётся более позднее
+                if field not in fields or fields[field][0] <= event_time:
+                    fields[field] = (event_time, to_units(value))
+
+    def _buffer_order(self, exchange_order_id, event_time, status):
+        status = ORDER_STATUSES.get(status)
+        if status is None:
+            return
+        current = self._orders.get(exchange_order_id)
+        if current is None or current[0] <= event_time:
+            self._orders[exchange_order_id] = (event_time, status)
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _renew(self, user_id):
+        credentials = self._credentials.get(user_id)
+        if credentials is None:
+            return
+        await self._detach(user_id)
+        await self.add(user_id, *credentials)
+
+    def resync(self, listen_keys):
+        """
+        Восполнение пропуска: снимки балансов и открытых ордеров из REST для пользователей ключей.
+        """
+        for listen_key in list(listen_keys):
+            user_id = self._users.get(listen_key)
+            if user_id is not None:
+                self._spawn(self._resync_user(user_id))
+
+    async def _resync_user(self, user_id):
+        api_key, api_secret = self._credentials[user_id]
+        async with self._resync_limit:
+            try:
+                account = await exchange_client.account(api_key, api_secret)
+                self._buffer_balances(user_id, account['updateTime'], account['balances'], 'asset', 'free', 'locked')
+                async with get_session() as session:
+                    result = await session.execute(
+                        select(Order.exchange_order_id)
+                        .where(Order.user_id == user_id, Order.status == 'Open', Order.exchange_order_id.isnot(None))
+                    )
+                    open_orders = result.scalars().all()
+                for exchange_order_id in open_orders:
+                    order = await exchange_client.get_order(api_key, order_id=exchange_order_id, secret=api_secret)
+                    self._buffer_order(exchange_order_id, order.get('updateTime', 0), order['status'])
+            except ExchangeError as e:
+                logger.warning("Resync of user %s failed: %s", user_id, e)
+
+    async def _keepalive_loop(self):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            for user_id, listen_key in list(self._listen_keys.items()):
+                try:
+                    await exchange_client.keepalive_listen_key(self._credentials[user_id][0], listen_key)
+                except ExchangeError as e:
+                    logger.warning("Listen key of user %s expired: %s", user_id, e)
+                    await self._renew(user_id)
+
+    async def _pending_loop(self):
+        while True:
+            await asyncio.sleep(self.pending_timeout / 2)
+            try:
+                await resolve_pending(self.pending_timeout)
+            except Exception:
+                logger.exception("Failed to resolve pending orders")
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to write user data stream events")
+
+    async def flush(self):
+        if not self._balances and not self._orders and (not self._unmatched or time.monotonic() < self._retry_at):
+            return
+        balances, self._balances = self._balances, {}
+        orders, self._orders = {**self._unmatched, **self._orders}, {}
+        self._unmatched = {}
+        try:
+            closed = await apply_updates(
+                {user_id: {field: value for field, (_, value) in fields.items()} for user_id, fields in balances.items()},
+                {exchange_order_id: status for exchange_order_id, (_, status) in orders.items()},
+            )
+        except Exception:
+            # Возвращаем события в буферы, не затирая пришедшие позже
+            for user_id, fields in balances.items():
+                current = self._balances.setdefault(user_id, {})
+                for field, item in fields.items():
+                    if field not in current or current[field][0] <= item[0]:
+                        current[field] = item
+            for exchange_order_id, item in orders.items():
+                if exchange_order_id not in self._orders or self._orders[exchange_order_id][0] <= item[0]:
+                    self._orders[exchange_order_id] = item
+            raise
+        matched = {row[-1] for row in closed}
+        expires = int(time.time() * 1000) - UNMATCHED_ORDER_TTL
+        self._unmatched = {
+            exchange_order_id: item for exchange_order_id, item in orders.items()
+            if exchange_order_id not in matched and item[0] > expires
+        }
+        self._retry_at = time.monotonic() + UNMATCHED_RETRY_INTERVAL
+
+
+async def apply_updates(balances, orders):
+    """
+    Записывает пакет событий одной транзакцией: остатки через журнал (ledger.sync_many),
+    статусы ордеров одним UPDATE ... FROM (VALUES ...), уведомления об исполнении - в outbox.
+    Балансы по исполненным ордерам уже пришли в событиях остатков, поэтому для них
+    обновляется только статистика.
+    Возвращает закрытые ордера (id, user_id, order_type, amount, price, status, exchange_order_id).
+    """
+    async with get_session() as session:
+        await ledger.sync_many(session, balances)
+        closed = []
+        if orders:
+            statuses = values(
+                column('exchange_order_id', BigInteger), column('status', String), name='statuses'
+            ).data(list(orders.items()))
+            result = await session.execute(
+                update(Order)
+                .where(Order.exchange_order_id == statuses.c.exchange_order_id, Order.status == 'Open')
+                .values(status=statuses.c.status)
+                .returning(Order.id, Order.user_id, Order.order_type, Order.amount, Order.price, Order.status, Order.exchange_order_id)
+                .execution_options(synchronize_session=False)
+            )
+            closed = result.all()
+            today = datetime.utcnow().date()
+            filled = [row[:5] for row in closed if row.status == 'Completed']
+            await record_fills(session, [Fill(user_id, order_type, amount, price, today) for _, user_id, order_type, amount, price in filled])
+            await outbox.enqueue_many(session, [fill_message(*fill) for fill in filled])
+        await session.commit()
+    return closed
+
+
+user_stream = UserStreamManager()
@@ -1,13 +1,28 @@
 # app/handlers/commands.py
 
+import asyncio
+from decimal import Decimal
+from typing import Optional
+
 from aiogram import Router, types
-from aiogram.filters import Command
-from sqlalchemy import select
-from sqlalchemy.orm import selectinload
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.filters import Command, CommandObject
+from sqlalchemy import select, update
 
-from app.models import User, Order, UserParameters, Balance
+from app.models import Order, UserParameters
 from app.utils.locale import load_locale
 from app.utils.db import get_session
+from app.utils.user_cache import UserSnapshot
+from app.utils.render import render, autobuy_keyboard, SELL_ORDER_KEYBOARD, STATS_PERIOD_KEYBOARD
+from app.services.price_feed import price_feed
+from app.services.autotrade import autotrade_engine
+from app.services.order_book import order_book, sell_placed_message
+from app.services.alerts import alert_index, alert_watcher
+from app.services.backtest import BacktestParams, load_candles, run_backtest
+from app.services.stats import Fill, record_fills, period_stats
+from app.services import ledger, outbox
+from app.exchange import trading as exchange_trading
+from app.config import BACKTEST_CANDLES_FILE, EXCHANGE_TRADING, MAX_PRICE_ALERTS
 from datetime import datetime, timedelta
 from aiogram.types import ReplyKeyboardRemove
 from aiogram.fsm.context import FSMContext
@@ -23,80 +38,106 @@ class SellStates(StatesGroup):
     waiting_for_sell_price = State()
 
 @router.message(Command('buy'))
-async def cmd_buy(message: types.Message, state: FSMContext):
+async def cmd_buy(message: types.Message, state: FSMContext, user: UserSnapshot):
+    # Registration is enforced by SubscriptionMiddleware, which also passes the user snapshot
+    locale = load_locale(user.language)
+    balance = await ledger.get_balance(user.id)
+    # Display instruction and current balance
+    current_price = price_feed.price
+    price_text = f"{current_price} USDT/BTC" if current_price else "unavailable"
+    balance_text = f"Available USDT: {ledger.format_usdt(balance.usdt_available_micro)}\nCurrent Price: {price_text}"
+    await message.answer(f"{locale.get('buy_instruction', 'Please enter the amount to buy in USDT.')}\n\n{balance_text}")
+    await state.set_state(BuyStates.waiting_for_amount)
+
+def purchase_messages(order_id, user_id, bought_btc, spent, now):
+    # The confirmation and the sell offer are committed together with the purchase
+    return [
+        outbox.Message(
+            user_id,
+            f"Purchase successful.\nBought: {bought_btc} BTC\nPrice: {ledger.format_usdt(spent)} USDT\nDate and time: {now}",
+            dedupe_key=f"buy:{order_id}",
+        ),
+        outbox.Message(
+            user_id,
+            f"Do you want to create a sell order for {bought_btc} BTC?",
+            dedupe_key=f"buy_offer:{order_id}",
+            reply_markup=SELL_ORDER_KEYBOARD,
+        ),
+    ]
+
+async def exchange_buy(message, user_id, spent):
+    # The order is saved as Pending before it is sent: after a lost response or a restart
+    # the user data stream finds it on the exchange by its client order id
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.balance))
-            .where(User.id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await message.answer("User not found. Please use /start to register.")
-            return
-        locale = load_locale(user.language)
-        balance = user.balance
-        if not balance:
-            # Initialize user's balance if it doesn't exist
-            balance = Balance(user_id=user.id)
-            session.add(balance)
-            await session.commit()
-        # Display instruction and current balance
-        balance_text = f"Available USDT: {balance.usdt_available}\nCurrent Price: 50000 USDT/BTC"  # Using a fictitious price
-        await message.answer(f"{locale.get('buy_instruction', 'Please enter the amount to buy in USDT.')}\n\n{balance_text}")
-        await state.set_state(BuyStates.waiting_for_amount)
+        order = Order(user_id=user_id, order_type='buy', status='Pending', date_created=datetime.utcnow())
+        session.add(order)
+        await session.commit()
+    outcome = await exchange_trading.market_buys({order.id: (user_id, spent)})
+    async with get_session() as session:
+        # Record what the exchange actually executed
+        settled = await exchange_trading.settle_buys(session, outcome)
+        for order_id, _, bought_btc, price in settled:
+            _, spent, _, _ = outcome.filled[order_id]
+            await record_fills(session, [Fill(user_id, 'buy', bought_btc, price, order.date_created.date())])
+            await outbox.enqueue_many(session, purchase_messages(order_id, user_id, bought_btc, spent, order.date_created))
+        await session.commit()
+    if order.id in outcome.rejected:
+        await message.answer("The exchange did not execute the purchase. Check your API key and try again later.")
+    elif not settled:
+        await message.answer(f"The exchange has not confirmed purchase №{order.id} yet. You will be notified once it is settled.")
 
 @router.message(BuyStates.waiting_for_amount)
 async def process_buy_amount(message: types.Message, state: FSMContext):
     amount_text = message.text.strip()
+    user_id = message.from_user.id
     try:
         amount = float(amount_text)
-        if amount <= 0:
+        spent = ledger.to_micro(amount)
+        if spent <= 0:
+            raise ValueError
+        balance = await ledger.get_balance(user_id)
+        if balance.usdt_available_micro < spent:
+            await message.answer("Insufficient funds.")
+            return
+        if EXCHANGE_TRADING:
+            # The exchange enforces the funds; balances arrive through the user data stream
+            await exchange_buy(message, user_id, spent)
+            return
+        # Emulate purchase at the latest streamed price
+        current_price = await price_feed.get_price()
+        bought_sat = ledger.to_sat(ledger.from_micro(spent) / Decimal(str(current_price)))
+        if bought_sat <= 0:
             raise ValueError
+        bought_btc = float(ledger.from_sat(bought_sat))
         async with get_session() as session:
-            result = await session.execute(
-                select(User)
-                .options(selectinload(User.balance))
-                .where(User.id == message.from_user.id)
-            )
-            user = result.scalar_one_or_none()
-            balance = user.balance
-            if balance.usdt_available < amount:
-                await message.answer("Insufficient funds.")
-                await state.clear()
-                return
-            # Emulate purchase
-            current_price = 50000  # Fictitious BTC price
-            bought_btc = amount / current_price
+            now = datetime.utcnow()
             # Create a buy order in the database
             new_order = Order(
-                user_id=user.id,
+                user_id=user_id,
                 order_type='buy',
                 amount=bought_btc,
                 price=current_price,
                 status='Completed',
-                date_created=datetime.utcnow()
+                date_created=now
             )
             session.add(new_order)
-            # Update user's balance
-            balance.usdt_available -= amount
-            balance.btc_available += bought_btc
+            await session.flush()
+            # Debit USDT only if it is still available: one conditional update, no row lock
+            change = ledger.Change(user_id, 'buy', new_order.id, btc_available_sat=bought_sat, usdt_available_micro=-spent)
+            if await ledger.apply(session, change) is None:
+                await session.rollback()
+                await message.answer("Insufficient funds.")
+                return
+            await record_fills(session, [Fill(user_id, 'buy', bought_btc, current_price, now.date())])
+            await outbox.enqueue_many(session, purchase_messages(new_order.id, user_id, bought_btc, spent, now))
             await session.commit()
-        text = f"Purchase successful.\nBought: {bought_btc} BTC\nPrice: {amount} USDT\nDate and time: {datetime.utcnow()}"
-        await message.answer(text)
-        # Offer to create a sell order
-        await message.answer(f"Do you want to create a sell order for {bought_btc} BTC?", reply_markup=create_sell_order_keyboard())
     except ValueError:
         await message.answer("Invalid amount. Please enter a valid number.")
+    except asyncio.TimeoutError:
+        await message.answer("Price is temporarily unavailable. Please try again later.")
     finally:
         await state.clear()
 
-def create_sell_order_keyboard():
-    buttons = [
-        [types.InlineKeyboardButton(text="Create Sell Order", callback_data="create_sell_order")]
-    ]
-    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
-
 @router.callback_query(lambda c: c.data == 'create_sell_order')
 async def process_create_sell_order(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.message.answer("Enter the amount to sell (in BTC):")
@@ -107,24 +148,17 @@ async def process_create_sell_order(callback_query: types.CallbackQuery, state:
 async def process_sell_amount(message: types.Message, state: FSMContext):
     amount_text = message.text.strip()
     try:
-        amount = float(amount_text)
-        if amount <= 0:
+        amount_sat = ledger.to_sat(float(amount_text))
+        if amount_sat <= 0:
             raise ValueError
-        async with get_session() as session:
-            result = await session.execute(
-                select(User)
-                .options(selectinload(User.balance))
-                .where(User.id == message.from_user.id)
-            )
-            user = result.scalar_one_or_none()
-            balance = user.balance
-            if balance.btc_available < amount:
-                await message.answer("Insufficient BTC balance.")
-                await state.clear()
-                return
-            await state.update_data(sell_amount=amount)
-            await message.answer("Enter the desired sell price per 1 BTC (in USDT):")
-            await state.set_state(SellStates.waiting_for_sell_price)
+        balance = await ledger.get_balance(message.from_user.id)
+        if balance.btc_available_sat < amount_sat:
+            await message.answer("Insufficient BTC balance.")
+            await state.clear()
+            return
+        await state.update_data(sell_amount=float(ledger.from_sat(amount_sat)))
+        await message.answer("Enter the desired sell price per 1 BTC (in USDT):")
+        await state.set_state(SellStates.waiting_for_sell_price)
     except ValueError:
         await message.answer("Invalid amount. Please enter a valid number.")
 
@@ -137,61 +171,116 @@ async def process_sell_price(message: types.Message, state: FSMContext):
             raise ValueError
         data = await state.get_data()
         amount = data.get('sell_amount')
-        total = amount * price
+        amount_sat = ledger.to_sat(amount)
         async with get_session() as session:
-            result = await session.execute(
-                select(User)
-                .options(selectinload(User.balance))
-                .where(User.id == message.from_user.id)
-            )
-            user = result.scalar_one_or_none()
-            # Create a sell order in the database
+            # Create a sell order in the database; on the exchange it opens once the exchange accepts it
             new_order = Order(
-                user_id=user.id,
+                user_id=message.from_user.id,
                 order_type='sell',
                 amount=amount,
                 price=price,
-                status='Open',
+                status='Pending' if EXCHANGE_TRADING else 'Open',
                 date_created=datetime.utcnow()
             )
             session.add(new_order)
-            # Update user's balance
-            balance = user.balance
-            balance.btc_available -= amount
-            balance.btc_frozen += amount
+            await session.flush()
+            # On the exchange the BTC is locked by the exchange itself and reported by the user data stream
+            if not EXCHANGE_TRADING:
+                # Freeze the BTC being sold
+                change = ledger.Change(new_order.user_id, 'sell_order', new_order.id, btc_available_sat=-amount_sat, btc_frozen_sat=amount_sat)
+                if await ledger.apply(session, change) is None:
+                    await session.rollback()
+                    await message.answer("Insufficient BTC balance.")
+                    return
+                await outbox.enqueue_many(session, [
+                    sell_placed_message(new_order.id, new_order.user_id, amount, price, new_order.date_created),
+                ])
             await session.commit()
-        text = f"Limit sell order successfully placed.\nSell: {amount} BTC\nSell price per 1 BTC: {price} USDT\nTotal: {total} USDT\nDate and time: {datetime.utcnow()}"
-        await message.answer(text)
+        if EXCHANGE_TRADING:
+            # The confirmation or the rejection is written once the exchange answers
+            await exchange_trading.place_sell_orders([new_order])
+        else:
+            order_book.add(new_order.id, new_order.order_type, new_order.price)
     except ValueError:
         await message.answer("Invalid price. Please enter a valid number.")
     finally:
         await state.clear()
 
+ORDERS_PAGE_SIZE = 10
+ORDER_STATUSES = ('Open', 'Completed', 'Cancelled')
+
+async def fetch_orders_page(user_id, status, direction, cursor):
+    """
+    Одна страница ордеров по ключу id (новые первыми): direction 'n' - старее cursor, 'p' - новее.
+    Читается PAGE_SIZE + 1 строк, лишняя строка означает, что дальше есть ещё страница.
+    'p' без cursor (Prev с пустой страницы) - самая новая страница, а не самые старые ордера.
+    """
+    if direction == 'p' and not cursor:
+        direction = 'n'
+    query = select(
+        Order.id, Order.order_type, Order.status, Order.amount, Order.price, Order.date_created
+    ).where(Order.user_id == user_id, Order.status == status)
+    if direction == 'p':
+        query = query.where(Order.id > cursor).order_by(Order.id.asc())
+    else:
+        if cursor:
+            query = query.where(Order.id < cursor)
+        query = query.order_by(Order.id.desc())
+    async with get_session() as session:
+        result = await session.execute(query.limit(ORDERS_PAGE_SIZE + 1))
+        rows = result.all()
+    has_more = len(rows) > ORDERS_PAGE_SIZE
+    rows = rows[:ORDERS_PAGE_SIZE]
+    if direction == 'p':
+        rows.reverse()
+        return rows, True, has_more
+    return rows, has_more, bool(cursor)
+
+def orders_page_text(status, orders):
+    if not orders:
+        return "You have no active orders." if status == 'Open' else f"You have no {status.lower()} orders."
+    orders_text = f"Orders ({status}):\n"
+    for order in orders:
+        order_text = f"Order №{order.id}\nType: {order.order_type}\nStatus: {order.status}\nAmount: {order.amount} BTC\nPrice: {order.price} USDT\nDate: {order.date_created}"
+        orders_text += order_text + "\n\n"
+    return orders_text
+
+def orders_page_keyboard(status, orders, has_older, has_newer):
+    buttons = [[
+        types.InlineKeyboardButton(text=f"• {name}" if name == status else name, callback_data=f"orders_page_{name}_n_0")
+        for name in ORDER_STATUSES
+    ]]
+    buttons += cancel_order_keyboard(orders).inline_keyboard
+    navigation = []
+    if has_newer:
+        navigation.append(types.InlineKeyboardButton(text="« Prev", callback_data=f"orders_page_{status}_p_{orders[0].id if orders else 0}"))
+    if has_older and orders:
+        navigation.append(types.InlineKeyboardButton(text="Next »", callback_data=f"orders_page_{status}_n_{orders[-1].id}"))
+    if navigation:
+        buttons.append(navigation)
+    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+
 @router.message(Command('orders'))
 async def cmd_orders(message: types.Message):
-    async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.orders))
-            .where(User.id == message.from_user.id)
+    orders, has_older, has_newer = await fetch_orders_page(message.from_user.id, 'Open', 'n', 0)
+    await message.answer(orders_page_text('Open', orders), reply_markup=orders_page_keyboard('Open', orders, has_older, has_newer))
+
+@router.callback_query(lambda c: c.data.startswith('orders_page_'))
+async def process_orders_page(callback_query: types.CallbackQuery):
+    _, _, status, direction, cursor = callback_query.data.split('_')
+    if status not in ORDER_STATUSES:
+        await callback_query.answer()
+        return
+    orders, has_older, has_newer = await fetch_orders_page(callback_query.from_user.id, status, direction, int(cursor))
+    try:
+        await callback_query.message.edit_text(
+            orders_page_text(status, orders),
+            reply_markup=orders_page_keyboard(status, orders, has_older, has_newer)
         )
-        user = result.scalar_one_or_none()
-        if not user:
-            await message.answer("User not found. Please use /start to register.")
-            return
-        locale = load_locale(user.language)
-        # Get the list of orders from the database
-        orders = user.orders
-        if not orders:
-            await message.answer("You have no active orders.")
-            return
-        orders_text = "Order status:\n"
-        for order in orders:
-            order_text = f"Order №{order.id}\nType: {order.order_type}\nStatus: {order.status}\nAmount: {order.amount} BTC\nPrice: {order.price} USDT\nDate: {order.date_created}"
-            orders_text += order_text + "\n\n"
-        await message.answer(orders_text)
-        # Add buttons to cancel orders
-        await message.answer("Do you want to cancel any order?", reply_markup=cancel_order_keyboard(orders))
+    except TelegramBadRequest:
+        # Same page pressed again: the message is not modified
+        pass
+    await callback_query.answer()
 
 def cancel_order_keyboard(orders):
     buttons = []
@@ -203,27 +292,33 @@ def cancel_order_keyboard(orders):
 @router.callback_query(lambda c: c.data.startswith('cancel_order_'))
 async def process_cancel_order(callback_query: types.CallbackQuery):
     order_id = int(callback_query.data.split('_')[2])
+    if EXCHANGE_TRADING:
+        # Orders placed on the exchange are closed by the user data stream once the exchange confirms
+        cancelled = await exchange_trading.cancel_order(order_id, callback_query.from_user.id)
+        if cancelled is not None:
+            await callback_query.message.answer(
+                f"Cancellation of order №{order_id} has been sent to the exchange." if cancelled
+                else f"The exchange did not cancel order №{order_id}. Please try again later."
+            )
+            await callback_query.answer()
+            return
     async with get_session() as session:
+        # Only an open order of this user can be cancelled; the status check also guards against a concurrent fill
         result = await session.execute(
-            select(Order)
-            .options(selectinload(Order.user).selectinload(User.balance))
-            .where(Order.id == order_id)
+            update(Order)
+            .where(Order.id == order_id, Order.user_id == callback_query.from_user.id, Order.status == 'Open')
+            .values(status='Cancelled')
+            .returning(Order.id, Order.user_id, Order.order_type, Order.amount, Order.price)
+            .execution_options(synchronize_session=False)
         )
-        order = result.scalar_one_or_none()
-        if order and order.status == 'Open':
-            # Update user's balance
-            balance = order.user.balance
-            if order.order_type == 'sell':
-                balance.btc_frozen -= order.amount
-                balance.btc_available += order.amount
-            elif order.order_type == 'buy':
-                total_amount = order.amount * order.price
-                balance.usdt_frozen -= total_amount
-                balance.usdt_available += total_amount
-            order.status = 'Cancelled'
+        order = result.one_or_none()
+        # An order that never reached the exchange froze nothing there; the stream keeps the balances
+        if order and (EXCHANGE_TRADING or await ledger.apply(session, ledger.cancel_change(*order)) is not None):
+            await outbox.enqueue(session, order.user_id, f"Order №{order.id} has been cancelled.", dedupe_key=f"cancel:{order.id}")
             await session.commit()
-            await callback_query.message.answer(f"Order №{order.id} has been cancelled.")
+            order_book.discard(order.id)
         else:
+            await session.rollback()
             await callback_query.message.answer("Order not found or already completed.")
     await callback_query.answer()
 
@@ -232,100 +327,67 @@ class ParamsStates(StatesGroup):
     waiting_for_new_value = State()
 
 @router.message(Command('autobuy'))
-async def cmd_autobuy(message: types.Message):
+async def cmd_autobuy(message: types.Message, user: UserSnapshot):
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.parameters))
-            .where(User.id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await message.answer("User not found. Please use /start to register.")
-            return
         # Get autotrading parameters
-        if not user.parameters:
+        params = await session.get(UserParameters, user.id)
+        if not params:
             params = UserParameters(user_id=user.id)
             session.add(params)
             await session.commit()
-        else:
-            params = user.parameters
         locale = load_locale(user.language)
         # Display autotrading status and current parameters
         autobuy_status = 'Running' if params.autobuy_on_growth or params.autobuy_on_fall else 'Stopped'
         message_text = f"Autotrading cycle is currently: {autobuy_status}\n\nCurrent parameters:\nPurchase amount: {params.purchase_amount} USDT\nProfit percentage: {params.profit_percentage}%\nPurchase delay: {params.purchase_delay} seconds\nGrowth percentage: {params.growth_percentage}%\nFall percentage: {params.fall_percentage}%"
-        await message.answer(message_text, reply_markup=autobuy_keyboard(params))
-
-def autobuy_keyboard(params):
-    buttons = []
-    if params.autobuy_on_growth or params.autobuy_on_fall:
-        buttons.append([types.InlineKeyboardButton(text="Stop", callback_data="autobuy_stop")])
-    else:
-        buttons.append([types.InlineKeyboardButton(text="Start", callback_data="autobuy_start")])
-    buttons.append([types.InlineKeyboardButton(text="Change parameters", callback_data="change_params")])
-    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+        await message.answer(message_text, reply_markup=autobuy_keyboard(autobuy_status == 'Running'))
 
 @router.callback_query(lambda c: c.data == 'autobuy_start')
-async def process_autobuy_start(callback_query: types.CallbackQuery):
+async def process_autobuy_start(callback_query: types.CallbackQuery, user: Optional[UserSnapshot] = None):
+    if not user:
+        await callback_query.message.answer("User not found. Please use /start to register.")
+        return
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.parameters))
-            .where(User.id == callback_query.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await callback_query.message.answer("User not found. Please use /start to register.")
-            return
-        params = user.parameters
+        params = await session.get(UserParameters, user.id)
+        if not params:
+            params = UserParameters(user_id=user.id)
+            session.add(params)
         # Start autotrading
         params.autobuy_on_growth = True
         params.autobuy_on_fall = True
         await session.commit()
+        autotrade_engine.upsert(params)
         await callback_query.message.answer("Autotrading cycle started.")
     await callback_query.answer()
 
 @router.callback_query(lambda c: c.data == 'autobuy_stop')
-async def process_autobuy_stop(callback_query: types.CallbackQuery):
+async def process_autobuy_stop(callback_query: types.CallbackQuery, user: Optional[UserSnapshot] = None):
+    if not user:
+        await callback_query.message.answer("User not found. Please use /start to register.")
+        return
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.parameters))
-            .where(User.id == callback_query.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await callback_query.message.answer("User not found. Please use /start to register.")
-            return
-        params = user.parameters
-        if params.autobuy_on_growth or params.autobuy_on_fall:
+        params = await session.get(UserParameters, user.id)
+        if params and (params.autobuy_on_growth or params.autobuy_on_fall):
             params.autobuy_on_growth = False
             params.autobuy_on_fall = False
             await session.commit()
+            autotrade_engine.remove(user.id)
             await callback_query.message.answer("Autotrading cycle stopped.")
         else:
             await callback_query.message.answer("Autotrading cycle is not running.")
     await callback_query.answer()
 
 @router.callback_query(lambda c: c.data == 'change_params')
-async def process_change_params(callback_query: types.CallbackQuery, state: FSMContext):
+async def process_change_params(callback_query: types.CallbackQuery, state: FSMContext, user: Optional[UserSnapshot] = None):
+    if not user:
+        await callback_query.message.answer("User not found. Please use /start to register.")
+        return
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.parameters))
-            .where(User.id == callback_query.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await callback_query.message.message.answer("User not found. Please use /start to register.")
-            return
         # Get parameters
-        if not user.parameters:
+        params = await session.get(UserParameters, user.id)
+        if not params:
             params = UserParameters(user_id=user.id)
             session.add(params)
             await session.commit()
-        else:
-            params = user.parameters
         # Display current parameters
         params_text = f"Parameters:\n1. Purchase amount (USDT): {params.purchase_amount}\n2. Profit percentage: {params.profit_percentage}%\n3. Purchase delay: {params.purchase_delay} seconds\n4. Growth percentage: {params.growth_percentage}%\n5. Fall percentage: {params.fall_percentage}%\n6. Autobuy on growth: {'Enabled' if params.autobuy_on_growth else 'Disabled'}\n7. Autobuy on fall: {'Enabled' if params.autobuy_on_fall else 'Disabled'}\n\nEnter the number of the parameter you want to change, or type 'reset' to reset to default."
         await callback_query.message.answer(params_text)
@@ -333,24 +395,14 @@ async def process_change_params(callback_query: types.CallbackQuery, state: FSMC
     await callback_query.answer()
 
 @router.message(Command('params'))
-async def cmd_params(message: types.Message, state: FSMContext):
+async def cmd_params(message: types.Message, state: FSMContext, user: UserSnapshot):
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.parameters))
-            .where(User.id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await message.answer("User not found. Please use /start to register.")
-            return
         # Get parameters
-        if not user.parameters:
+        params = await session.get(UserParameters, user.id)
+        if not params:
             params = UserParameters(user_id=user.id)
             session.add(params)
             await session.commit()
-        else:
-            params = user.parameters
         # Display current parameters
         params_text = f"Parameters:\n1. Purchase amount (USDT): {params.purchase_amount}\n2. Profit percentage: {params.profit_percentage}%\n3. Purchase delay: {params.purchase_delay} seconds\n4. Growth percentage: {params.growth_percentage}%\n5. Fall percentage: {params.fall_percentage}%\n6. Autobuy on growth: {'Enabled' if params.autobuy_on_growth else 'Disabled'}\n7. Autobuy on fall: {'Enabled' if params.autobuy_on_fall else 'Disabled'}\n\nEnter the number of the parameter you want to change, or type 'reset' to reset to default."
         await message.answer(params_text)
@@ -361,16 +413,12 @@ async def process_param_choice(message: types.Message, state: FSMContext):
     choice = message.text.strip().lower()
     if choice == 'reset':
         async with get_session() as session:
-            result = await session.execute(
-                select(User)
-                .options(selectinload(User.parameters))
-                .where(User.id == message.from_user.id)
-            )
-            user = result.scalar_one_or_none()
             # Reset parameters
-            if user.parameters:
-                await session.delete(user.parameters)
+            params = await session.get(UserParameters, message.from_user.id)
+            if params:
+                await session.delete(params)
                 await session.commit()
+            autotrade_engine.remove(message.from_user.id)
             await message.answer("Parameters have been reset to default.")
         await state.clear()
     elif choice in ['1', '2', '3', '4', '5', '6', '7']:
@@ -381,22 +429,15 @@ async def process_param_choice(message: types.Message, state: FSMContext):
         await message.answer("Invalid choice. Please enter a number from 1 to 7, or 'reset'.")
 
 @router.message(ParamsStates.waiting_for_new_value)
-async def process_new_value(message: types.Message, state: FSMContext):
+async def process_new_value(message: types.Message, state: FSMContext, user: Optional[UserSnapshot] = None):
     data = await state.get_data()
     param_choice = data.get('param_choice')
     new_value = message.text.strip()
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.parameters))
-            .where(User.id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user.parameters:
-            params = UserParameters(user_id=user.id)
+        params = await session.get(UserParameters, message.from_user.id)
+        if not params:
+            params = UserParameters(user_id=message.from_user.id)
             session.add(params)
-        else:
-            params = user.parameters
         try:
             if param_choice in [1, 2, 3, 4, 5]:
                 value = float(new_value)
@@ -419,157 +460,162 @@ async def process_new_value(message: types.Message, state: FSMContext):
             elif param_choice == 7:
                 params.autobuy_on_fall = value
             await session.commit()
+            if user and user.has_subscription:
+                autotrade_engine.upsert(params)
             await message.answer("Parameter updated successfully.")
         except ValueError:
             await message.answer("Invalid value. Please enter a valid number.")
     await state.clear()
 
 @router.message(Command('stop'))
-async def cmd_stop(message: types.Message):
+async def cmd_stop(message: types.Message, user: UserSnapshot):
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.parameters))
-            .where(User.id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await message.answer("User not found. Please use /start to register.")
-            return
-        params = user.parameters
-        if params.autobuy_on_growth or params.autobuy_on_fall:
+        params = await session.get(UserParameters, user.id)
+        if params and (params.autobuy_on_growth or params.autobuy_on_fall):
             params.autobuy_on_growth = False
             params.autobuy_on_fall = False
             await session.commit()
+            autotrade_engine.remove(user.id)
             await message.answer("Autotrading cycle stopped.")
         else:
             await message.answer("Autotrading cycle is not running.")
 
 @router.message(Command('stats'))
 async def cmd_stats(message: types.Message):
-    await message.answer("Select the time period:", reply_markup=stats_period_keyboard())
-
-def stats_period_keyboard():
-    buttons = [
-        [types.InlineKeyboardButton(text="Daily", callback_data="stats_daily")],
-        [types.InlineKeyboardButton(text="Monthly", callback_data="stats_monthly")],
-        [types.InlineKeyboardButton(text="Full", callback_data="stats_full")]
-    ]
-    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+    await message.answer("Select the time period:", reply_markup=STATS_PERIOD_KEYBOARD)
 
 @router.callback_query(lambda c: c.data.startswith('stats_'))
 async def process_stats_period(callback_query: types.CallbackQuery):
     period = callback_query.data.split('_')[1]
+    today = datetime.utcnow().date()
+    if period == 'daily':
+        since = today
+        period_text = "Daily"
+    elif period == 'monthly':
+        since = today - timedelta(days=29)
+        period_text = "Monthly"
+    else:
+        since = None
+        period_text = "Full"
+    # One aggregate read over the per-day rollups instead of loading every order
     async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .where(User.id == callback_query.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await callback_query.message.answer("User not found. Please use /start to register.")
-            return
-        now = datetime.utcnow()
-        if period == 'daily':
-            start_time = now - timedelta(days=1)
-            period_text = "Daily"
-        elif period == 'monthly':
-            start_time = now - timedelta(days=30)
-            period_text = "Monthly"
-        else:
-            start_time = datetime.min
-            period_text = "Full"
-        # Get the number of trades and profit
-        trades_result = await session.execute(
-            select(Order).where(Order.user_id == user.id, Order.date_created >= start_time)
-        )
-        trades = trades_result.scalars().all()
-        num_trades = len(trades)
-        total_profit = 0.0  # You can implement profit calculation based on your data
-        stats_text = f"Time period: {period_text}\nNumber of trades: {num_trades}\nProfit: {total_profit} USDT"
-        await callback_query.message.answer(stats_text)
+        num_trades, volume, total_profit = await period_stats(session, callback_query.from_user.id, since)
+    stats_text = (
+        f"Time period: {period_text}\nNumber of trades: {num_trades}\n"
+        f"Volume: {volume:.2f} USDT\nProfit: {total_profit:.2f} USDT"
+    )
+    await callback_query.message.answer(stats_text)
     await callback_query.answer()
 
 @router.message(Command('balance'))
 async def cmd_balance(message: types.Message):
-    async with get_session() as session:
-        result = await session.execute(
-            select(User)
-            .options(selectinload(User.balance))
-            .where(User.id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await message.answer("User not found. Please use /start to register.")
-            return
-        balance = user.balance
-        if not balance:
-            # Initialize user's balance if it doesn't exist
-            balance = Balance(user_id=user.id)
-            session.add(balance)
-            await session.commit()
-        # Calculate total amounts
-        orders_pending_execution = balance.usdt_frozen
-        available_balance = balance.usdt_available
-        total_balance = orders_pending_execution + available_balance
-
-        balance_text = "Balance:\n\nCryptocurrencies:\n"
-        balance_text += f"- Bitcoin: Available: {balance.btc_available} BTC, Frozen: {balance.btc_frozen} BTC\n"
-        balance_text += f"- USDT: Available: {balance.usdt_available} USDT, Frozen: {balance.usdt_frozen} USDT\n\n"
-        balance_text += "Sum of funds:\n"
-        balance_text += f"- Orders pending execution: {orders_pending_execution} USDT\n"
-        balance_text += f"- Available balance: {available_balance} USDT\n"
-        balance_text += f"- Total amount: {total_balance} USDT"
-        await message.answer(balance_text)
+    # Served from the cached balance projection; registration is enforced by SubscriptionMiddleware
+    balance = await ledger.get_balance(message.from_user.id)
+    # Calculate total amounts
+    orders_pending_execution = ledger.format_usdt(balance.usdt_frozen_micro)
+    available_balance = ledger.format_usdt(balance.usdt_available_micro)
+    total_balance = ledger.format_usdt(balance.usdt_frozen_micro + balance.usdt_available_micro)
+
+    balance_text = "Balance:\n\nCryptocurrencies:\n"
+    balance_text += f"- Bitcoin: Available: {ledger.format_btc(balance.btc_available_sat)} BTC, Frozen: {ledger.format_btc(balance.btc_frozen_sat)} BTC\n"
+    balance_text += f"- USDT: Available: {available_balance} USDT, Frozen: {orders_pending_execution} USDT\n\n"
+    balance_text += "Sum of funds:\n"
+    balance_text += f"- Orders pending execution: {orders_pending_execution} USDT\n"
+    balance_text += f"- Available balance: {available_balance} USDT\n"
+    balance_text += f"- Total amount: {total_balance} USDT"
+    await message.answer(balance_text)
 
 @router.message(Command('price'))
 async def cmd_price(message: types.Message):
-    # Emulate current price
-    current_price = 50000  # Fictitious price for testing
+    try:
+        current_price = await price_feed.get_price()
+    except asyncio.TimeoutError:
+        await message.answer("Price is temporarily unavailable. Please try again later.")
+        return
     await message.answer(f"Current asset price:\n- BTC/USDT: {current_price} USDT")
 
+ALERT_USAGE = "Usage:\n/alert above 65000 - notify when the price rises to 65000 USDT\n/alert below 60000 - notify when the price falls to 60000 USDT\n/alert clear - remove all alerts"
+
+@router.message(Command('alert'))
+async def cmd_alert(message: types.Message, command: CommandObject):
+    user_id = message.from_user.id
+    args = (command.args or '').split()
+    if not args:
+        alerts = alert_index.user_alerts(user_id)
+        lines = [f"- {direction} {price} USDT" for _, direction, price in alerts]
+        text = "Your price alerts:\n" + "\n".join(lines) if lines else "You have no price alerts."
+        await message.answer(f"{text}\n\n{ALERT_USAGE}")
+        return
+    if args == ['clear']:
+        removed = await alert_watcher.clear(user_id)
+        await message.answer(f"Removed {removed} price alerts.")
+        return
+    try:
+        direction, price = args[0].lower(), float(args[1])
+        if len(args) != 2 or direction not in ('above', 'below') or not 0 < price < float('inf'):
+            raise ValueError
+    except (ValueError, IndexError):
+        await message.answer(ALERT_USAGE)
+        return
+    if alert_index.count(user_id) >= MAX_PRICE_ALERTS:
+        await message.answer(f"You can have at most {MAX_PRICE_ALERTS} price alerts. Remove them with /alert clear.")
+        return
+    current_price = price_feed.price
+    if current_price is not None and (current_price >= price if direction == 'above' else current_price <= price):
+        await message.answer(f"The price is already {direction} {price} USDT (current price: {current_price} USDT).")
+        return
+    await alert_watcher.create(user_id, direction, price)
+    await message.answer(f"Alert set: you will be notified when BTC/USDT is {direction} {price} USDT.")
+
+@router.message(Command('backtest'))
+async def cmd_backtest(message: types.Message, command: CommandObject, user: UserSnapshot):
+    # /backtest [days] - replay historical candles against the user's parameters
+    try:
+        days = int(command.args) if command.args else 30
+        if days <= 0:
+            raise ValueError
+    except ValueError:
+        await message.answer("Usage: /backtest [days]")
+        return
+    async with get_session() as session:
+        user_params = await session.get(UserParameters, user.id)
+    params = BacktestParams.from_model(user_params) if user_params else BacktestParams()
+    if not (params.autobuy_on_growth or params.autobuy_on_fall):
+        params = BacktestParams.from_model(params, autobuy_on_growth=True, autobuy_on_fall=True)
+    loop = asyncio.get_running_loop()
+    try:
+        candles = await loop.run_in_executor(None, load_candles, BACKTEST_CANDLES_FILE)
+    except OSError:
+        await message.answer("Historical data is not available.")
+        return
+    if not len(candles):
+        await message.answer("Historical data is not available.")
+        return
+    result = await loop.run_in_executor(None, run_backtest, candles.last(days * 86400), params)
+    closed = len(result.trades) - result.open_positions
+    text = (
+        f"Backtest for the last {days} days:\n"
+        f"Trades: {len(result.trades)} (closed: {closed}, open: {result.open_positions})\n"
+        f"Realized profit: {result.realized_pnl:.2f} USDT\n"
+        f"PnL: {result.pnl:.2f} USDT ({result.pnl_percentage:.2f}%)\n"
+        f"Max drawdown: {result.max_drawdown * 100:.2f}%"
+    )
+    await message.answer(text)
+
 class HelpStates(StatesGroup):
     viewing_help = State()
 
-help_pages = {
-    'en': [
-        "Help Page 1: Overview\n\nThis bot allows you to trade BTC/USDT automatically, create orders, view balance, statistics, and more.",
-        "Help Page 2: Commands\n\n/autobuy - Start or stop autotrading\n/buy - Purchase cryptocurrency\n/orders - View open orders\n/params - Set autotrading parameters\n/stop - Stop autotrading\n/stats - View statistics\n/balance - View balance\n/price - View current price\n/subscription - Manage your subscription\n/help - View help pages",
-        "Help Page 3: FAQ\n\nQ: How do I start trading?\nA: First, purchase a subscription via /subscription, then set your parameters via /params, and start autotrading with /autobuy."
-    ],
-    'ru': [
-        "Страница помощи 1: Обзор\n\nЭтот бот позволяет автоматически торговать парой BTC/USDT, создавать ордера, просматривать баланс, статистику и многое другое.",
-        "Страница помощи 2: Команды\n\n/autobuy - Запустить или остановить автоторговлю\n/buy - Купить криптовалюту\n/orders - Просмотреть открытые ордера\n/params - Настроить параметры автоторговли\n/stop - Остановить автоторговлю\n/stats - Просмотреть статистику\n/balance - Просмотреть баланс\n/price - Просмотреть текущую цену\n/subscription - Управлять подпиской\n/help - Просмотреть страницы помощи",
-        "Страница помощи 3: Часто задаваемые вопросы\n\nВ: Как начать торговлю?\nО: Сначала приобретите подписку через /subscription, затем настройте параметры через /params и запустите автоторговлю с помощью /autobuy."
-    ]
-}
-
 @router.message(Command('help'))
-async def cmd_help(message: types.Message, state: FSMContext):
-    async with get_session() as session:
-        result = await session.execute(
-            select(User).where(User.id == message.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        if not user:
-            await message.answer("User not found. Please use /start to register.")
-            return
-        language = user.language or 'en'
-        page = 0
-        await state.update_data(help_page=page)
-        await message.answer(help_pages[language][page], reply_markup=help_keyboard(page, language))
-        await state.set_state(HelpStates.viewing_help)
-
-def help_keyboard(page, language):
-    buttons = []
-    if page > 0:
-        buttons.append(types.InlineKeyboardButton(text="Previous", callback_data=f"help_prev_{page}"))
-    if page < len(help_pages[language]) - 1:
-        buttons.append(types.InlineKeyboardButton(text="Next", callback_data=f"help_next_{page}"))
-    return types.InlineKeyboardMarkup(inline_keyboard=[buttons])
+async def cmd_help(message: types.Message, state: FSMContext, user: UserSnapshot):
+    language = user.language or 'en'
+    page = 0
+    await state.update_data(help_page=page)
+    text, keyboard = render.help_page(language, page)
+    await message.answer(text, reply_markup=keyboard)
+    await state.set_state(HelpStates.viewing_help)
 
 @router.callback_query(HelpStates.viewing_help, lambda c: c.data.startswith('help_'))
-async def process_help_pagination(callback_query: types.CallbackQuery, state: FSMContext):
+async def process_help_pagination(callback_query: types.CallbackQuery, state: FSMContext, user: Optional[UserSnapshot] = None):
     _, direction, current_page = callback_query.data.split('_')
     current_page = int(current_page)
     if direction == 'next':
@@ -578,14 +624,10 @@ async def process_help_pagination(callback_query: types.CallbackQuery, state: FS
         new_page = current_page - 1
     else:
         new_page = current_page
-    async with get_session() as session:
-        result = await session.execute(
-            select(User).where(User.id == callback_query.from_user.id)
-        )
-        user = result.scalar_one_or_none()
-        language = user.language or 'en'
-        await state.update_data(help_page=new_page)
-        await callback_query.message.edit_text(help_pages[language][new_page], reply_markup=help_keyboard(new_page, language))
+    language = user.language if user and user.language else 'en'
+    await state.update_data(help_page=new_page)
+    text, keyboard = render.help_page(language, new_page)
+    await callback_query.message.edit_text(text, reply_markup=keyboard)
     await callback_query.answer()
 
 def register_command_handlers(dp):
@@ -7,11 +7,16 @@ from app.models import User
 from app.utils.locale import load_locale
 from app.utils.db import get_session
 from app.utils.commands import set_user_commands
+from app.utils.render import render
+from app.utils.user_cache import user_cache
+from app.exchange.user_stream import user_stream
+from app.config import EXCHANGE_TRADING
 
 router = Router()
 
 class Registration(StatesGroup):
     waiting_for_api_key = State()
+    waiting_for_api_secret = State()
 
 @router.callback_query(lambda c: c.data.startswith('lang_'))
 async def language_callback(callback_query: types.CallbackQuery, state: FSMContext):
@@ -21,6 +26,7 @@ async def language_callback(callback_query: types.CallbackQuery, state: FSMConte
         if user:
             user.language = language_code
             await session.commit()
+            user_cache.invalidate(user.id)
             locale = load_locale(language_code)
             await callback_query.message.answer(locale["enter_api_key"], reply_markup=ReplyKeyboardRemove())
             await state.set_state(Registration.waiting_for_api_key)
@@ -38,21 +44,29 @@ async def api_key_received(message: types.Message, state: FSMContext):
         # Placeholder for API key validation
         user.api_key = api_key  # Should be encrypted
         await session.commit()
+    # Requests to the exchange are signed with the key's secret
+    await message.answer(locale["enter_api_secret"])
+    await state.set_state(Registration.waiting_for_api_secret)
+
+@router.message(Registration.waiting_for_api_secret)
+async def api_secret_received(message: types.Message, state: FSMContext):
+    api_secret = message.text.strip()
+    async with get_session() as session:
+        user = await session.get(User, message.from_user.id)
+        locale = load_locale(user.language)
+        if len(api_secret) < 3 or len(api_secret) > 128:
+            await message.answer(locale["api_secret_invalid"])
+            return
+        user.api_secret = api_secret  # Should be encrypted
+        await session.commit()
         await message.answer(locale["api_key_saved"])
-        await message.answer(locale["subscription_prompt"], reply_markup=subscription_keyboard(user.language))
+        await message.answer(locale["subscription_prompt"], reply_markup=render.subscription_keyboard(user.language))
         await state.clear()
         # Set default commands for user
         await set_user_commands(message.bot, user.id, user.language, user.subscription)
-
-def subscription_keyboard(language_code):
-    locale = load_locale(language_code)
-    buttons = [
-        [types.InlineKeyboardButton(text=locale["subscription_option_service"], callback_data="subscribe_service")],
-        [types.InlineKeyboardButton(text=locale["subscription_option_stars"], callback_data="subscribe_stars")],
-        [types.InlineKeyboardButton(text=locale["subscription_option_direct"], callback_data="subscribe_direct")],
-        [types.InlineKeyboardButton(text=locale["subscription_option_test"], callback_data="subscribe_test")],
-    ]
-    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+        api_key = user.api_key
+    if EXCHANGE_TRADING:
+        await user_stream.add(message.from_user.id, api_key, api_secret)
 
 def register_registration_handlers(dp):
     dp.include_router(router)
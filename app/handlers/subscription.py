@@ -5,35 +5,32 @@ from datetime import datetime, timedelta
 
 from aiogram.utils.formatting import Text
 
-from app.models import User
+from app.models import User, UserParameters
 from app.utils.locale import load_locale
 from app.utils.db import get_session
 from app.utils.commands import set_user_commands
+from app.utils.render import render
+from app.services.subscriptions import subscription_checker
+from app.services.autotrade import autotrade_engine
+from app.services import outbox
+from app.utils.user_cache import user_cache, UserSnapshot
 
 router = Router()
 
 @router.message(Command('subscription'))
-async def cmd_subscription(message: types.Message):
-    async with get_session() as session:
-        user = await session.get(User, message.from_user.id)
-        locale = load_locale(user.language)
-        if user.subscription and user.subscription_expires > datetime.utcnow():
-            remaining_days = (user.subscription_expires - datetime.utcnow()).days
-            await message.answer(locale["subscription_active"].format(days=remaining_days), reply_markup=subscription_keyboard(user.language, renew=True))
-        else:
-            await message.answer(locale["subscription_inactive"], reply_markup=subscription_keyboard(user.language))
+async def cmd_subscription(message: types.Message, user: UserSnapshot):
+    locale = load_locale(user.language)
+    if user.has_subscription and user.subscription_expires:
+        remaining_days = (user.subscription_expires - datetime.utcnow()).days
+        await message.answer(locale["subscription_active"].format(days=remaining_days), reply_markup=render.subscription_keyboard(user.language, renew=True))
+    else:
+        await message.answer(locale["subscription_inactive"], reply_markup=render.subscription_keyboard(user.language))
 
-def subscription_keyboard(language_code, renew=False):
-    locale = load_locale(language_code)
-    buttons = [
-        [types.InlineKeyboardButton(text=locale["subscription_option_service"], callback_data="subscribe_service")],
-        [types.InlineKeyboardButton(text=locale["subscription_option_stars"], callback_data="subscribe_stars")],
-        [types.InlineKeyboardButton(text=locale["subscription_option_direct"], callback_data="subscribe_direct")],
-        [types.InlineKeyboardButton(text=locale["subscription_option_test"], callback_data="subscribe_test")],  # Новая опция
-    ]
-    if renew:
-        buttons.append([types.InlineKeyboardButton(text=locale["subscription_option_extend"], callback_data="extend_subscription")])
-    return types.InlineKeyboardMarkup(inline_keyboard=buttons)
+async def resume_autotrade(session, user_id):
+    # An expired subscription removed the user from the engine: put enabled autobuy back, as /autobuy start does
+    params = await session.get(UserParameters, user_id)
+    if params:
+        autotrade_engine.upsert(params)
 
 @router.callback_query(lambda c: c.data.startswith('subscribe_'))
 async def subscription_callback(callback_query: types.CallbackQuery):
@@ -51,17 +48,26 @@ async def subscription_callback(callback_query: types.CallbackQuery):
             # Предоставляем тестовую подписку
             user.subscription = True
             user.subscription_expires = datetime.utcnow() + timedelta(days=7)  # Тестовая подписка на 7 дней
-            await session.commit()
             remaining_days = (user.subscription_expires - datetime.utcnow()).days
-            await callback_query.message.answer(f"You have received a test subscription! Days remaining: {remaining_days}")
+            # Confirmation is committed together with the subscription change
+            await outbox.enqueue(session, user.id, f"You have received a test subscription! Days remaining: {remaining_days}",
+                                 dedupe_key=f"subscription_granted:{user.id}:{user.subscription_expires:%Y%m%d%H%M%S}")
+            await session.commit()
+            user_cache.invalidate(user.id)
+            subscription_checker.notify_changed()
+            await resume_autotrade(session, user.id)
             # Обновляем команды пользователя
             await set_user_commands(callback_query.bot, user.id, user.language, user.subscription)
         elif action == 'extend':
             user.subscription_expires += timedelta(days=30)
-            await session.commit()
-            remaining_days = (user.subscription_expires - datetime.utcnow()).days
-            await callback_query.message.answer(locale["subscription_active"].format(days=remaining_days))
             user.subscription = True
+            remaining_days = (user.subscription_expires - datetime.utcnow()).days
+            await outbox.enqueue(session, user.id, locale["subscription_active"].format(days=remaining_days),
+                                 dedupe_key=f"subscription_granted:{user.id}:{user.subscription_expires:%Y%m%d%H%M%S}")
+            await session.commit()
+            user_cache.invalidate(user.id)
+            subscription_checker.notify_changed()
+            await resume_autotrade(session, user.id)
             await set_user_commands(callback_query.bot, user.id, user.language, user.subscription)
     await callback_query.answer()
 
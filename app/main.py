@@ -1,24 +1,37 @@
 import asyncio
+import logging
 import os
 import ssl
-from datetime import datetime, timedelta
 
 from aiogram import Bot, Dispatcher
 from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.strategy import FSMStrategy
 from aiohttp import web
 from dotenv import load_dotenv
-from sqlalchemy import select
 
-from app.models import User
-from app.utils.db import get_session
-from app.utils.locale import load_locale
+from app.services.price_feed import price_feed, SupervisorSource
+from app.services.delivery import delivery
+from app.services.outbox import outbox_dispatcher
+from app.services.autotrade import autotrade_engine
+from app.services.order_book import order_matcher
+from app.services.alerts import alert_watcher
+from app.services.subscriptions import subscription_checker
+from app.services.leader import leader_elector
+from app.services.ingestion import QueuedRequestHandler
+from app.exchange.client import exchange_client
+from app.exchange.user_stream import user_stream
+from app.utils.locale import catalog
+from app.utils.commands import set_default_commands, command_scopes
+from app.utils.render import render
+from app.utils.fsm_storage import PostgresStorage
+from app.utils import sharding, metrics
+from app.middlewares.metrics_middleware import setup_metrics
+from app.database import engine
+from app.migrations.runner import pending_migrations
 from handlers import register_handlers
 from middlewares import setup_middlewares
-from config import DOMAIN_NAME
-from utils.commands import set_default_commands, set_user_commands
-from database import create_db_and_tables
+from config import (DOMAIN_NAME, LOCALE_AUTO_RELOAD, FSM_STATE_TTL, WEB_WORKERS,
+                    WEBHOOK_INGESTION, INGESTION_WORKERS, INGESTION_MAX_PENDING, EXCHANGE_TRADING)
 
 try:
     import uvloop
@@ -28,6 +41,8 @@ except ImportError:
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 API_TOKEN = os.getenv('BOT_TOKEN')
 BOT_WEBHOOK_BASE_URL = os.getenv('BOT_WEBHOOK_BASE_URL')
 BOT_WEBHOOK_PATH = os.getenv('BOT_WEBHOOK_PATH')
@@ -36,7 +51,7 @@ WEBAPP_HOST = '0.0.0.0'
 WEBAPP_PORT = 8443
 
 bot = Bot(token=API_TOKEN)
-storage = MemoryStorage()
+storage = PostgresStorage(ttl=FSM_STATE_TTL)
 dp = Dispatcher(storage=storage, fsm_strategy=FSMStrategy.CHAT)
 
 # Регистрация обработчиков
@@ -44,50 +59,104 @@ register_handlers(dp)
 
 # Настройка middlewares
 setup_middlewares(dp)
+setup_metrics(dp, bot, engine)
+metrics.fsm_states.set_function(storage.state_counts)
 
-async def subscription_checker():
-    while True:
-        async with get_session() as session:
-            now = datetime.utcnow()
-            users = await session.execute(select(User).where(User.subscription == True))
-            users = users.scalars().all()
-            for user in users:
-                if user.subscription_expires:
-                    days_remaining = (user.subscription_expires - now).days
-                    locale = load_locale(user.language)
-                    if days_remaining == 5:
-                        await bot.send_message(user.id, locale["subscription_expiring"].format(days=5))
-                    elif days_remaining <= 0:
-                        user.subscription = False
-                        await session.commit()
-                        await bot.send_message(user.id, locale["subscription_expired"])
-                        # Reset commands
-                        await set_user_commands(bot, user.id, user.language, user.subscription)
-        await asyncio.sleep(86400)  # Проверяем раз в сутки
+async def on_webhook_lease(lease):
+    # Все реплики обслуживают один и тот же URL: вебхук только ставится, но никогда не снимается,
+    # иначе остановка одной реплики оставила бы без обновлений остальные
+    await bot.set_webhook(f"{BOT_WEBHOOK_BASE_URL}{BOT_WEBHOOK_PATH}")
+    # Схему применяет отдельный шаг деплоя: python -m app.migrations upgrade
+    pending = await pending_migrations()
+    if pending:
+        logger.warning("Database schema is behind: %d pending migrations", len(pending))
+    await set_default_commands(bot)
 
+# Одиночные задачи выполняет ведущая реплика своей аренды, среди всех процессов и хостов
+leader_elector.lease('webhook', on_acquired=on_webhook_lease)
+leader_elector.lease('subscriptions',
+                     on_acquired=lambda lease: subscription_checker.start(bot, lease),
+                     on_lost=lambda lease: subscription_checker.stop())
 
 async def on_startup(app):
-    await bot.delete_webhook()
-    await bot.set_webhook(f"{BOT_WEBHOOK_BASE_URL}{BOT_WEBHOOK_PATH}")
-    await create_db_and_tables()
-    await set_default_commands(bot)
-    asyncio.create_task(subscription_checker())
+    leader_elector.start()
+    # Статические клавиатуры и тексты собираются до первого обновления
+    render.build()
+    metrics.loop_monitor.start()
+    storage.start()
+    delivery.start(bot)
+    outbox_dispatcher.start()
+    command_scopes.start(bot)
+    await exchange_client.start()
+    await autotrade_engine.start()
+    if not EXCHANGE_TRADING:
+        # На бирже лимитные ордера исполняет сама биржа
+        await order_matcher.start()
+    await alert_watcher.start()
+    price_feed.start()
+    if EXCHANGE_TRADING:
+        await user_stream.start()
+    if LOCALE_AUTO_RELOAD:
+        asyncio.create_task(catalog.watch())
 
 async def on_shutdown(app):
-    await bot.delete_webhook()
+    # Принятые из вебхука обновления дорабатываются первыми: им ещё нужны хранилище FSM,
+    # биржа и очередь отправки. Хуки остановки aiohttp вызываются в порядке регистрации,
+    # а обработчик вебхука регистрируется позже
+    if isinstance(request_handler, QueuedRequestHandler):
+        await request_handler.queue.close()
+    metrics.loop_monitor.stop()
+    await leader_elector.stop()
+    autotrade_engine.stop()
+    order_matcher.stop()
+    alert_watcher.stop()
+    await price_feed.stop()
+    await user_stream.stop()
+    await outbox_dispatcher.stop()
+    await command_scopes.stop()
+    await delivery.close()
+    await exchange_client.close()
+    await storage.close()
+
+async def handle_health(request):
+    return web.json_response({'status': 'ok', 'worker': sharding.worker_index, 'leaders': leader_elector.status()})
+
+async def handle_metrics(request):
+    return web.Response(text=metrics.registry.expose(), content_type='text/plain')
 
 app = web.Application()
 app.on_startup.append(on_startup)
 app.on_shutdown.append(on_shutdown)
-
-SimpleRequestHandler(dispatcher=dp, bot=bot).register(app, path=BOT_WEBHOOK_PATH)
+app.router.add_get('/health', handle_health)
+app.router.add_get('/metrics', handle_metrics)
+
+if WEBHOOK_INGESTION == 'queue':
+    request_handler = QueuedRequestHandler(dispatcher=dp, bot=bot, workers=INGESTION_WORKERS,
+                                           max_pending=INGESTION_MAX_PENDING)
+else:
+    request_handler = SimpleRequestHandler(dispatcher=dp, bot=bot)
+request_handler.register(app, path=BOT_WEBHOOK_PATH)
 setup_application(app, dp, bot=bot)
 
 ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
 ssl_context.load_cert_chain(f'/etc/letsencrypt/live/{DOMAIN_NAME}/fullchain.pem',
                             f'/etc/letsencrypt/live/{DOMAIN_NAME}/privkey.pem')
 
+def run_worker(index, count, path):
+    # Рабочий запускается через spawn и не наследует политику цикла событий супервизора
+    if uvloop:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    from app.supervisor import ticks_socket_path
+    sharding.configure(index, count)
+    # Цену читает супервизор и рассылает рабочим: к бирже подключён один процесс
+    price_feed.source = SupervisorSource(ticks_socket_path())
+    web.run_app(app, path=path, print=None)
+
 if __name__ == '__main__':
     if uvloop:
         asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
-    web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, ssl_context=ssl_context)
+    if WEB_WORKERS > 1:
+        from app.supervisor import Supervisor
+        Supervisor(WEB_WORKERS, run_worker, BOT_WEBHOOK_PATH).run(WEBAPP_HOST, WEBAPP_PORT, ssl_context=ssl_context)
+    else:
+        web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT, ssl_context=ssl_context)
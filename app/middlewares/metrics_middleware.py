@@ -0,0 +1,103 @@
+import time
+from contextvars import ContextVar
+
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from sqlalchemy import event
+
+from app.utils import metrics
+
+# [число запросов, время в базе] текущего обновления; вне обработки обновления - None
+_update_db = ContextVar('update_db', default=None)
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на dp.update: полное время обработки обновления
+    и число/время запросов к базе за это обновление.
+    """
+    async def __call__(self, handler, event, data):
+        stats = [0, 0.0]
+        token = _update_db.set(stats)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            metrics.update_duration.labels(event.event_type).observe(time.perf_counter() - started)
+            metrics.update_db_queries.observe(stats[0])
+            metrics.update_db_duration.observe(stats[1])
+            _update_db.reset(token)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """
+    Внутренний middleware: время выполнения конкретного обработчика.
+    Метки - модуль роутера и имя функции, их число ограничено кодом.
+    """
+    def __init__(self):
+        self._labels = {}
+
+    def _metric_labels(self, callback):
+        labels = self._labels.get(callback)
+        if labels is None:
+            labels = self._labels[callback] = (
+                callback.__module__.rsplit('.', 1)[-1],
+                getattr(callback, '__name__', type(callback).__name__),
+            )
+        return labels
+
+    async def __call__(self, handler, event, data):
+        labels = self._metric_labels(data['handler'].callback)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            metrics.handler_errors.labels(*labels).inc()
+            raise
+        finally:
+            metrics.handler_duration.labels(*labels).observe(time.perf_counter() - started)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            metrics.bot_api_errors.labels(name, type(e).__name__).inc()
+            raise
+        finally:
+            metrics.bot_api_duration.labels(name).observe(time.perf_counter() - started)
+
+
+def instrument_engine(engine):
+    """
+    Время каждого запроса к базе через события движка SQLAlchemy;
+    запросы внутри обработки обновления дополнительно учитываются в его счётчиках.
+    """
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, 'before_cursor_execute')
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, 'after_cursor_execute')
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        duration = time.perf_counter() - context._metrics_started
+        metrics.db_query_duration.observe(duration)
+        stats = _update_db.get()
+        if stats is not None:
+            stats[0] += 1
+            stats[1] += duration
+
+
+def setup_metrics(dp, bot, engine):
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    handler_middleware = HandlerMetricsMiddleware()
+    # Внутренние middleware наследуются вложенными роутерами
+    for name, observer in dp.observers.items():
+        if name not in ('update', 'error'):
+            observer.middleware(handler_middleware)
+    bot.session.middleware(BotApiMetricsMiddleware())
+    instrument_engine(engine)
@@ -1,24 +1,36 @@
 from aiogram import BaseMiddleware
-from aiogram.types import Message
-from datetime import datetime
+from aiogram.types import Message, Update
 from app.utils.db import get_session
+from app.utils.user_cache import user_cache, UserSnapshot
 from app.models import User
-from aiogram.methods import SendMessage
+
+async def load_snapshot(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        async with get_session() as session:
+            db_user = await session.get(User, user_id)
+        if db_user:
+            user = UserSnapshot.from_model(db_user)
+            user_cache.put(user)
+    return user
 
 class SubscriptionMiddleware(BaseMiddleware):
     async def __call__(self, handler, event, data):
-        if isinstance(event, Message):
-            if event.text.startswith('/'):
-                command = event.text.split()[0][1:]
-                allowed_commands = ['start', 'help', 'subscription']
-                async with get_session() as session:
-                    user = await session.get(User, event.from_user.id)
-                    if not user:
-                        await event.answer("Please select your language first.")
-                        return
-                    data['user'] = user
-                    if not user.subscription or (user.subscription_expires and user.subscription_expires <= datetime.utcnow()):
-                        if command not in allowed_commands:
-                            await event.answer("This section is available only with a subscription. Please purchase a subscription via /subscription.")
-                            return
+        # Middleware is registered on dp.update, so the message or callback is nested in the Update
+        target = (event.message or event.callback_query) if isinstance(event, Update) else event
+        from_user = getattr(target, 'from_user', None)
+        user = await load_snapshot(from_user.id) if from_user else None
+        if user:
+            # Handlers take the snapshot as `user` instead of loading the row again
+            data['user'] = user
+        if isinstance(target, Message) and target.text and target.text.startswith('/'):
+            command = target.text.split()[0][1:].split('@')[0]
+            allowed_commands = ['start', 'help', 'subscription']
+            if not user:
+                if command != 'start':
+                    await target.answer("Please select your language first.")
+                    return
+            elif not user.has_subscription and command not in allowed_commands:
+                await target.answer("This section is available only with a subscription. Please purchase a subscription via /subscription.")
+                return
         return await handler(event, data)
@@ -0,0 +1,38 @@
+import argparse
+import asyncio
+import logging
+import sys
+
+from app.database import engine
+from app.migrations.runner import upgrade, pending_migrations
+from app.migrations.check import check_plans
+
+
+async def main(command):
+    try:
+        if command == 'upgrade':
+            applied = await upgrade()
+            print(f"Applied migrations: {', '.join(f'{version:04d}' for version in applied)}" if applied else "Schema is up to date")
+            return 0
+        status = 0
+        pending = await pending_migrations()
+        if pending:
+            print(f"Pending migrations: {', '.join(f'{m.version:04d}_{m.name}' for m in pending)}")
+            status = 1
+        failures = await check_plans()
+        for name, tables in failures.items():
+            print(f"Sequential scan in '{name}': {', '.join(tables)}")
+            status = 1
+        if not status:
+            print("Schema is up to date, all hot queries use indexes")
+        return status
+    finally:
+        await engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='python -m app.migrations', description="Миграции схемы базы данных")
+    parser.add_argument('command', choices=('upgrade', 'check'))
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    sys.exit(asyncio.run(main(args.command)))
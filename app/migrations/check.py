@@ -0,0 +1,88 @@
+import json
+import logging
+
+from sqlalchemy import text
+
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Горячие запросы обработчиков и фоновых задач с типичными параметрами.
+# Каждый должен выполняться по индексу: проверка падает, если в плане есть Seq Scan.
+HOT_QUERIES = {
+    'orders page': (
+        "SELECT id, order_type, status, amount, price, date_created FROM orders "
+        "WHERE user_id = :user_id AND status = 'Open' AND id < :cursor ORDER BY id DESC LIMIT 11",
+        {'user_id': 1, 'cursor': 1000},
+    ),
+    'open orders by price': (
+        "SELECT id, order_type, price FROM orders WHERE status = 'Open' AND order_type = 'sell' AND price <= :price",
+        {'price': 60000.0},
+    ),
+    'last purchase': (
+        "SELECT max(date_created) FROM orders WHERE user_id = :user_id AND order_type = 'buy'",
+        {'user_id': 1},
+    ),
+    'expired subscriptions': (
+        "SELECT id FROM users WHERE subscription = true AND subscription_expires <= now()",
+        {},
+    ),
+    'subscription orders': (
+        "SELECT id FROM subscription_orders WHERE user_id = :user_id",
+        {'user_id': 1},
+    ),
+    'stats period': (
+        "SELECT sum(trade_count), sum(volume), sum(realized_pnl) FROM user_daily_stats "
+        "WHERE user_id = :user_id AND day >= current_date - 29",
+        {'user_id': 1},
+    ),
+    'position lots': (
+        "SELECT id, amount, price FROM position_lots WHERE user_id = :user_id ORDER BY id",
+        {'user_id': 1},
+    ),
+    'orders by exchange id': (
+        "SELECT id FROM orders WHERE exchange_order_id IN (:first, :second) AND status = 'Open'",
+        {'first': 1, 'second': 2},
+    ),
+    'stale pending orders': (
+        "SELECT id, user_id, order_type FROM orders WHERE status = 'Pending' AND date_created < now() - interval '1 minute'",
+        {},
+    ),
+    'price alerts of user': (
+        "SELECT id FROM price_alerts WHERE user_id = :user_id",
+        {'user_id': 1},
+    ),
+    'pending outbox': (
+        "SELECT id FROM outbox_messages WHERE status = 'pending' ORDER BY priority, id LIMIT 500",
+        {},
+    ),
+    'expired fsm states': (
+        "SELECT key FROM fsm_states WHERE updated_at < now() - interval '1 day'",
+        {},
+    ),
+}
+
+
+def _seq_scans(plan):
+    if plan.get('Node Type') == 'Seq Scan':
+        yield plan.get('Relation Name')
+    for child in plan.get('Plans', ()):
+        yield from _seq_scans(child)
+
+
+async def check_plans():
+    """
+    EXPLAIN для горячих запросов с enable_seqscan=off: если план всё равно
+    содержит Seq Scan, подходящего индекса нет. Возвращает {запрос: [таблицы]}.
+    """
+    failures = {}
+    async with engine.connect() as conn:
+        await conn.execute(text("SET enable_seqscan = off"))
+        for name, (sql, params) in HOT_QUERIES.items():
+            result = await conn.scalar(text(f"EXPLAIN (FORMAT JSON) {sql}"), params)
+            plan = result if isinstance(result, list) else json.loads(result)
+            tables = list(_seq_scans(plan[0]['Plan']))
+            if tables:
+                failures[name] = tables
+        await conn.rollback()
+    return failures
@@ -0,0 +1,120 @@
+import importlib
+import logging
+import pkgutil
+import os
+
+from sqlalchemy import text
+
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+VERSIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'versions')
+# Ключ advisory-блокировки: миграции не запускаются параллельно из нескольких контейнеров
+LOCK_ID = 0x53435442
+
+
+class Migration:
+    __slots__ = ('version', 'name', 'module')
+
+    def __init__(self, version, name, module):
+        self.version = version
+        self.name = name
+        self.module = module
+
+    @property
+    def transactional(self):
+        # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+        return getattr(self.module, 'transactional', True)
+
+    async def upgrade(self, conn):
+        await self.module.upgrade(conn)
+
+
+def discover():
+    """
+    Миграции из каталога versions: файлы вида v0001_name.py с функцией async upgrade(conn).
+    """
+    migrations = []
+    for info in pkgutil.iter_modules([VERSIONS_DIR]):
+        if not info.name.startswith('v'):
+            continue
+        version, _, name = info.name[1:].partition('_')
+        module = importlib.import_module(f'app.migrations.versions.{info.name}')
+        migrations.append(Migration(int(version), name, module))
+    migrations.sort(key=lambda migration: migration.version)
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise RuntimeError(f"Duplicate migration versions: {versions}")
+    return migrations
+
+
+async def _ensure_table(conn):
+    await conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS schema_migrations ("
+        "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP NOT NULL DEFAULT now())"
+    ))
+
+
+async def applied_versions(conn):
+    result = await conn.execute(text(
+        "SELECT version FROM schema_migrations"
+    ))
+    return {row[0] for row in result}
+
+
+async def pending_migrations():
+    async with engine.connect() as conn:
+        exists = await conn.scalar(text("SELECT to_regclass('schema_migrations') IS NOT NULL"))
+        applied = await applied_versions(conn) if exists else set()
+    return [migration for migration in discover() if migration.version not in applied]
+
+
+async def upgrade():
+    """
+    Применяет недостающие миграции по порядку, каждую в своей транзакции.
+    Возвращает список применённых версий.
+    """
+    migrations = discover()
+    done = []
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT pg_advisory_lock(:id)"), {'id': LOCK_ID})
+        try:
+            await _ensure_table(conn)
+            await conn.commit()
+            applied = await applied_versions(conn)
+            await conn.commit()
+            for migration in migrations:
+                if migration.version in applied:
+                    continue
+                logger.info("Applying migration %04d_%s", migration.version, migration.name)
+                if migration.transactional:
+                    await migration.upgrade(conn)
+                else:
+                    async with engine.connect() as autocommit:
+                        await autocommit.execution_options(isolation_level='AUTOCOMMIT')
+                        await migration.upgrade(autocommit)
+                await conn.execute(
+                    text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                    {'version': migration.version, 'name': migration.name},
+                )
+                await conn.commit()
+                done.append(migration.version)
+        finally:
+            await conn.rollback()
+            await conn.execute(text("SELECT pg_advisory_unlock(:id)"), {'id': LOCK_ID})
+            await conn.commit()
+    return done
+
+
+async def create_index_concurrently(conn, name, ddl):
+    """
+    Создаёт индекс без блокировки записи в таблицу.
+    Недостроенный (invalid) индекс после прерванной попытки удаляется и строится заново.
+    """
+    invalid = await conn.scalar(text(
+        "SELECT NOT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = :name"
+    ), {'name': name})
+    if invalid:
+        await conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {name}"))
+    await conn.execute(text(ddl))
@@ -0,0 +1,98 @@
+"""
+Базовая схема: таблицы в том виде, в каком их создавал create_all до появления миграций.
+Определения зафиксированы здесь, а не взяты из app.models, чтобы последующие
+изменения моделей не меняли уже применённую миграцию.
+На существующей базе ничего не делает - таблицы уже есть (checkfirst).
+"""
+from sqlalchemy import (MetaData, Table, Column, BigInteger, String, Boolean, DateTime, Date,
+                        ForeignKey, Float, Integer, JSON, Index)
+
+metadata = MetaData()
+
+Table(
+    'users', metadata,
+    Column('id', BigInteger, primary_key=True, index=True),
+    Column('name', String),
+    Column('language', String),
+    Column('subscription', Boolean),
+    Column('subscription_expires', DateTime),
+    Column('api_key', String),
+)
+
+Table(
+    'user_parameters', metadata,
+    Column('user_id', BigInteger, ForeignKey('users.id'), primary_key=True),
+    Column('purchase_amount', Float),
+    Column('profit_percentage', Float),
+    Column('purchase_delay', Integer),
+    Column('growth_percentage', Float),
+    Column('fall_percentage', Float),
+    Column('autobuy_on_growth', Boolean),
+    Column('autobuy_on_fall', Boolean),
+)
+
+Table(
+    'orders', metadata,
+    Column('id', BigInteger, primary_key=True, index=True, autoincrement=True),
+    Column('user_id', BigInteger, ForeignKey('users.id')),
+    Column('order_type', String),
+    Column('amount', Float),
+    Column('price', Float),
+    Column('status', String),
+    Column('date_created', DateTime),
+)
+
+Table(
+    'admins', metadata,
+    Column('id', BigInteger, primary_key=True, index=True),
+    Column('username', String),
+    Column('password_hash', String),
+)
+
+Table(
+    'subscription_orders', metadata,
+    Column('id', BigInteger, primary_key=True, index=True),
+    Column('user_id', BigInteger, ForeignKey('users.id')),
+    Column('order_id', String),
+    Column('closed', Boolean),
+    Column('description', String),
+)
+
+Table(
+    'balances', metadata,
+    Column('user_id', BigInteger, ForeignKey('users.id'), primary_key=True),
+    Column('btc_available', Float),
+    Column('btc_frozen', Float),
+    Column('usdt_available', Float),
+    Column('usdt_frozen', Float),
+)
+
+Table(
+    'fsm_states', metadata,
+    Column('key', String, primary_key=True),
+    Column('state', String),
+    Column('data', JSON),
+    Column('updated_at', DateTime, index=True),
+)
+
+Table(
+    'user_daily_stats', metadata,
+    Column('user_id', BigInteger, ForeignKey('users.id'), primary_key=True),
+    Column('day', Date, primary_key=True),
+    Column('trade_count', Integer),
+    Column('volume', Float),
+    Column('realized_pnl', Float),
+)
+
+Table(
+    'position_lots', metadata,
+    Column('id', BigInteger, primary_key=True, autoincrement=True),
+    Column('user_id', BigInteger, ForeignKey('users.id')),
+    Column('amount', Float),
+    Column('price', Float),
+    Index('ix_position_lots_user_id_id', 'user_id', 'id'),
+)
+
+
+async def upgrade(conn):
+    await conn.run_sync(metadata.create_all, checkfirst=True)
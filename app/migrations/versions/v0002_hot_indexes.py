@@ -0,0 +1,32 @@
+"""
+Индексы под горячие запросы: постраничный /orders, загрузка книги ордеров,
+последняя покупка пользователя, проверка подписок и заказы подписок.
+Строятся CONCURRENTLY, чтобы не блокировать запись в работающей базе.
+"""
+from sqlalchemy import text
+
+from app.migrations.runner import create_index_concurrently
+
+transactional = False
+
+INDEXES = {
+    'ix_orders_user_status_id':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_user_status_id ON orders (user_id, status, id)",
+    'ix_orders_user_date_created':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_user_date_created ON orders (user_id, date_created)",
+    'ix_orders_open_type_price':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_open_type_price ON orders (order_type, price) "
+        "WHERE status = 'Open'",
+    'ix_users_subscribed_expires':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_users_subscribed_expires ON users (subscription_expires) "
+        "WHERE subscription = true",
+    'ix_subscription_orders_user_id':
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_subscription_orders_user_id ON subscription_orders (user_id)",
+}
+
+
+async def upgrade(conn):
+    for name, ddl in INDEXES.items():
+        await create_index_concurrently(conn, name, ddl)
+    # Полный индекс по сроку подписки заменён частичным по подписанным пользователям
+    await conn.execute(text("DROP INDEX CONCURRENTLY IF EXISTS ix_users_subscription_expires"))
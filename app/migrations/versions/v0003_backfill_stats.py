@@ -0,0 +1,70 @@
+"""
+Заполняет дневную статистику и FIFO-лоты по истории исполненных ордеров,
+накопленной до появления user_daily_stats.
+Как и остальные миграции, не импортирует код приложения: запросы и сопоставление лотов
+зафиксированы здесь, поэтому изменения app.services.stats не меняют уже применённую миграцию.
+"""
+from collections import defaultdict, deque
+
+from sqlalchemy import text
+
+# Остаток лота меньше этого объёма считается закрытым
+DUST = 1e-12
+BATCH_SIZE = 1000
+
+INSERT_LOT = text("INSERT INTO position_lots (user_id, amount, price) VALUES (:user_id, :amount, :price)")
+UPDATE_PNL = text("UPDATE user_daily_stats SET realized_pnl = :pnl WHERE user_id = :user_id AND day = :day")
+
+
+async def upgrade(conn):
+    await conn.execute(text("DELETE FROM user_daily_stats"))
+    await conn.execute(text("DELETE FROM position_lots"))
+    # Сделки и объём по дням считает база; прибыль ниже заполняет FIFO
+    await conn.execute(text(
+        "INSERT INTO user_daily_stats (user_id, day, trade_count, volume, realized_pnl) "
+        "SELECT user_id, CAST(date_created AS DATE), count(*), sum(amount * price), 0 "
+        "FROM orders WHERE status = 'Completed' "
+        "GROUP BY user_id, CAST(date_created AS DATE)"
+    ))
+    result = await conn.stream(text(
+        "SELECT user_id, order_type, amount, price, date_created FROM orders "
+        "WHERE status = 'Completed' ORDER BY user_id, date_created, id"
+    ))
+    lots, pnl = [], []
+    current, user_lots, user_pnl = None, deque(), defaultdict(float)
+
+    def close_user():
+        lots.extend({'user_id': current, 'amount': amount, 'price': price} for amount, price in user_lots)
+        pnl.extend({'user_id': current, 'day': day, 'pnl': value} for day, value in user_pnl.items() if value)
+
+    async for user_id, order_type, amount, price, date_created in result:
+        if user_id != current:
+            if current is not None:
+                close_user()
+                if len(lots) + len(pnl) >= BATCH_SIZE:
+                    await _write(conn, lots, pnl)
+                    lots, pnl = [], []
+            current, user_lots, user_pnl = user_id, deque(), defaultdict(float)
+        if order_type == 'buy':
+            user_lots.append([amount, price])
+            continue
+        # Продажа закрывает самые старые лоты; сверх купленного прибыль не считается
+        remaining = amount
+        while remaining > DUST and user_lots:
+            lot = user_lots[0]
+            take = min(lot[0], remaining)
+            user_pnl[date_created.date()] += take * (price - lot[1])
+            lot[0] -= take
+            remaining -= take
+            if lot[0] <= DUST:
+                user_lots.popleft()
+    if current is not None:
+        close_user()
+    await _write(conn, lots, pnl)
+
+
+async def _write(conn, lots, pnl):
+    if lots:
+        await conn.execute(INSERT_LOT, lots)
+    if pnl:
+        await conn.execute(UPDATE_PNL, pnl)
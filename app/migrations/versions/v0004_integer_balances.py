@@ -0,0 +1,42 @@
+"""
+Балансы в целых минимальных единицах (сатоши, микро-USDT) вместо Float
+и журнал ledger_entries. Текущие остатки переносятся с округлением вниз
+и записываются в журнал как начальные ('opening'), чтобы журнал сходился с балансами.
+"""
+from sqlalchemy import text
+
+STATEMENTS = (
+    "ALTER TABLE balances "
+    "ADD COLUMN btc_available_sat BIGINT NOT NULL DEFAULT 0, "
+    "ADD COLUMN btc_frozen_sat BIGINT NOT NULL DEFAULT 0, "
+    "ADD COLUMN usdt_available_micro BIGINT NOT NULL DEFAULT 10000000000, "
+    "ADD COLUMN usdt_frozen_micro BIGINT NOT NULL DEFAULT 0",
+    # Накопленная погрешность Float могла дать отрицательные остатки порядка 1e-12
+    "UPDATE balances SET "
+    "btc_available_sat = greatest(0, floor(coalesce(btc_available, 0)::numeric * 100000000)), "
+    "btc_frozen_sat = greatest(0, floor(coalesce(btc_frozen, 0)::numeric * 100000000)), "
+    "usdt_available_micro = greatest(0, floor(coalesce(usdt_available, 0)::numeric * 1000000)), "
+    "usdt_frozen_micro = greatest(0, floor(coalesce(usdt_frozen, 0)::numeric * 1000000))",
+    "ALTER TABLE balances "
+    "DROP COLUMN btc_available, DROP COLUMN btc_frozen, DROP COLUMN usdt_available, DROP COLUMN usdt_frozen, "
+    "ADD CONSTRAINT ck_balances_non_negative CHECK "
+    "(btc_available_sat >= 0 AND btc_frozen_sat >= 0 AND usdt_available_micro >= 0 AND usdt_frozen_micro >= 0)",
+    "CREATE TABLE ledger_entries ("
+    "id BIGSERIAL PRIMARY KEY, "
+    "user_id BIGINT NOT NULL REFERENCES users (id), "
+    "reason VARCHAR NOT NULL, "
+    "order_id BIGINT, "
+    "btc_available_sat BIGINT NOT NULL DEFAULT 0, "
+    "btc_frozen_sat BIGINT NOT NULL DEFAULT 0, "
+    "usdt_available_micro BIGINT NOT NULL DEFAULT 0, "
+    "usdt_frozen_micro BIGINT NOT NULL DEFAULT 0, "
+    "created_at TIMESTAMP NOT NULL DEFAULT (now() at time zone 'utc'))",
+    "CREATE INDEX ix_ledger_entries_user_id_id ON ledger_entries (user_id, id)",
+    "INSERT INTO ledger_entries (user_id, reason, btc_available_sat, btc_frozen_sat, usdt_available_micro, usdt_frozen_micro) "
+    "SELECT user_id, 'opening', btc_available_sat, btc_frozen_sat, usdt_available_micro, usdt_frozen_micro FROM balances",
+)
+
+
+async def upgrade(conn):
+    for statement in STATEMENTS:
+        await conn.execute(text(statement))
@@ -0,0 +1,19 @@
+"""
+Связь ордеров с биржей: orders.exchange_order_id и уникальный частичный индекс
+для сопоставления событий потока данных аккаунта с ордерами.
+"""
+from sqlalchemy import text
+
+from app.migrations.runner import create_index_concurrently
+
+transactional = False
+
+
+async def upgrade(conn):
+    # Столбец без значения по умолчанию добавляется без перезаписи таблицы
+    await conn.execute(text("ALTER TABLE orders ADD COLUMN IF NOT EXISTS exchange_order_id BIGINT"))
+    await create_index_concurrently(
+        conn, 'ix_orders_exchange_order_id',
+        "CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_exchange_order_id ON orders (exchange_order_id) "
+        "WHERE exchange_order_id IS NOT NULL",
+    )
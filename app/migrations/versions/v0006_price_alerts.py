@@ -0,0 +1,19 @@
+"""
+Таблица уведомлений о цене (/alert above|below).
+"""
+from sqlalchemy import text
+
+STATEMENTS = (
+    "CREATE TABLE price_alerts ("
+    "id BIGSERIAL PRIMARY KEY, "
+    "user_id BIGINT NOT NULL REFERENCES users (id), "
+    "direction VARCHAR NOT NULL CHECK (direction IN ('above', 'below')), "
+    "price DOUBLE PRECISION NOT NULL, "
+    "created_at TIMESTAMP DEFAULT (now() at time zone 'utc'))",
+    "CREATE INDEX ix_price_alerts_user_id ON price_alerts (user_id)",
+)
+
+
+async def upgrade(conn):
+    for statement in STATEMENTS:
+        await conn.execute(text(statement))
@@ -0,0 +1,27 @@
+"""
+Исходящие сообщения (outbox): пишутся в транзакции изменения и рассылаются
+фоновым диспетчером, который забирает строки через FOR UPDATE SKIP LOCKED.
+"""
+from sqlalchemy import text
+
+STATEMENTS = (
+    "CREATE TABLE outbox_messages ("
+    "id BIGSERIAL PRIMARY KEY, "
+    "chat_id BIGINT NOT NULL, "
+    "text VARCHAR NOT NULL, "
+    "reply_markup JSON, "
+    "priority INTEGER NOT NULL DEFAULT 1, "
+    "dedupe_key VARCHAR UNIQUE, "
+    "status VARCHAR NOT NULL DEFAULT 'pending', "
+    "attempts INTEGER NOT NULL DEFAULT 0, "
+    "lease_until TIMESTAMP, "
+    "created_at TIMESTAMP DEFAULT (now() at time zone 'utc'), "
+    "sent_at TIMESTAMP)",
+    "CREATE INDEX ix_outbox_messages_pending ON outbox_messages (priority, id) WHERE status = 'pending'",
+    "CREATE INDEX ix_outbox_messages_created_at ON outbox_messages (created_at)",
+)
+
+
+async def upgrade(conn):
+    for statement in STATEMENTS:
+        await conn.execute(text(statement))
@@ -0,0 +1,17 @@
+"""
+Аренды одиночных фоновых задач с токенами ограждения (выбор ведущей реплики).
+"""
+from sqlalchemy import text
+
+STATEMENTS = (
+    "CREATE TABLE leases ("
+    "name VARCHAR PRIMARY KEY, "
+    "holder VARCHAR NOT NULL, "
+    "token BIGINT NOT NULL, "
+    "expires_at TIMESTAMP NOT NULL)",
+)
+
+
+async def upgrade(conn):
+    for statement in STATEMENTS:
+        await conn.execute(text(statement))
@@ -0,0 +1,18 @@
+"""
+Последний установленный набор команд каждого чата: повторные set_my_commands пропускаются.
+"""
+from sqlalchemy import text
+
+STATEMENTS = (
+    "CREATE TABLE chat_command_scopes ("
+    "chat_id BIGINT PRIMARY KEY, "
+    "language VARCHAR NOT NULL, "
+    "subscribed BOOLEAN NOT NULL, "
+    "digest VARCHAR NOT NULL, "
+    "updated_at TIMESTAMP DEFAULT (now() at time zone 'utc'))",
+)
+
+
+async def upgrade(conn):
+    for statement in STATEMENTS:
+        await conn.execute(text(statement))
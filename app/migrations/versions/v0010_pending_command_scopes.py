@@ -0,0 +1,16 @@
+"""
+Ожидающие установки наборы команд: переживают перезапуск до того, как фоновый обработчик их применит.
+"""
+from sqlalchemy import text
+
+STATEMENTS = (
+    "ALTER TABLE chat_command_scopes ADD COLUMN pending_language VARCHAR",
+    "ALTER TABLE chat_command_scopes ADD COLUMN pending_subscribed BOOLEAN",
+    "CREATE INDEX ix_chat_command_scopes_pending ON chat_command_scopes (chat_id) "
+    "WHERE pending_language IS NOT NULL",
+)
+
+
+async def upgrade(conn):
+    for statement in STATEMENTS:
+        await conn.execute(text(statement))
@@ -0,0 +1,13 @@
+"""
+Секрет API-ключа пользователя: без него подписанные запросы к бирже невозможны.
+"""
+from sqlalchemy import text
+
+STATEMENTS = (
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS api_secret VARCHAR",
+)
+
+
+async def upgrade(conn):
+    for statement in STATEMENTS:
+        await conn.execute(text(statement))
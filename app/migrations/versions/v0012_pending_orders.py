@@ -0,0 +1,15 @@
+"""
+Частичный индекс по ордерам в статусе Pending: сохранённым до отправки на биржу
+и ещё не подтверждённым. По нему их периодически ищет resolve_pending.
+"""
+from app.migrations.runner import create_index_concurrently
+
+transactional = False
+
+
+async def upgrade(conn):
+    await create_index_concurrently(
+        conn, 'ix_orders_pending_date_created',
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_orders_pending_date_created ON orders (date_created) "
+        "WHERE status = 'Pending'",
+    )
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, BigInteger, String, Boolean, DateTime, ForeignKey, Float, Integer
+from sqlalchemy import Column, BigInteger, String, Boolean, DateTime, Date, ForeignKey, Float, Integer, JSON, Index, CheckConstraint, text
 from sqlalchemy.orm import declarative_base, relationship
 import datetime
 
@@ -6,6 +6,9 @@ Base = declarative_base()
 
 class User(Base):
     __tablename__ = 'users'
+    __table_args__ = (
+        Index('ix_users_subscribed_expires', 'subscription_expires', postgresql_where=text('subscription = true')),
+    )
 
     id = Column(BigInteger, primary_key=True, index=True)
     name = Column(String)
@@ -13,6 +16,7 @@ class User(Base):
     subscription = Column(Boolean, default=False)
     subscription_expires = Column(DateTime, default=None)
     api_key = Column(String)
+    api_secret = Column(String)  # секрет ключа для подписи запросов к бирже
     # Связь с параметрами и ордерами
     parameters = relationship("UserParameters", uselist=False, back_populates="user")
     orders = relationship("Order", back_populates="user")
@@ -34,6 +38,14 @@ class UserParameters(Base):
 
 class Order(Base):
     __tablename__ = 'orders'
+    # Индексы создаются миграциями (app/migrations), здесь - для согласованности с моделью
+    __table_args__ = (
+        Index('ix_orders_user_status_id', 'user_id', 'status', 'id'),
+        Index('ix_orders_user_date_created', 'user_id', 'date_created'),
+        Index('ix_orders_open_type_price', 'order_type', 'price', postgresql_where=text("status = 'Open'")),
+        Index('ix_orders_exchange_order_id', 'exchange_order_id', unique=True, postgresql_where=text("exchange_order_id IS NOT NULL")),
+        Index('ix_orders_pending_date_created', 'date_created', postgresql_where=text("status = 'Pending'")),
+    )
 
     id = Column(BigInteger, primary_key=True, index=True, autoincrement=True)
     user_id = Column(BigInteger, ForeignKey('users.id'))
@@ -42,6 +54,7 @@ class Order(Base):
     price = Column(Float)
     status = Column(String, default='Open')  # 'Open' or 'Completed'
     date_created = Column(DateTime, default=datetime.datetime.utcnow)
+    exchange_order_id = Column(BigInteger, nullable=True)  # id ордера на бирже, если он размещён там
 
     user = relationship("User", back_populates="orders")
 
@@ -56,18 +69,123 @@ class SubscriptionOrder(Base):
     __tablename__ = 'subscription_orders'
 
     id = Column(BigInteger, primary_key=True, index=True)
-    user_id = Column(BigInteger, ForeignKey('users.id'))
+    user_id = Column(BigInteger, ForeignKey('users.id'), index=True)
     order_id = Column(String)
     closed = Column(Boolean, default=False)
     description = Column(String)
 
 class Balance(Base):
+    # Суммы в минимальных единицах: сатоши и микро-USDT. Меняются только через app.services.ledger
     __tablename__ = 'balances'
+    __table_args__ = (
+        CheckConstraint(
+            'btc_available_sat >= 0 AND btc_frozen_sat >= 0 AND usdt_available_micro >= 0 AND usdt_frozen_micro >= 0',
+            name='ck_balances_non_negative'
+        ),
+    )
 
     user_id = Column(BigInteger, ForeignKey('users.id'), primary_key=True)
-    btc_available = Column(Float, default=0.0)
-    btc_frozen = Column(Float, default=0.0)
-    usdt_available = Column(Float, default=10000.0)  # Начальный баланс для тестирования
-    usdt_frozen = Column(Float, default=0.0)
+    btc_available_sat = Column(BigInteger, nullable=False, default=0)
+    btc_frozen_sat = Column(BigInteger, nullable=False, default=0)
+    usdt_available_micro = Column(BigInteger, nullable=False, default=10000 * 10 ** 6)  # Начальный баланс для тестирования
+    usdt_frozen_micro = Column(BigInteger, nullable=False, default=0)
 
     user = relationship("User", back_populates="balance")
+
+class LedgerEntry(Base):
+    # Журнал изменений балансов, только добавление. Сумма записей пользователя равна его балансу
+    __tablename__ = 'ledger_entries'
+    __table_args__ = (Index('ix_ledger_entries_user_id_id', 'user_id', 'id'),)
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False)
+    reason = Column(String, nullable=False)  # 'opening', 'buy', 'autobuy', 'sell_order', 'cancel', 'fill'
+    order_id = Column(BigInteger)
+    btc_available_sat = Column(BigInteger, nullable=False, default=0)
+    btc_frozen_sat = Column(BigInteger, nullable=False, default=0)
+    usdt_available_micro = Column(BigInteger, nullable=False, default=0)
+    usdt_frozen_micro = Column(BigInteger, nullable=False, default=0)
+    created_at = Column(DateTime, nullable=False, server_default=text("(now() at time zone 'utc')"))
+
+class FsmState(Base):
+    __tablename__ = 'fsm_states'
+
+    key = Column(String, primary_key=True)
+    state = Column(String)
+    data = Column(JSON, default=dict)
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, index=True)
+
+class UserDailyStats(Base):
+    __tablename__ = 'user_daily_stats'
+
+    user_id = Column(BigInteger, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    trade_count = Column(Integer, default=0)
+    volume = Column(Float, default=0.0)  # USDT
+    realized_pnl = Column(Float, default=0.0)  # USDT, FIFO
+
+class PositionLot(Base):
+    # Незакрытые остатки покупок для FIFO-расчёта прибыли
+    __tablename__ = 'position_lots'
+    __table_args__ = (Index('ix_position_lots_user_id_id', 'user_id', 'id'),)
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey('users.id'))
+    amount = Column(Float)  # оставшийся объём, BTC
+    price = Column(Float)
+
+class PriceAlert(Base):
+    # Уведомление о цене: срабатывает один раз и удаляется
+    __tablename__ = 'price_alerts'
+    __table_args__ = (Index('ix_price_alerts_user_id', 'user_id'),)
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    user_id = Column(BigInteger, ForeignKey('users.id'), nullable=False)
+    direction = Column(String, nullable=False)  # 'above' or 'below'
+    price = Column(Float, nullable=False)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+
+class OutboxMessage(Base):
+    # Сообщения пользователям, записанные в одной транзакции с изменением, о котором они сообщают
+    __tablename__ = 'outbox_messages'
+    __table_args__ = (
+        Index('ix_outbox_messages_pending', 'priority', 'id', postgresql_where=text("status = 'pending'")),
+        Index('ix_outbox_messages_created_at', 'created_at'),
+    )
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    chat_id = Column(BigInteger, nullable=False)
+    text = Column(String, nullable=False)
+    reply_markup = Column(JSON, nullable=True)
+    priority = Column(Integer, nullable=False, default=1)
+    dedupe_key = Column(String, nullable=True, unique=True)
+    status = Column(String, nullable=False, default='pending')  # 'pending', 'sent' or 'failed'
+    attempts = Column(Integer, nullable=False, default=0)
+    lease_until = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+class Lease(Base):
+    # Аренда одиночной фоновой задачи: держатель, токен ограждения и срок
+    __tablename__ = 'leases'
+
+    name = Column(String, primary_key=True)
+    holder = Column(String, nullable=False)
+    token = Column(BigInteger, nullable=False)  # растёт при каждой смене держателя
+    expires_at = Column(DateTime, nullable=False)
+
+class ChatCommandScope(Base):
+    # Последний установленный в чате набор команд; chat_id 0 - область по умолчанию
+    __tablename__ = 'chat_command_scopes'
+    __table_args__ = (
+        Index('ix_chat_command_scopes_pending', 'chat_id', postgresql_where=text('pending_language IS NOT NULL')),
+    )
+
+    chat_id = Column(BigInteger, primary_key=True)
+    language = Column(String, nullable=False)
+    subscribed = Column(Boolean, nullable=False)
+    digest = Column(String, nullable=False)  # хеш самих команд: меняется при их правке в коде
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Набор, поставленный в очередь фоновому обработчику и ещё не установленный
+    pending_language = Column(String)
+    pending_subscribed = Column(Boolean)
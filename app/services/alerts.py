@@ -0,0 +1,161 @@
+import logging
+from bisect import bisect_left, bisect_right
+
+from sqlalchemy import select, delete
+
+from app.models import PriceAlert
+from app.utils.db import get_session
+from app.utils.sharding import user_filter
+from app.services.price_feed import price_feed
+from app.services import outbox
+
+logger = logging.getLogger(__name__)
+
+DELETE_CHUNK = 5000
+
+
+class AlertIndex:
+    """
+    Уведомления о цене в двух массивах, отсортированных по порогу.
+    'above' срабатывает при цене >= порога, 'below' - при цене <= порога.
+    Сработавшие удаляются из массивов, поэтому на каждом тике сработавшие 'above' -
+    префикс массива до bisect_right(цена), а 'below' - суффикс от bisect_left(цена):
+    O(log n + k) без просмотра остальных уведомлений.
+    """
+    def __init__(self):
+        self._prices = {'above': [], 'below': []}
+        self._ids = {'above': [], 'below': []}
+        self._alerts = {}  # alert_id -> (user_id, direction, price)
+        self._per_user = {}  # user_id -> set(alert_id)
+
+    def __len__(self):
+        return len(self._alerts)
+
+    def count(self, user_id):
+        return len(self._per_user.get(user_id, ()))
+
+    def user_alerts(self, user_id):
+        return sorted((alert_id, *self._alerts[alert_id][1:]) for alert_id in self._per_user.get(user_id, ()))
+
+    def add(self, alert_id, user_id, direction, price):
+        prices, ids = self._prices[direction], self._ids[direction]
+        position = bisect_right(prices, price)
+        prices.insert(position, price)
+        ids.insert(position, alert_id)
+        self._alerts[alert_id] = (user_id, direction, price)
+        self._per_user.setdefault(user_id, set()).add(alert_id)
+
+    def discard(self, alert_id):
+        alert = self._alerts.pop(alert_id, None)
+        if alert is None:
+            return
+        user_id, direction, price = alert
+        prices, ids = self._prices[direction], self._ids[direction]
+        position = ids.index(alert_id, bisect_left(prices, price), bisect_right(prices, price))
+        del prices[position]
+        del ids[position]
+        self._release(user_id, alert_id)
+
+    def _release(self, user_id, alert_id):
+        alerts = self._per_user[user_id]
+        alerts.discard(alert_id)
+        if not alerts:
+            del self._per_user[user_id]
+
+    def triggered(self, price):
+        """
+        Извлекает сработавшие при цене price уведомления: список (alert_id, user_id, direction, price).
+        """
+        end = bisect_right(self._prices['above'], price)
+        start = bisect_left(self._prices['below'], price)
+        alert_ids = self._ids['above'][:end] + self._ids['below'][start:]
+        if not alert_ids:
+            return []
+        del self._prices['above'][:end], self._ids['above'][:end]
+        del self._prices['below'][start:], self._ids['below'][start:]
+        triggered = []
+        for alert_id in alert_ids:
+            user_id, direction, threshold = self._alerts.pop(alert_id)
+            self._release(user_id, alert_id)
+            triggered.append((alert_id, user_id, direction, threshold))
+        return triggered
+
+
+class AlertWatcher:
+    """
+    Проверяет уведомления пользователей этого процесса на каждом тике цены.
+    Сработавшие удаляются из базы пакетом в одной транзакции с записью уведомлений в outbox.
+    """
+    def __init__(self, index):
+        self.index = index
+        self._subscriber = None
+
+    async def start(self):
+        await self.load()
+        self._subscriber = price_feed.subscribe(self.on_tick)
+
+    def stop(self):
+        if self._subscriber:
+            price_feed.unsubscribe(self._subscriber)
+            self._subscriber = None
+
+    async def load(self):
+        async with get_session() as session:
+            result = await session.execute(
+                select(PriceAlert.id, PriceAlert.user_id, PriceAlert.direction, PriceAlert.price)
+                .where(user_filter(PriceAlert.user_id))
+            )
+            for alert_id, user_id, direction, price in result:
+                self.index.add(alert_id, user_id, direction, price)
+        logger.info("Loaded %d price alerts", len(self.index))
+
+    async def create(self, user_id, direction, price):
+        async with get_session() as session:
+            alert = PriceAlert(user_id=user_id, direction=direction, price=price)
+            session.add(alert)
+            await session.commit()
+            self.index.add(alert.id, user_id, direction, price)
+            return alert.id
+
+    async def clear(self, user_id):
+        async with get_session() as session:
+            result = await session.execute(
+                delete(PriceAlert).where(PriceAlert.user_id == user_id).returning(PriceAlert.id)
+            )
+            alert_ids = result.scalars().all()
+            await session.commit()
+        for alert_id in alert_ids:
+            self.index.discard(alert_id)
+        return len(alert_ids)
+
+    async def on_tick(self, tick):
+        triggered = self.index.triggered(tick.price)
+        if not triggered:
+            return
+        try:
+            async with get_session() as session:
+                for start in range(0, len(triggered), DELETE_CHUNK):
+                    chunk = triggered[start:start + DELETE_CHUNK]
+                    result = await session.execute(
+                        delete(PriceAlert).where(PriceAlert.id.in_([alert_id for alert_id, _, _, _ in chunk])).returning(PriceAlert.id)
+                    )
+                    # Удалённое командой /alert clear в другой транзакции не доставляется
+                    deleted = set(result.scalars())
+                    await outbox.enqueue_many(session, [
+                        outbox.Message(
+                            user_id,
+                            f"Price alert: BTC/USDT is {direction} {price} USDT.\nCurrent price: {tick.price} USDT",
+                            dedupe_key=f"alert:{alert_id}",
+                        )
+                        for alert_id, user_id, direction, price in chunk if alert_id in deleted
+                    ])
+                await session.commit()
+        except Exception:
+            # Возвращаем уведомления в индекс, чтобы повторить на следующем тике
+            for alert_id, user_id, direction, price in triggered:
+                self.index.add(alert_id, user_id, direction, price)
+            raise
+
+
+alert_index = AlertIndex()
+alert_watcher = AlertWatcher(alert_index)
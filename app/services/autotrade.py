@@ -0,0 +1,346 @@
+import logging
+import time
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import numpy as np
+from sqlalchemy import select, or_, func
+
+from app.models import User, UserParameters, Order
+from app.utils.db import get_session
+from app.utils.sharding import user_filter
+from app.services.price_feed import price_feed
+from app.services.order_book import order_book
+from app.services.scheduler import Scheduler
+from app.services.delivery import PRIORITY_FILL
+from app.services.stats import Fill, record_fills
+from app.services import ledger, outbox
+from app.exchange import trading as exchange_trading
+from app.config import EXCHANGE_TRADING
+
+logger = logging.getLogger(__name__)
+
+_COLUMNS = {
+    'user_id': np.int64,
+    'purchase_amount': np.float64,
+    'profit_percentage': np.float64,
+    'purchase_delay': np.float64,
+    'growth_percentage': np.float64,
+    'fall_percentage': np.float64,
+    'autobuy_on_growth': np.bool_,
+    'autobuy_on_fall': np.bool_,
+    'ref_price': np.float64,  # цена, от которой считаются рост/падение
+    'last_purchase': np.float64,  # время последней автопокупки
+    'armed': np.bool_,  # False, пока идёт покупка и пока не истёк purchase_delay после неё
+}
+
+
+class AutotradeEngine:
+    """
+    Параметры всех активных пользователей в столбцовом виде (массивы NumPy).
+    На каждом тике срабатывания порогов роста/падения вычисляются
+    одним векторизованным проходом по всем пользователям.
+    Паузы purchase_delay ведёт планировщик: после покупки пользователь
+    снимается с взвода и взводится снова, когда пауза истекает.
+    """
+    def __init__(self, capacity=1024):
+        self.size = 0
+        self._index = {}
+        self._subscriber = None
+        self._columns = {name: np.zeros(capacity, dtype=dtype) for name, dtype in _COLUMNS.items()}
+        self.scheduler = Scheduler(self.rearm)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, user_id):
+        return user_id in self._index
+
+    def column(self, name):
+        return self._columns[name][:self.size]
+
+    def _grow(self):
+        capacity = len(self._columns['user_id']) * 2
+        for name, array in self._columns.items():
+            grown = np.zeros(capacity, dtype=array.dtype)
+            grown[:self.size] = array[:self.size]
+            self._columns[name] = grown
+
+    def upsert(self, params):
+        if not (params.autobuy_on_growth or params.autobuy_on_fall):
+            self.remove(params.user_id)
+            return
+        row = self._index.get(params.user_id)
+        if row is None:
+            if self.size == len(self._columns['user_id']):
+                self._grow()
+            row = self.size
+            self.size += 1
+            self._index[params.user_id] = row
+            self._columns['user_id'][row] = params.user_id
+            self._columns['ref_price'][row] = np.nan
+            self._columns['last_purchase'][row] = 0.0
+            self._columns['armed'][row] = True
+        columns = self._columns
+        if params.user_id in self.scheduler and columns['purchase_delay'][row] != params.purchase_delay:
+            # Пауза изменилась во время ожидания - переносим срок взвода
+            self.scheduler.schedule_at(params.user_id, columns['last_purchase'][row] + params.purchase_delay)
+        columns['purchase_amount'][row] = params.purchase_amount
+        columns['profit_percentage'][row] = params.profit_percentage
+        columns['purchase_delay'][row] = params.purchase_delay
+        columns['growth_percentage'][row] = params.growth_percentage
+        columns['fall_percentage'][row] = params.fall_percentage
+        columns['autobuy_on_growth'][row] = params.autobuy_on_growth
+        columns['autobuy_on_fall'][row] = params.autobuy_on_fall
+
+    def remove(self, user_id):
+        row = self._index.pop(user_id, None)
+        if row is None:
+            return
+        self.scheduler.cancel(user_id)
+        last = self.size - 1
+        if row != last:
+            # Переносим последнюю строку на место удалённой
+            for array in self._columns.values():
+                array[row] = array[last]
+            self._index[int(self._columns['user_id'][row])] = row
+        self.size = last
+
+    def evaluate(self, price):
+        """
+        Возвращает индексы строк пользователей, у которых сработал порог роста или падения.
+        Сработавшие снимаются с взвода до исхода покупки: его отмечают purchased и rearm.
+        """
+        if not self.size:
+            return np.empty(0, dtype=np.intp)
+        ref = self.column('ref_price')
+        np.copyto(ref, price, where=np.isnan(ref))
+        change = (price - ref) / ref * 100
+        fired = (
+            (self.column('autobuy_on_growth') & (change >= self.column('growth_percentage')))
+            | (self.column('autobuy_on_fall') & (-change >= self.column('fall_percentage')))
+        ) & self.column('armed')
+        rows = np.flatnonzero(fired)
+        self.column('armed')[rows] = False
+        return rows
+
+    def purchased(self, user_ids, price, now=None):
+        """
+        Покупка исполнена: цена отсчёта переносится на цену покупки, взвод - через purchase_delay.
+        """
+        now = time.time() if now is None else now
+        for user_id in user_ids:
+            row = self._index.get(user_id)
+            if row is None:
+                continue
+            self._columns['ref_price'][row] = price
+            self._columns['last_purchase'][row] = now
+            self.scheduler.schedule_at(user_id, now + self._columns['purchase_delay'][row])
+
+    def rearm(self, user_ids):
+        rows = [self._index[user_id] for user_id in user_ids if user_id in self._index]
+        self._columns['armed'][rows] = True
+
+    async def load(self):
+        async with get_session() as session:
+            result = await session.execute(
+                select(UserParameters)
+                .join(User)
+                .where(
+                    User.subscription == True,
+                    or_(UserParameters.autobuy_on_growth, UserParameters.autobuy_on_fall),
+                    user_filter(UserParameters.user_id),
+                )
+            )
+            for params in result.scalars():
+                self.upsert(params)
+            # Восстанавливаем незавершённые паузы по времени последней покупки
+            result = await session.execute(
+                select(Order.user_id, func.max(Order.date_created))
+                .join(UserParameters, UserParameters.user_id == Order.user_id)
+                .where(
+                    Order.order_type == 'buy',
+                    or_(UserParameters.autobuy_on_growth, UserParameters.autobuy_on_fall),
+                    user_filter(Order.user_id),
+                )
+                .group_by(Order.user_id)
+            )
+            now = time.time()
+            for user_id, last_purchase in result:
+                row = self._index.get(user_id)
+                if row is None:
+                    continue
+                last_purchase = last_purchase.replace(tzinfo=timezone.utc).timestamp()
+                deadline = last_purchase + self._columns['purchase_delay'][row]
+                if deadline > now:
+                    self._columns['last_purchase'][row] = last_purchase
+                    self._columns['armed'][row] = False
+                    self.scheduler.schedule_at(user_id, deadline)
+        logger.info("Autotrade engine loaded %d users, %d waiting for purchase delay", self.size, len(self.scheduler))
+
+    async def start(self):
+        await self.load()
+        self.scheduler.start()
+        self._subscriber = price_feed.subscribe(self.on_tick)
+
+    def stop(self):
+        self.scheduler.stop()
+        if self._subscriber:
+            price_feed.unsubscribe(self._subscriber)
+            self._subscriber = None
+
+    async def on_tick(self, tick):
+        rows = self.evaluate(tick.price)
+        if not rows.size:
+            return
+        purchases = list(zip(
+            self.column('user_id')[rows].tolist(),
+            self.column('purchase_amount')[rows].tolist(),
+            self.column('profit_percentage')[rows].tolist(),
+        ))
+        executed = []
+        pending = []
+        try:
+            executed, lapsed, pending = await execute_purchases(tick.price, purchases)
+            # Подписка истекла: проверка подписок могла пройти в другом процессе
+            for user_id in lapsed:
+                self.remove(user_id)
+        finally:
+            # Неподтверждённая покупка могла исполниться: повторять её на следующем тике нельзя
+            bought = {user_id for user_id, _, _ in executed} | set(pending)
+            self.purchased(bought, tick.price, tick.timestamp)
+            # Пропущенные покупки (нехватка средств, отказ биржи) не сдвигают цену отсчёта
+            self.rearm([user_id for user_id, _, _ in purchases if user_id not in bought])
+
+
+async def execute_purchases(price, purchases):
+    """
+    Исполняет покупки сработавших пользователей: ордер на покупку, лимитный ордер на продажу
+    с учётом profit_percentage и уведомления в outbox.
+    Возвращает исполненные покупки, пользователей без активной подписки и пользователей,
+    чья покупка на бирже ещё не подтверждена (ордер остался Pending).
+    """
+    now = datetime.utcnow()
+    async with get_session() as session:
+        result = await session.execute(
+            select(User.id).where(User.id.in_([user_id for user_id, _, _ in purchases]), User.subscription == True)
+        )
+        subscribed = set(result.scalars())
+    lapsed = [user_id for user_id, _, _ in purchases if user_id not in subscribed]
+    orders = {}  # user_id -> (микро-USDT, profit_percentage)
+    for user_id, amount, profit_percentage in purchases:
+        if user_id not in subscribed:
+            continue
+        spent = ledger.to_micro(amount)
+        cached = ledger.balance_cache.get(user_id)
+        # Заведомо недостаточный баланс отсекается по проекции, окончательно решает
+        # условный UPDATE, а в режиме биржи - сама биржа
+        if cached is not None and cached.usdt_available_micro < spent:
+            continue
+        orders[user_id] = (spent, profit_percentage)
+    if not orders:
+        return [], lapsed, []
+    if EXCHANGE_TRADING:
+        executed, pending = await _exchange_purchases(orders, now)
+        return executed, lapsed, pending
+    return await _simulated_purchases(price, orders, now), lapsed, []
+
+
+def _sell_price(buy_price, profit_percentage):
+    return round(buy_price * (1 + profit_percentage / 100), 2)
+
+
+async def _record_purchases(session, purchases, now):
+    """
+    Статистика и уведомления об исполненных покупках в транзакции session.
+    purchases - список (id покупки, user_id, BTC, цена покупки, ордер на продажу).
+    Pending-продажа только отправляется на биржу: о её размещении сообщает open_sells.
+    """
+    await record_fills(session, [Fill(user_id, 'buy', amount, buy_price, now.date()) for _, user_id, amount, buy_price, _ in purchases])
+    await outbox.enqueue_many(session, [
+        outbox.Message(
+            user_id,
+            f"Autobuy executed.\nBought: {amount} BTC\nPrice: {buy_price} USDT/BTC\nSell order {'placed' if sell_order.status == 'Open' else 'sent to the exchange'} at {sell_order.price} USDT",
+            PRIORITY_FILL,
+            f"autobuy:{buy_id}",
+        )
+        for buy_id, user_id, amount, buy_price, sell_order in purchases
+    ])
+    return [(user_id, amount, sell_order.price) for _, user_id, amount, _, sell_order in purchases]
+
+
+async def _simulated_purchases(price, orders, now):
+    """
+    Покупки по текущей цене одной транзакцией с одним пакетным условным списанием балансов через журнал.
+    """
+    price_decimal = Decimal(str(price))
+    async with get_session() as session:
+        placed = {}  # user_id -> (покупка, продажа, сатоши, микро-USDT)
+        for user_id, (spent, profit_percentage) in orders.items():
+            bought_sat = ledger.to_sat(ledger.from_micro(spent) / price_decimal)
+            if bought_sat <= 0:
+                continue
+            bought_btc = float(ledger.from_sat(bought_sat))
+            buy_order = Order(user_id=user_id, order_type='buy', amount=bought_btc, price=price, status='Completed', date_created=now)
+            sell_order = Order(user_id=user_id, order_type='sell', amount=bought_btc, price=_sell_price(price, profit_percentage),
+                               status='Open', date_created=now)
+            session.add_all([buy_order, sell_order])
+            placed[user_id] = (buy_order, sell_order, bought_sat, spent)
+        if not placed:
+            return []
+        await session.flush()
+        applied = await ledger.apply_many(session, [
+            ledger.Change(user_id, 'autobuy', buy_order.id, btc_frozen_sat=bought_sat, usdt_available_micro=-spent)
+            for user_id, (buy_order, _, bought_sat, spent) in placed.items()
+        ])
+        for user_id, (buy_order, sell_order, _, _) in placed.items():
+            if user_id not in applied:
+                # Баланс успел измениться - ордера без списания не сохраняются
+                await session.delete(buy_order)
+                await session.delete(sell_order)
+        sell_orders = [placed[user_id][1] for user_id in applied]
+        executed = await _record_purchases(session, [
+            (buy_order.id, user_id, buy_order.amount, buy_order.price, sell_order)
+            for user_id, (buy_order, sell_order, _, _) in placed.items() if user_id in applied
+        ], now)
+        await session.commit()
+    for sell_order in sell_orders:
+        order_book.add(sell_order.id, sell_order.order_type, sell_order.price)
+    return executed
+
+
+async def _exchange_purchases(orders, now):
+    """
+    Покупки на бирже. Ордера сохраняются со статусом Pending до отправки: после потерянного
+    ответа или перезапуска их находит на бирже resolve_pending. Исполненные покупки,
+    ордера на продажу и уведомления пишутся одной транзакцией; балансы приносит поток данных аккаунта.
+    Возвращает исполненные покупки и пользователей с неподтверждёнными ордерами.
+    """
+    async with get_session() as session:
+        pending = {user_id: Order(user_id=user_id, order_type='buy', status='Pending', date_created=now) for user_id in orders}
+        session.add_all(pending.values())
+        await session.commit()
+    # Покупки уходят на биржу параллельно, вне транзакции
+    outcome = await exchange_trading.market_buys({order.id: (user_id, orders[user_id][0]) for user_id, order in pending.items()})
+    async with get_session() as session:
+        settled = await exchange_trading.settle_buys(session, outcome)
+        purchases = []
+        for buy_id, user_id, amount, buy_price in settled:
+            # Продажа открывается, когда её примет биржа (place_sell_orders)
+            sell_order = Order(user_id=user_id, order_type='sell', amount=amount, price=_sell_price(buy_price, orders[user_id][1]),
+                               status='Pending', date_created=now)
+            session.add(sell_order)
+            purchases.append((buy_id, user_id, amount, buy_price, sell_order))
+        await session.flush()
+        executed = await _record_purchases(session, purchases, now)
+        await session.commit()
+    sell_orders = [sell_order for *_, sell_order in purchases]
+    if sell_orders:
+        # Продажи исполняет биржа, исполнение приносит поток данных аккаунта
+        await exchange_trading.place_sell_orders(sell_orders)
+    unresolved = [user_id for user_id, order in pending.items()
+                  if order.id not in outcome.filled and order.id not in outcome.rejected]
+    return executed, unresolved
+
+
+autotrade_engine = AutotradeEngine()
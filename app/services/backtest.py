@@ -0,0 +1,212 @@
+import heapq
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, fields, replace
+from functools import lru_cache
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+
+class Candles(NamedTuple):
+    timestamp: np.ndarray  # секунды
+    open: np.ndarray
+    high: np.ndarray
+    low: np.ndarray
+    close: np.ndarray
+    volume: np.ndarray
+
+    def __len__(self):
+        return len(self.timestamp)
+
+    def last(self, seconds):
+        start = np.searchsorted(self.timestamp, self.timestamp[-1] - seconds)
+        return Candles(*(column[start:] for column in self))
+
+
+@dataclass(frozen=True)
+class BacktestParams:
+    purchase_amount: float = 1000.0
+    profit_percentage: float = 5.0
+    purchase_delay: int = 10
+    growth_percentage: float = 2.0
+    fall_percentage: float = 3.0
+    autobuy_on_growth: bool = True
+    autobuy_on_fall: bool = True
+
+    @classmethod
+    def from_model(cls, params, **overrides):
+        values = {f.name: getattr(params, f.name) for f in fields(cls)}
+        values.update(overrides)
+        return cls(**values)
+
+
+class Trade(NamedTuple):
+    buy_time: float
+    buy_price: float
+    amount: float  # BTC
+    sell_time: Optional[float]
+    sell_price: float
+    profit: float  # USDT, 0 для незакрытой позиции
+
+
+@dataclass
+class BacktestResult:
+    params: BacktestParams
+    initial_usdt: float
+    final_equity: float
+    realized_pnl: float
+    max_drawdown: float  # доля от пика, 0..1
+    trades: list = field(default_factory=list)
+
+    @property
+    def pnl(self):
+        return self.final_equity - self.initial_usdt
+
+    @property
+    def pnl_percentage(self):
+        return self.pnl / self.initial_usdt * 100
+
+    @property
+    def open_positions(self):
+        return sum(1 for trade in self.trades if trade.sell_time is None)
+
+
+@lru_cache(maxsize=4)
+def load_candles(path):
+    """
+    Загружает свечи из CSV: timestamp,open,high,low,close,volume.
+    Строка заголовка допускается; timestamp в секундах или миллисекундах.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        first = f.readline().split(',')[0].strip()
+    try:
+        float(first)
+        skiprows = 0
+    except ValueError:
+        skiprows = 1
+    data = np.loadtxt(path, delimiter=',', skiprows=skiprows, usecols=range(6), ndmin=2)
+    timestamp = data[:, 0]
+    if timestamp.size and timestamp[-1] > 1e11:
+        timestamp = timestamp / 1000
+    return Candles(timestamp, data[:, 1], data[:, 2], data[:, 3], data[:, 4], data[:, 5])
+
+
+def _first_true(predicate, start, stop):
+    """
+    Индекс первого элемента в [start, stop), где predicate(срез) истинен, или -1.
+    Ищет окнами растущего размера, чтобы близкие события не требовали прохода до конца.
+    """
+    window = 256
+    while start < stop:
+        end = min(start + window, stop)
+        mask = predicate(start, end)
+        if mask.any():
+            return start + int(np.argmax(mask))
+        start = end
+        window *= 4
+    return -1
+
+
+def run_backtest(candles, params, initial_usdt=10000.0):
+    """
+    Прогоняет правила автоторговли по свечам: покупка на purchase_amount при росте/падении
+    цены закрытия от опорной на заданный процент (не чаще purchase_delay),
+    затем лимитная продажа с profit_percentage, исполняемая по максимуму свечи.
+    Покупка без свободных средств пропускается, опорная цена остаётся прежней.
+    """
+    timestamp, high, close = candles.timestamp, candles.high, candles.close
+    n = len(candles)
+    trades = []
+    if n == 0:
+        return BacktestResult(params, initial_usdt, initial_usdt, 0.0, 0.0, trades)
+
+    cash_delta = np.zeros(n)
+    btc_delta = np.zeros(n)
+    pending = []  # (индекс исполнения продажи, выручка)
+    cash = initial_usdt
+    ref = close[0]
+    next_allowed = timestamp[0]
+    i = 0
+
+    def trigger(start, end):
+        change = (close[start:end] - ref) / ref * 100
+        fired = np.zeros(end - start, dtype=bool)
+        if params.autobuy_on_growth:
+            fired |= change >= params.growth_percentage
+        if params.autobuy_on_fall:
+            fired |= -change >= params.fall_percentage
+        return fired & (timestamp[start:end] >= next_allowed)
+
+    while True:
+        j = _first_true(trigger, i + 1, n)
+        if j < 0:
+            break
+        price = close[j]
+        while pending and pending[0][0] <= j:
+            cash += heapq.heappop(pending)[1]
+        i = j
+        if cash < params.purchase_amount:
+            # Как в движке: пропущенная покупка не сдвигает цену отсчёта и не начинает паузу.
+            # Денег не прибавится до исполнения ближайшей продажи
+            if not pending:
+                break
+            i = max(j, pending[0][0] - 1)
+            continue
+        ref = price
+        next_allowed = timestamp[j] + params.purchase_delay
+        amount = params.purchase_amount / price
+        target = round(price * (1 + params.profit_percentage / 100), 2)
+        cash -= params.purchase_amount
+        cash_delta[j] -= params.purchase_amount
+        btc_delta[j] += amount
+        k = _first_true(lambda start, end: high[start:end] >= target, j + 1, n)
+        if k < 0:
+            trades.append(Trade(timestamp[j], price, amount, None, target, 0.0))
+            continue
+        proceeds = amount * target
+        heapq.heappush(pending, (k, proceeds))
+        cash_delta[k] += proceeds
+        btc_delta[k] -= amount
+        trades.append(Trade(timestamp[j], price, amount, timestamp[k], target, proceeds - params.purchase_amount))
+
+    equity = initial_usdt + np.cumsum(cash_delta) + np.cumsum(btc_delta) * close
+    peak = np.maximum.accumulate(np.maximum(equity, initial_usdt))
+    max_drawdown = float(np.max((peak - equity) / peak))
+    realized_pnl = float(sum(trade.profit for trade in trades))
+    return BacktestResult(params, initial_usdt, float(equity[-1]), realized_pnl, max_drawdown, trades)
+
+
+_worker_candles = None
+
+
+def _init_worker(candles):
+    global _worker_candles
+    _worker_candles = candles
+
+
+def _run_point(args):
+    params, initial_usdt = args
+    result = run_backtest(_worker_candles, params, initial_usdt)
+    return params, result.pnl, result.max_drawdown, len(result.trades)
+
+
+def sweep(candles, grid, base_params=None, initial_usdt=10000.0, processes=None):
+    """
+    Перебор сетки параметров в пуле процессов.
+    grid - словарь {имя параметра: список значений}.
+    Возвращает список (params, pnl, max_drawdown, trades), отсортированный по pnl.
+    """
+    base_params = base_params or BacktestParams()
+    names = list(grid)
+    points = [
+        (replace(base_params, **dict(zip(names, values))), initial_usdt)
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+    processes = processes or os.cpu_count() or 1
+    chunksize = max(1, len(points) // (processes * 4))
+    with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(candles,)) as pool:
+        results = list(pool.map(_run_point, points, chunksize=chunksize))
+    results.sort(key=lambda result: result[1], reverse=True)
+    return results
@@ -0,0 +1,207 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramAPIError
+
+from app.utils.rate_limit import TokenBucket
+from app.utils import sharding
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_FILL = 0
+PRIORITY_DEFAULT = 1
+PRIORITY_REMINDER = 2
+
+MAX_MESSAGE_LENGTH = 4096
+MAX_ATTEMPTS = 3
+READY_AT_EXPIRE_MIN = 1024
+
+
+class _Message:
+    __slots__ = ('chat_id', 'text', 'priority', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, chat_id, text, priority, kwargs, future):
+        self.chat_id = chat_id
+        self.text = text
+        self.priority = priority
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class DeliveryQueue:
+    """
+    Очередь исходящих сообщений бота для фоновых задач.
+    Общее ведро токенов (~30 сообщений/с), не чаще одного сообщения в чат за per_chat_interval,
+    приоритеты (исполнения ордеров раньше напоминаний), учёт retry_after
+    и склейка нескольких ожидающих текстов в один чат в одно сообщение.
+    enqueue возвращает Future: True - доставлено, False - доставить не удалось.
+    """
+    def __init__(self, rate=30, per_chat_interval=1.0, workers=8):
+        self.rate = rate
+        self.per_chat_interval = per_chat_interval
+        self.workers = workers
+        self._bucket = TokenBucket(rate)
+        self._pending = {}  # chat_id -> list[_Message]
+        self._ready = []  # (priority, seq, chat_id)
+        self._delayed = []  # (ready_at, priority, seq, chat_id)
+        self._chat_ready_at = {}  # chat_id -> monotonic time
+        self._expire_at = READY_AT_EXPIRE_MIN  # размер _chat_ready_at, при котором удаляются прошедшие сроки
+        self._in_flight = set()
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self._bot = None
+
+    def __len__(self):
+        return sum(len(messages) for messages in self._pending.values())
+
+    def enqueue(self, chat_id, text, priority=PRIORITY_DEFAULT, **kwargs):
+        future = asyncio.get_running_loop().create_future()
+        message = _Message(chat_id, text, priority, kwargs, future)
+        self._pending.setdefault(chat_id, []).append(message)
+        if chat_id not in self._in_flight:
+            self._push(chat_id, priority)
+        return future
+
+    def _push(self, chat_id, priority):
+        ready_at = self._chat_ready_at.get(chat_id, 0.0)
+        if ready_at > time.monotonic():
+            heapq.heappush(self._delayed, (ready_at, priority, next(self._seq), chat_id))
+        else:
+            heapq.heappush(self._ready, (priority, next(self._seq), chat_id))
+        self._wakeup.set()
+
+    def _pop_ready(self):
+        now = time.monotonic()
+        while self._delayed and self._delayed[0][0] <= now:
+            _, priority, seq, chat_id = heapq.heappop(self._delayed)
+            heapq.heappush(self._ready, (priority, seq, chat_id))
+        while self._ready:
+            priority, seq, chat_id = heapq.heappop(self._ready)
+            # Записи кучи - подсказки: чат мог уже обслуживаться, опустеть или ещё не остыть
+            if chat_id not in self._pending or chat_id in self._in_flight:
+                continue
+            ready_at = self._chat_ready_at.get(chat_id, 0.0)
+            if ready_at > now:
+                heapq.heappush(self._delayed, (ready_at, priority, seq, chat_id))
+                continue
+            self._in_flight.add(chat_id)
+            return chat_id
+        return None
+
+    async def _next_chat(self):
+        while True:
+            chat_id = self._pop_ready()
+            if chat_id is not None:
+                return chat_id
+            self._wakeup.clear()
+            timeout = self._delayed[0][0] - time.monotonic() if self._delayed else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def _take_batch(self, chat_id):
+        messages = self._pending[chat_id]
+        batch = [messages[0]]
+        if not messages[0].kwargs:
+            length = len(messages[0].text)
+            for message in messages[1:]:
+                length += len(message.text) + 2
+                if message.kwargs or length > MAX_MESSAGE_LENGTH:
+                    break
+                batch.append(message)
+        del messages[:len(batch)]
+        return batch
+
+    async def _worker(self):
+        while True:
+            # Токен берём до выбора чата, чтобы к моменту отправки выбирался самый приоритетный
+            await self._bucket.acquire()
+            chat_id = await self._next_chat()
+            batch = self._take_batch(chat_id)
+            try:
+                pause = self._bucket.paused_until - time.monotonic()
+                if pause > 0:
+                    await asyncio.sleep(pause)
+                await self._send(chat_id, batch)
+            finally:
+                self._in_flight.discard(chat_id)
+                # Срок остаётся и после опустения очереди чата: следующее сообщение тоже его ждёт
+                now = time.monotonic()
+                self._chat_ready_at[chat_id] = now + self.per_chat_interval
+                messages = self._pending.get(chat_id)
+                if messages:
+                    self._push(chat_id, min(message.priority for message in messages))
+                else:
+                    self._pending.pop(chat_id, None)
+                self._expire_ready_at(now)
+
+    def _expire_ready_at(self, now):
+        # Прошедшие сроки ничего не ограничивают - удаляем их пакетно, когда словарь вырос вдвое
+        if len(self._chat_ready_at) < self._expire_at:
+            return
+        self._chat_ready_at = {chat_id: ready_at for chat_id, ready_at in self._chat_ready_at.items() if ready_at > now}
+        self._expire_at = max(READY_AT_EXPIRE_MIN, 2 * len(self._chat_ready_at))
+
+    def _requeue(self, chat_id, batch):
+        self._pending.setdefault(chat_id, [])[:0] = batch
+
+    async def _send(self, chat_id, batch):
+        text = "\n\n".join(message.text for message in batch)
+        try:
+            await self._bot.send_message(chat_id, text, **batch[0].kwargs)
+        except TelegramRetryAfter as e:
+            logger.warning("Flood limit hit, pausing delivery for %s s", e.retry_after)
+            self._bucket.pause(e.retry_after)
+            self._requeue(chat_id, batch)
+            return
+        except TelegramNetworkError as e:
+            retry = [message for message in batch if message.attempts + 1 < MAX_ATTEMPTS]
+            for message in batch:
+                message.attempts += 1
+                if message not in retry:
+                    self._resolve(message, False)
+            logger.warning("Network error delivering to %s: %s", chat_id, e)
+            self._requeue(chat_id, retry)
+            return
+        except TelegramAPIError as e:
+            logger.warning("Failed to deliver to %s: %s", chat_id, e)
+            for message in batch:
+                self._resolve(message, False)
+            return
+        except Exception:
+            logger.exception("Failed to deliver to %s", chat_id)
+            for message in batch:
+                self._resolve(message, False)
+            return
+        for message in batch:
+            self._resolve(message, True)
+
+    @staticmethod
+    def _resolve(message, delivered):
+        if not message.future.done():
+            message.future.set_result(delivered)
+
+    def start(self, bot):
+        self._bot = bot
+        # Общий лимит Telegram делится между рабочими процессами
+        self._bucket = TokenBucket(self.rate / sharding.worker_count)
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout=5.0):
+        # Даём дослать накопленное, затем останавливаем обработчики
+        deadline = time.monotonic() + timeout
+        while (self._pending or self._in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+delivery = DeliveryQueue()
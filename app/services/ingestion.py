@@ -0,0 +1,133 @@
+import asyncio
+import logging
+from collections import OrderedDict, deque
+
+from aiogram.methods import TelegramMethod
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
+from aiohttp import web
+
+from app.supervisor import extract_user_id
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateQueue:
+    """
+    Очередь обновлений: у каждого пользователя своя FIFO-полоса,
+    обновления одного пользователя обрабатываются строго по порядку,
+    разных пользователей - параллельно пулом из workers задач.
+    Повторные доставки с тем же update_id отбрасываются.
+    """
+    def __init__(self, process, workers=64, max_pending=10000, dedupe_size=100000):
+        self.process = process
+        self.workers = workers
+        self.max_pending = max_pending
+        self.dedupe_size = dedupe_size
+        self.pending = 0
+        self._lanes = {}  # user_id -> deque
+        self._ready = asyncio.Queue()
+        self._seen = OrderedDict()
+        self._space = asyncio.Condition()
+        self._tasks = []
+
+    def _is_duplicate(self, update_id):
+        if update_id in self._seen:
+            return True
+        self._seen[update_id] = None
+        if len(self._seen) > self.dedupe_size:
+            self._seen.popitem(last=False)
+        return False
+
+    async def put(self, update, timeout=5.0):
+        """
+        Возвращает 'accepted', 'duplicate' или 'busy' (очередь заполнена дольше timeout).
+        """
+        update_id = update.get('update_id')
+        if update_id in self._seen:
+            return 'duplicate'
+        if self.pending >= self.max_pending:
+            async with self._space:
+                try:
+                    await asyncio.wait_for(self._space.wait_for(lambda: self.pending < self.max_pending), timeout)
+                except asyncio.TimeoutError:
+                    return 'busy'
+        # Пока ждали места, эту доставку могли принять из повтора
+        if update_id is not None and self._is_duplicate(update_id):
+            return 'duplicate'
+        user_id = extract_user_id(update)
+        lane = self._lanes.get(user_id)
+        if lane is None:
+            self._lanes[user_id] = deque([update])
+            self._ready.put_nowait(user_id)
+        else:
+            lane.append(update)
+        self.pending += 1
+        return 'accepted'
+
+    async def _worker(self):
+        while True:
+            user_id = await self._ready.get()
+            lane = self._lanes[user_id]
+            update = lane.popleft()
+            try:
+                await self.process(update)
+            except Exception:
+                logger.exception("Update %s failed", update.get('update_id'))
+            finally:
+                self.pending -= 1
+                if lane:
+                    self._ready.put_nowait(user_id)
+                else:
+                    del self._lanes[user_id]
+                async with self._space:
+                    self._space.notify()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout=10.0):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while self.pending and loop.time() < deadline:
+            await asyncio.sleep(0.05)
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+
+class QueuedRequestHandler(SimpleRequestHandler):
+    """
+    Обработчик вебхука, который отвечает Telegram сразу после постановки обновления в UpdateQueue.
+    При переполнении очереди отвечает 503, и Telegram повторяет доставку позже.
+    """
+    def __init__(self, dispatcher, bot, workers=64, max_pending=10000, **data):
+        super().__init__(dispatcher=dispatcher, bot=bot, handle_in_background=True, **data)
+        self.queue = UpdateQueue(self._process, workers=workers, max_pending=max_pending)
+
+    def register(self, app, /, path, **kwargs):
+        app.on_startup.append(self._handle_start)
+        super().register(app, path=path, **kwargs)
+
+    async def _handle_start(self, app):
+        self.queue.start()
+
+    async def _process(self, update):
+        result = await self.dispatcher.feed_raw_update(bot=self.bot, update=update, **self.data)
+        if isinstance(result, TelegramMethod):
+            await self.dispatcher.silent_call_request(bot=self.bot, result=result)
+
+    async def handle(self, request):
+        if not self.verify_secret(request.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), self.bot):
+            return web.Response(body="Unauthorized", status=401)
+        update = await request.json(loads=self.bot.session.json_loads)
+        status = await self.queue.put(update)
+        if status == 'busy':
+            return web.Response(status=503)
+        return web.json_response({}, dumps=self.bot.session.json_dumps)
+
+    __call__ = handle
+
+    async def close(self):
+        await self.queue.close()
+        await super().close()
@@ -0,0 +1,213 @@
+import asyncio
+import inspect
+import logging
+import os
+import socket
+import uuid
+from datetime import timedelta
+
+from sqlalchemy import select, update, case, or_, func
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.config import LEASE_TTL, LEASE_RENEW_INTERVAL
+from app.models import Lease
+from app.utils.db import get_session
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseLost(Exception):
+    def __init__(self, name):
+        super().__init__(f"Lease {name!r} is no longer held")
+        self.name = name
+
+
+def _db_now():
+    # Сроки аренды считаются по часам базы, а не реплик
+    return func.timezone('utc', func.now())
+
+
+class JobLease:
+    """
+    Аренда одной одиночной задачи. token - токен ограждения: растёт при каждой смене
+    держателя, поэтому запись бывшего ведущего после потери аренды отклоняет fence.
+    """
+    def __init__(self, elector, name, on_acquired=None, on_lost=None):
+        self.elector = elector
+        self.name = name
+        self.on_acquired = on_acquired
+        self.on_lost = on_lost
+        self.token = None  # токен, пока аренда у этого процесса
+        self.holder = None  # текущий держатель по последнему продлению
+        self.holder_token = None
+        self.expires_at = None
+        self._valid_until = 0.0  # время цикла событий, до которого аренда заведомо наша
+        self._acquired_task = None  # выполняющийся on_acquired
+
+    @property
+    def is_leader(self):
+        return self.token is not None and asyncio.get_running_loop().time() < self._valid_until
+
+    async def fence(self, session):
+        """
+        Проверяет в транзакции session, что аренда всё ещё у этого процесса с тем же токеном.
+        Строка аренды блокируется FOR SHARE до конца транзакции, поэтому другая реплика
+        не перехватит аренду, пока изменения не зафиксированы.
+        """
+        if self.token is None:
+            raise LeaseLost(self.name)
+        result = await session.execute(
+            select(Lease.token)
+            .where(
+                Lease.name == self.name,
+                Lease.holder == self.elector.holder,
+                Lease.token == self.token,
+                Lease.expires_at > _db_now(),
+            )
+            .with_for_update(read=True)
+        )
+        if result.scalar() is None:
+            raise LeaseLost(self.name)
+
+    def status(self):
+        return {
+            'holder': self.holder,
+            'token': self.holder_token,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+            'leader': self.is_leader,
+        }
+
+
+class LeaderElector:
+    """
+    Выбор ведущей реплики для одиночных задач через таблицу leases.
+    Каждые renew_interval секунд реплика продлевает свои аренды и пытается занять истёкшие
+    одним INSERT ... ON CONFLICT DO UPDATE. Если продлить аренду не удаётся дольше ttl,
+    процесс сам снимает с себя роль. При остановке аренды освобождаются, и другая реплика
+    подхватывает задачи на следующем продлении.
+    """
+    def __init__(self, ttl=LEASE_TTL, renew_interval=LEASE_RENEW_INTERVAL):
+        self.ttl = ttl
+        self.renew_interval = renew_interval
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.leases = {}
+        self._task = None
+
+    def lease(self, name, on_acquired=None, on_lost=None):
+        """
+        Регистрирует задачу. on_acquired и on_lost получают JobLease и могут быть корутинами.
+        on_acquired выполняется отдельной задачей и отменяется, если аренда потеряна раньше.
+        """
+        lease = JobLease(self, name, on_acquired, on_lost)
+        self.leases[name] = lease
+        return lease
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        held = [lease for lease in self.leases.values() if lease.token is not None]
+        for lease in held:
+            await self._lose(lease)
+        if held:
+            try:
+                await self._release(held)
+            except Exception:
+                logger.exception("Failed to release leases")
+
+    def status(self):
+        return {name: lease.status() for name, lease in self.leases.items()}
+
+    async def _run(self):
+        while True:
+            for lease in self.leases.values():
+                await self._renew(lease)
+            await asyncio.sleep(self.renew_interval)
+
+    async def _renew(self, lease):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        try:
+            holder, token, expires_at = await self._acquire(lease.name)
+        except Exception:
+            logger.exception("Lease %s renewal failed", lease.name)
+            if lease.token is not None and loop.time() >= lease._valid_until:
+                logger.warning("Lease %s expired locally", lease.name)
+                await self._lose(lease)
+            return
+        lease.holder, lease.holder_token, lease.expires_at = holder, token, expires_at
+        if holder != self.holder:
+            if lease.token is not None:
+                logger.warning("Lease %s taken over by %s", lease.name, holder)
+                await self._lose(lease)
+            return
+        # Отсчёт от начала запроса: аренда не дольше, чем её видит база
+        lease._valid_until = started + self.ttl
+        if lease.token != token:
+            lease.token = token
+            logger.info("Acquired lease %s with token %d", lease.name, token)
+            # Отдельной задачей: долгий on_acquired не должен задерживать продление аренд
+            lease._acquired_task = asyncio.create_task(self._call(lease.on_acquired, lease))
+
+    async def _acquire(self, name):
+        now = _db_now()
+        statement = pg_insert(Lease).values(
+            name=name, holder=self.holder, token=1, expires_at=now + timedelta(seconds=self.ttl),
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[Lease.name],
+            set_={
+                'holder': statement.excluded.holder,
+                'token': case((Lease.holder == statement.excluded.holder, Lease.token), else_=Lease.token + 1),
+                'expires_at': statement.excluded.expires_at,
+            },
+            where=or_(Lease.holder == statement.excluded.holder, Lease.expires_at <= now),
+        ).returning(Lease.holder, Lease.token, Lease.expires_at)
+        async with get_session() as session:
+            result = await session.execute(statement)
+            row = result.first()
+            if row is None:
+                # Аренда у другой реплики
+                result = await session.execute(
+                    select(Lease.holder, Lease.token, Lease.expires_at).where(Lease.name == name)
+                )
+                row = result.one()
+            await session.commit()
+        return tuple(row)
+
+    async def _release(self, leases):
+        async with get_session() as session:
+            for lease in leases:
+                await session.execute(
+                    update(Lease)
+                    .where(Lease.name == lease.name, Lease.holder == self.holder, Lease.token == lease.holder_token)
+                    .values(expires_at=_db_now())
+                )
+            await session.commit()
+
+    async def _lose(self, lease):
+        lease.token = None
+        lease._valid_until = 0.0
+        task, lease._acquired_task = lease._acquired_task, None
+        if task and not task.done():
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self._call(lease.on_lost, lease)
+
+    async def _call(self, callback, lease):
+        if callback is None:
+            return
+        try:
+            result = callback(lease)
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception("Lease %s callback failed", lease.name)
+
+
+leader_elector = LeaderElector()
@@ -0,0 +1,260 @@
+from collections import defaultdict
+from decimal import Decimal, ROUND_DOWN
+from typing import NamedTuple, Optional
+
+from sqlalchemy import select, update, insert, values, column, cast, event, func, literal, or_, BigInteger, String
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.config import USER_CACHE_SIZE, USER_CACHE_TTL
+from app.models import Balance, LedgerEntry
+from app.utils.db import get_session
+from app.utils.user_cache import UserCache
+
+SATOSHI = 10 ** 8
+MICRO = 10 ** 6
+INITIAL_USDT_MICRO = 10000 * MICRO  # Начальный баланс для тестирования
+
+FIELDS = ('btc_available_sat', 'btc_frozen_sat', 'usdt_available_micro', 'usdt_frozen_micro')
+
+
+def _to_units(value, scale):
+    value = Decimal(str(value))
+    if not value.is_finite():
+        raise ValueError(f"Amount must be finite: {value}")
+    return int((value * scale).to_integral_value(ROUND_DOWN))
+
+
+def to_sat(btc):
+    return _to_units(btc, SATOSHI)
+
+
+def to_micro(usdt):
+    return _to_units(usdt, MICRO)
+
+
+def from_sat(sat):
+    return Decimal(sat) / SATOSHI
+
+
+def from_micro(micro):
+    return Decimal(micro) / MICRO
+
+
+def format_btc(sat):
+    return f"{from_sat(sat):.8f}"
+
+
+def format_usdt(micro):
+    return f"{from_micro(micro):.2f}"
+
+
+class BalanceSnapshot(NamedTuple):
+    id: int  # user_id, ключ кэша
+    btc_available_sat: int
+    btc_frozen_sat: int
+    usdt_available_micro: int
+    usdt_frozen_micro: int
+
+
+class Change(NamedTuple):
+    user_id: int
+    reason: str
+    order_id: Optional[int] = None
+    btc_available_sat: int = 0
+    btc_frozen_sat: int = 0
+    usdt_available_micro: int = 0
+    usdt_frozen_micro: int = 0
+
+
+def order_value_micro(amount, price):
+    # Стоимость ордера в USDT считается одинаково при заморозке, отмене и исполнении
+    return to_micro(Decimal(str(amount)) * Decimal(str(price)))
+
+
+def fill_change(order_id, user_id, order_type, amount, price):
+    if order_type == 'sell':
+        return Change(user_id, 'fill', order_id, btc_frozen_sat=-to_sat(amount), usdt_available_micro=order_value_micro(amount, price))
+    return Change(user_id, 'fill', order_id, btc_available_sat=to_sat(amount), usdt_frozen_micro=-order_value_micro(amount, price))
+
+
+def cancel_change(order_id, user_id, order_type, amount, price):
+    if order_type == 'sell':
+        sat = to_sat(amount)
+        return Change(user_id, 'cancel', order_id, btc_available_sat=sat, btc_frozen_sat=-sat)
+    micro = order_value_micro(amount, price)
+    return Change(user_id, 'cancel', order_id, usdt_available_micro=micro, usdt_frozen_micro=-micro)
+
+
+def _apply_statement(changes):
+    """
+    Один запрос на пакет изменений: UPDATE ... FROM (VALUES ...) с условием,
+    что ни один остаток не уйдёт в минус, и запись в журнал только для обновлённых строк.
+    Изменения одного пользователя складываются: UPDATE FROM обновляет строку один раз.
+    """
+    balances = Balance.__table__
+    ledger = LedgerEntry.__table__
+    totals = defaultdict(lambda: [0] * len(FIELDS))
+    for change in changes:
+        total = totals[change.user_id]
+        for i, name in enumerate(FIELDS):
+            total[i] += getattr(change, name)
+    deltas = values(
+        column('user_id', BigInteger), *(column(name, BigInteger) for name in FIELDS), name='deltas'
+    ).data([(user_id, *total) for user_id, total in totals.items()])
+    applied = (
+        update(balances)
+        .where(balances.c.user_id == deltas.c.user_id, *(balances.c[name] + deltas.c[name] >= 0 for name in FIELDS))
+        .values({name: balances.c[name] + deltas.c[name] for name in FIELDS})
+        .returning(balances.c.user_id, *(balances.c[name] for name in FIELDS))
+        .cte('applied')
+    )
+    entries = values(
+        column('user_id', BigInteger), column('reason', String), column('order_id', BigInteger),
+        *(column(name, BigInteger) for name in FIELDS), name='entries'
+    ).data([(change.user_id, change.reason, change.order_id, *(getattr(change, name) for name in FIELDS)) for change in changes])
+    journal = insert(ledger).from_select(
+        ['user_id', 'reason', 'order_id', *FIELDS],
+        # Столбец из одних NULL в VALUES Postgres считает текстовым
+        select(
+            entries.c.user_id, entries.c.reason, cast(entries.c.order_id, BigInteger), *(entries.c[name] for name in FIELDS)
+        ).join(applied, applied.c.user_id == entries.c.user_id),
+    ).cte('journal')
+    return select(applied).add_cte(journal)
+
+
+async def apply_many(session, changes):
+    """
+    Применяет изменения в транзакции session без блокировок SELECT ... FOR UPDATE.
+    Возвращает {user_id: BalanceSnapshot} для применённых пользователей;
+    пользователь, которому не хватило средств, в результат не попадает.
+    Кэш балансов обновляется после commit.
+    """
+    if not changes:
+        return {}
+    result = await session.execute(_apply_statement(changes))
+    snapshots = {row[0]: BalanceSnapshot(*row) for row in result}
+    session.sync_session.info.setdefault('balances', {}).update(snapshots)
+    return snapshots
+
+
+async def apply(session, change):
+    snapshots = await apply_many(session, [change])
+    return snapshots.get(change.user_id)
+
+
+def _sync_statement(targets):
+    """
+    Один запрос на пакет: остатки выставляются в значения биржи (NULL - без изменений),
+    разница с прежними остатками пишется в журнал. Прежние значения берутся из второй
+    ссылки на balances в FROM: она видит строку до обновления.
+    """
+    balances = Balance.__table__
+    ledger = LedgerEntry.__table__
+    old = balances.alias('old')
+    rows = values(
+        column('user_id', BigInteger), *(column(name, BigInteger) for name in FIELDS), name='targets'
+    ).data([(user_id, *(fields.get(name) for name in FIELDS)) for user_id, fields in targets.items()])
+    applied = (
+        update(balances)
+        .where(balances.c.user_id == rows.c.user_id, old.c.user_id == balances.c.user_id)
+        .values({name: func.coalesce(cast(rows.c[name], BigInteger), balances.c[name]) for name in FIELDS})
+        .returning(
+            balances.c.user_id, *(balances.c[name] for name in FIELDS),
+            *((balances.c[name] - old.c[name]).label(f'delta_{name}') for name in FIELDS),
+        )
+        .cte('applied')
+    )
+    journal = insert(ledger).from_select(
+        ['user_id', 'reason', *FIELDS],
+        select(applied.c.user_id, literal('exchange'), *(applied.c[f'delta_{name}'] for name in FIELDS))
+        .where(or_(*(applied.c[f'delta_{name}'] != 0 for name in FIELDS))),
+    ).cte('journal')
+    return select(applied.c.user_id, *(applied.c[name] for name in FIELDS)).add_cte(journal)
+
+
+async def sync_many(session, targets):
+    """
+    Выставляет остатки по данным биржи. targets - {user_id: {поле: значение}};
+    отсутствующие поля не меняются, разница записывается в журнал с причиной 'exchange'.
+    Возвращает {user_id: BalanceSnapshot}.
+    """
+    if not targets:
+        return {}
+    result = await session.execute(_sync_statement(targets))
+    snapshots = {row[0]: BalanceSnapshot(*row) for row in result}
+    missing = targets.keys() - snapshots.keys()
+    if missing:
+        for user_id in missing:
+            await open_account(session, user_id)
+        result = await session.execute(_sync_statement({user_id: targets[user_id] for user_id in missing}))
+        snapshots.update((row[0], BalanceSnapshot(*row)) for row in result)
+    session.sync_session.info.setdefault('balances', {}).update(snapshots)
+    return snapshots
+
+
+async def open_account(session, user_id):
+    """
+    Создаёт баланс с начальной суммой и записью 'opening' в журнале, если его ещё нет.
+    """
+    balances = Balance.__table__
+    result = await session.execute(
+        pg_insert(balances)
+        .values(user_id=user_id, btc_available_sat=0, btc_frozen_sat=0, usdt_available_micro=INITIAL_USDT_MICRO, usdt_frozen_micro=0)
+        .on_conflict_do_nothing(index_elements=[balances.c.user_id])
+        .returning(balances.c.user_id, *(balances.c[name] for name in FIELDS))
+    )
+    row = result.first()
+    if row is None:
+        return None
+    await session.execute(insert(LedgerEntry.__table__).values(user_id=user_id, reason='opening', usdt_available_micro=INITIAL_USDT_MICRO))
+    snapshot = BalanceSnapshot(*row)
+    session.sync_session.info.setdefault('balances', {})[user_id] = snapshot
+    return snapshot
+
+
+async def get_balance(user_id):
+    """
+    Текущий баланс из кэшированной проекции; при промахе читается из базы,
+    отсутствующий баланс открывается с начальной суммой.
+    """
+    snapshot = balance_cache.get(user_id)
+    if snapshot is not None:
+        return snapshot
+    balances = Balance.__table__
+    async with get_session() as session:
+        result = await session.execute(
+            select(balances.c.user_id, *(balances.c[name] for name in FIELDS)).where(balances.c.user_id == user_id)
+        )
+        row = result.first()
+        if row is not None:
+            snapshot = BalanceSnapshot(*row)
+            balance_cache.put(snapshot)
+            return snapshot
+        snapshot = await open_account(session, user_id)
+        await session.commit()
+        if snapshot is None:
+            # Параллельный запрос открыл счёт первым - читаем его строку
+            result = await session.execute(
+                select(balances.c.user_id, *(balances.c[name] for name in FIELDS)).where(balances.c.user_id == user_id)
+            )
+            snapshot = BalanceSnapshot(*result.one())
+            balance_cache.put(snapshot)
+        return snapshot
+
+
+# Все изменения балансов пользователя идут через процесс-владелец (sharding),
+# поэтому проекция в памяти процесса совпадает с базой; TTL ограничивает расхождение
+# после ручных правок в базе.
+balance_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish_balances(session):
+    for snapshot in session.info.pop('balances', {}).values():
+        balance_cache.put(snapshot)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_balances(session):
+    session.info.pop('balances', None)
@@ -0,0 +1,175 @@
+import heapq
+import logging
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from app.models import Order
+from app.utils.db import get_session
+from app.utils.sharding import user_filter
+from app.services.price_feed import price_feed
+from app.services.delivery import PRIORITY_FILL
+from app.services.stats import Fill, record_fills
+from app.services import ledger, outbox
+
+logger = logging.getLogger(__name__)
+
+
+class OrderBook:
+    """
+    Открытые лимитные ордера в двух кучах по цене.
+    Продажа исполняется, когда цена >= цены ордера, покупка - когда цена <= цены ордера.
+    Отменённые ордера удаляются лениво: запись в куче пропускается при извлечении.
+    """
+    def __init__(self):
+        self._asks = []  # (price, order_id)
+        self._bids = []  # (-price, order_id)
+        self._orders = {}  # order_id -> (order_type, price)
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __contains__(self, order_id):
+        return order_id in self._orders
+
+    def add(self, order_id, order_type, price):
+        self._orders[order_id] = (order_type, price)
+        if order_type == 'sell':
+            heapq.heappush(self._asks, (price, order_id))
+        else:
+            heapq.heappush(self._bids, (-price, order_id))
+
+    def discard(self, order_id):
+        if self._orders.pop(order_id, None) is not None:
+            self._compact()
+
+    def _compact(self):
+        if len(self._asks) + len(self._bids) > 2 * len(self._orders) + 64:
+            self._asks = [entry for entry in self._asks if self._is_live(entry[1], 'sell', entry[0])]
+            self._bids = [entry for entry in self._bids if self._is_live(entry[1], 'buy', -entry[0])]
+            heapq.heapify(self._asks)
+            heapq.heapify(self._bids)
+
+    def _is_live(self, order_id, order_type, price):
+        return self._orders.get(order_id) == (order_type, price)
+
+    def crossed(self, price):
+        """
+        Извлекает из книги все ордера, пересечённые ценой, за O(k log n).
+        Возвращает список (order_id, order_type, price).
+        """
+        crossed = []
+        while self._asks and self._asks[0][0] <= price:
+            ask_price, order_id = heapq.heappop(self._asks)
+            if self._is_live(order_id, 'sell', ask_price):
+                del self._orders[order_id]
+                crossed.append((order_id, 'sell', ask_price))
+        while self._bids and -self._bids[0][0] >= price:
+            neg_price, order_id = heapq.heappop(self._bids)
+            if self._is_live(order_id, 'buy', -neg_price):
+                del self._orders[order_id]
+                crossed.append((order_id, 'buy', -neg_price))
+        return crossed
+
+    async def load(self):
+        async with get_session() as session:
+            result = await session.execute(
+                select(Order.id, Order.order_type, Order.price)
+                # Ордера, размещённые на бирже, исполняет биржа
+                .where(Order.status == 'Open', Order.exchange_order_id.is_(None), user_filter(Order.user_id))
+            )
+            for order_id, order_type, price in result:
+                self.add(order_id, order_type, price)
+        logger.info("Order book loaded %d open orders", len(self))
+
+
+def fill_message(order_id, user_id, order_type, amount, price):
+    # Ключ общий для исполнения книгой и потоком биржи: одно уведомление на ордер
+    return outbox.Message(
+        user_id,
+        f"Order №{order_id} has been filled.\nType: {order_type}\nAmount: {amount} BTC\nPrice: {price} USDT",
+        PRIORITY_FILL,
+        f"fill:{order_id}",
+    )
+
+
+async def fill_orders(order_ids):
+    """
+    Исполняет ордера одной транзакцией: статусы ордеров, балансы и уведомления пишутся пакетно.
+    Ордера пользователей, чьи балансы не удалось изменить, остаются открытыми.
+    Возвращает (исполненные ордера (id, user_id, order_type, amount, price),
+    оставшиеся открытыми (id, order_type, price)).
+    """
+    async with get_session() as session:
+        result = await session.execute(
+            update(Order)
+            .where(Order.id.in_(order_ids), Order.status == 'Open')
+            .values(status='Completed')
+            .returning(Order.id, Order.user_id, Order.order_type, Order.amount, Order.price)
+            .execution_options(synchronize_session=False)
+        )
+        fills = result.all()
+        if not fills:
+            return fills, []
+        applied = await ledger.apply_many(session, [ledger.fill_change(*fill) for fill in fills])
+        missing = {user_id for _, user_id, _, _, _ in fills} - applied.keys()
+        held = []
+        if missing:
+            # Замороженных средств меньше суммы ордеров - журнал и балансы разошлись.
+            # Ордера этих пользователей не исполняются: статус возвращается в Open
+            logger.error("Balances not updated for filled orders of users %s", sorted(missing))
+            held = [(order_id, order_type, price) for order_id, user_id, order_type, _, price in fills if user_id in missing]
+            await session.execute(
+                update(Order)
+                .where(Order.id.in_([order_id for order_id, _, _ in held]))
+                .values(status='Open')
+                .execution_options(synchronize_session=False)
+            )
+            fills = [fill for fill in fills if fill.user_id not in missing]
+        today = datetime.utcnow().date()
+        await record_fills(session, [Fill(user_id, order_type, amount, price, today) for _, user_id, order_type, amount, price in fills])
+        await outbox.enqueue_many(session, [fill_message(*fill) for fill in fills])
+        await session.commit()
+    return fills, held
+
+
+def sell_placed_message(order_id, user_id, amount, price, date_created):
+    total = ledger.format_usdt(ledger.order_value_micro(amount, price))
+    return outbox.Message(
+        user_id,
+        f"Limit sell order successfully placed.\nSell: {amount} BTC\nSell price per 1 BTC: {price} USDT\nTotal: {total} USDT\nDate and time: {date_created}",
+        dedupe_key=f"sell:{order_id}",
+    )
+
+
+class OrderMatcher:
+    def __init__(self, book):
+        self.book = book
+        self._subscriber = None
+
+    async def start(self):
+        await self.book.load()
+        self._subscriber = price_feed.subscribe(self.on_tick)
+
+    def stop(self):
+        if self._subscriber:
+            price_feed.unsubscribe(self._subscriber)
+            self._subscriber = None
+
+    async def on_tick(self, tick):
+        crossed = self.book.crossed(tick.price)
+        if not crossed:
+            return
+        try:
+            _, held = await fill_orders([order_id for order_id, _, _ in crossed])
+        except Exception:
+            # Возвращаем ордера в книгу, чтобы повторить на следующем тике
+            for order_id, order_type, price in crossed:
+                self.book.add(order_id, order_type, price)
+            raise
+        for order_id, order_type, price in held:
+            self.book.add(order_id, order_type, price)
+
+
+order_book = OrderBook()
+order_matcher = OrderMatcher(order_book)
@@ -0,0 +1,199 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from typing import NamedTuple, Optional
+
+from aiogram.types import InlineKeyboardMarkup
+from sqlalchemy import select, update, delete, or_, event
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session
+
+from app.config import OUTBOX_BATCH_SIZE, OUTBOX_LEASE, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION
+from app.models import OutboxMessage
+from app.utils.db import get_session
+from app.utils.sharding import user_filter
+from app.services.delivery import delivery, PRIORITY_DEFAULT
+
+logger = logging.getLogger(__name__)
+
+CLEANUP_INTERVAL = 3600
+
+
+class Message(NamedTuple):
+    chat_id: int
+    text: str
+    priority: int = PRIORITY_DEFAULT
+    dedupe_key: Optional[str] = None  # повторная запись с тем же ключом игнорируется
+    reply_markup: Optional[InlineKeyboardMarkup] = None
+
+
+async def enqueue_many(session, messages):
+    """
+    Записывает сообщения в outbox в транзакции session: они уйдут, только если она зафиксирована.
+    """
+    if not messages:
+        return
+    await session.execute(
+        pg_insert(OutboxMessage)
+        .values([
+            {
+                'chat_id': message.chat_id,
+                'text': message.text,
+                'priority': message.priority,
+                'dedupe_key': message.dedupe_key,
+                'reply_markup': message.reply_markup.model_dump(exclude_none=True) if message.reply_markup else None,
+            }
+            for message in messages
+        ])
+        .on_conflict_do_nothing(index_elements=[OutboxMessage.dedupe_key])
+    )
+    session.sync_session.info['outbox'] = True
+
+
+async def enqueue(session, chat_id, text, priority=PRIORITY_DEFAULT, dedupe_key=None, reply_markup=None):
+    await enqueue_many(session, [Message(chat_id, text, priority, dedupe_key, reply_markup)])
+
+
+class OutboxDispatcher:
+    """
+    Рассылает сообщения outbox своей доли пользователей (sharding).
+    Строки забираются пакетом через FOR UPDATE SKIP LOCKED с арендой lease_until:
+    реплики с тем же номером процесса не получат одни и те же строки, а строки упавшей
+    реплики вернутся в работу, когда аренда истечёт. Отправка идёт через очередь delivery,
+    результаты отмечаются в базе пакетом.
+    """
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, lease=OUTBOX_LEASE, poll_interval=OUTBOX_POLL_INTERVAL,
+                 max_attempts=OUTBOX_MAX_ATTEMPTS, retention=OUTBOX_RETENTION):
+        self.batch_size = batch_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.retention = retention
+        self._wakeup = asyncio.Event()
+        self._results = []  # (id, attempts, доставлено)
+        self._tasks = []
+
+    def notify(self):
+        self._wakeup.set()
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._run()), asyncio.create_task(self._cleanup())]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        # Непомеченные строки без результата вернутся в работу по истечении аренды
+        await self.record_results()
+
+    async def _run(self):
+        while True:
+            claimed = 0
+            try:
+                await self.record_results()
+                # Не забираем больше, чем очередь успеет отправить до конца аренды
+                if len(delivery) < self.batch_size:
+                    claimed = await self.dispatch_once()
+            except Exception:
+                logger.exception("Outbox dispatch failed")
+            if claimed < self.batch_size:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def claim(self):
+        now = datetime.utcnow()
+        table = OutboxMessage.__table__
+        pending = (
+            select(table.c.id)
+            .where(
+                table.c.status == 'pending',
+                or_(table.c.lease_until.is_(None), table.c.lease_until < now),
+                user_filter(table.c.chat_id),
+            )
+            .order_by(table.c.priority, table.c.id)
+            .limit(self.batch_size)
+            .with_for_update(skip_locked=True)
+        )
+        async with get_session() as session:
+            result = await session.execute(
+                update(table)
+                .where(table.c.id.in_(pending.scalar_subquery()))
+                .values(lease_until=now + timedelta(seconds=self.lease), attempts=table.c.attempts + 1)
+                .returning(table.c.id, table.c.chat_id, table.c.text, table.c.reply_markup, table.c.priority, table.c.attempts)
+            )
+            rows = sorted(result.all())
+            await session.commit()
+        return rows
+
+    async def dispatch_once(self):
+        rows = await self.claim()
+        for row_id, chat_id, text, reply_markup, priority, attempts in rows:
+            kwargs = {'reply_markup': InlineKeyboardMarkup.model_validate(reply_markup)} if reply_markup else {}
+            future = delivery.enqueue(chat_id, text, priority, **kwargs)
+            future.add_done_callback(lambda future, row_id=row_id, attempts=attempts: self._done(row_id, attempts, future))
+        return len(rows)
+
+    def _done(self, row_id, attempts, future):
+        self._results.append((row_id, attempts, not future.cancelled() and future.result()))
+        if len(self._results) >= self.batch_size:
+            self._wakeup.set()
+
+    async def record_results(self):
+        results, self._results = self._results, []
+        if not results:
+            return
+        sent = [row_id for row_id, _, delivered in results if delivered]
+        failed = [row_id for row_id, attempts, delivered in results if not delivered and attempts >= self.max_attempts]
+        retry = [row_id for row_id, attempts, delivered in results if not delivered and attempts < self.max_attempts]
+        now = datetime.utcnow()
+        table = OutboxMessage.__table__
+        try:
+            async with get_session() as session:
+                if sent:
+                    await session.execute(update(table).where(table.c.id.in_(sent)).values(status='sent', sent_at=now, lease_until=None))
+                if failed:
+                    await session.execute(update(table).where(table.c.id.in_(failed)).values(status='failed', lease_until=None))
+                if retry:
+                    # Повтор не раньше, чем через минуту
+                    await session.execute(update(table).where(table.c.id.in_(retry)).values(lease_until=now + timedelta(seconds=60)))
+                await session.commit()
+        except Exception:
+            self._results.extend(results)
+            raise
+
+    async def _cleanup(self):
+        while True:
+            await asyncio.sleep(CLEANUP_INTERVAL)
+            try:
+                async with get_session() as session:
+                    result = await session.execute(
+                        delete(OutboxMessage).where(
+                            OutboxMessage.status != 'pending',
+                            OutboxMessage.created_at < datetime.utcnow() - timedelta(seconds=self.retention),
+                            user_filter(OutboxMessage.chat_id),
+                        )
+                    )
+                    await session.commit()
+                if result.rowcount:
+                    logger.info("Outbox cleanup removed %d messages", result.rowcount)
+            except Exception:
+                logger.exception("Outbox cleanup failed")
+
+
+outbox_dispatcher = OutboxDispatcher()
+
+
+@event.listens_for(Session, 'after_commit')
+def _wake_dispatcher(session):
+    if session.info.pop('outbox', False):
+        outbox_dispatcher.notify()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_flag(session):
+    session.info.pop('outbox', None)
@@ -0,0 +1,271 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import NamedTuple
+
+import aiohttp
+
+from app.config import PRICE_FEED_SOURCE, PRICE_FEED_URL, PRICE_FEED_REPLAY_FILE, PRICE_FEED_HISTORY
+
+logger = logging.getLogger(__name__)
+
+
+class Tick(NamedTuple):
+    price: float
+    timestamp: float
+
+
+class PriceSource(ABC):
+    """
+    Источник тиков цены. Подклассы реализуют асинхронный генератор stream().
+    """
+    @abstractmethod
+    def stream(self):
+        """
+        Асинхронный итератор тиков Tick.
+        """
+
+
+class SimulatedSource(PriceSource):
+    """
+    Случайное блуждание цены - для локального запуска и тестов.
+    """
+    def __init__(self, start_price=50000.0, volatility=0.0005, interval=1.0, seed=None):
+        self.start_price = start_price
+        self.volatility = volatility
+        self.interval = interval
+        self.seed = seed
+
+    async def stream(self):
+        rng = random.Random(self.seed)
+        price = self.start_price
+        while True:
+            price *= 1 + rng.gauss(0, self.volatility)
+            yield Tick(round(price, 2), time.time())
+            await asyncio.sleep(self.interval)
+
+
+class ReplaySource(PriceSource):
+    """
+    Воспроизводит записанные цены: из списка или из файла,
+    где каждая строка - "price" или "timestamp,price".
+    """
+    def __init__(self, path=None, prices=None, interval=0.0, loop=False):
+        self.path = path
+        self.prices = prices
+        self.interval = interval
+        self.loop = loop
+
+    def _load(self):
+        if self.prices is not None:
+            return [float(p) for p in self.prices]
+        prices = []
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                prices.append(float(line.split(',')[-1]))
+        return prices
+
+    async def stream(self):
+        prices = self._load()
+        while True:
+            for price in prices:
+                yield Tick(price, time.time())
+                await asyncio.sleep(self.interval)
+            if not self.loop:
+                return
+
+
+class ExchangeStreamSource(PriceSource):
+    """
+    Поток сделок биржи по WebSocket (по умолчанию Binance btcusdt@trade).
+    Переподключается с экспоненциальной задержкой.
+    """
+    def __init__(self, url, reconnect_delay=1.0, max_reconnect_delay=30.0):
+        self.url = url
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+
+    @staticmethod
+    def parse(raw):
+        data = json.loads(raw)
+        if isinstance(data, dict) and 'data' in data:
+            data = data['data']
+        price = data.get('p') or data.get('c')
+        if price is None:
+            return None
+        timestamp = data.get('T') or data.get('E')
+        return Tick(float(price), timestamp / 1000 if timestamp else time.time())
+
+    async def stream(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.ws_connect(self.url, heartbeat=30) as ws:
+                        delay = self.reconnect_delay
+                        async for msg in ws:
+                            if msg.type == aiohttp.WSMsgType.TEXT:
+                                tick = self.parse(msg.data)
+                                if tick:
+                                    yield tick
+                            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                break
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                logger.warning("Price stream error: %s", e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.max_reconnect_delay)
+
+
+class SupervisorSource(PriceSource):
+    """
+    Тики, которые рассылает супервизор рабочим процессам (app.supervisor) по unix-сокету.
+    """
+    def __init__(self, path, reconnect_delay=0.5):
+        self.path = path
+        self.reconnect_delay = reconnect_delay
+
+    async def stream(self):
+        while True:
+            try:
+                async with aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=self.path)) as session:
+                    async with session.ws_connect('http://supervisor/ticks', heartbeat=30) as ws:
+                        async for msg in ws:
+                            if msg.type == aiohttp.WSMsgType.TEXT:
+                                price, timestamp = json.loads(msg.data)
+                                yield Tick(price, timestamp)
+                            elif msg.type in (aiohttp.WSMsgType.CLOSED, aiohttp.WSMsgType.ERROR):
+                                break
+            except (aiohttp.ClientError, OSError) as e:
+                logger.warning("Supervisor price stream error: %s", e)
+            await asyncio.sleep(self.reconnect_delay)
+
+
+class _Subscriber:
+    """
+    Подписчик на тики. Медленный подписчик получает только последний тик
+    и не задерживает ленту и других подписчиков.
+    """
+    def __init__(self, callback):
+        self.callback = callback
+        self._pending = None
+        self._event = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def notify(self, tick):
+        self._pending = tick
+        self._event.set()
+
+    async def _run(self):
+        while True:
+            await self._event.wait()
+            self._event.clear()
+            tick, self._pending = self._pending, None
+            try:
+                await self.callback(tick)
+            except Exception:
+                logger.exception("Price subscriber %r failed", self.callback)
+
+
+class PriceFeed:
+    """
+    Единственная фоновая задача, читающая источник цены.
+    Хранит последний тик и кольцевой буфер последних тиков в памяти,
+    поэтому обработчики получают цену без ввода-вывода.
+    """
+    def __init__(self, source, history=1000):
+        self.source = source
+        self.history = deque(maxlen=history)
+        self.latest = None
+        self._first_tick = asyncio.Event()
+        self._task = None
+        self._subscribers = []
+
+    @property
+    def price(self):
+        return self.latest.price if self.latest else None
+
+    def recent(self, n=None):
+        ticks = list(self.history)
+        return ticks if n is None else ticks[-n:]
+
+    async def get_price(self, timeout=10.0):
+        # До первого тика все читатели ждут одну и ту же задачу ленты,
+        # собственных запросов к источнику не делают
+        if self.latest is None:
+            self.start()
+            await asyncio.wait_for(self._first_tick.wait(), timeout)
+        return self.latest.price
+
+    def subscribe(self, callback):
+        subscriber = _Subscriber(callback)
+        self._subscribers.append(subscriber)
+        if self._task and not self._task.done():
+            subscriber.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        subscriber.stop()
+        self._subscribers.remove(subscriber)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+            for subscriber in self._subscribers:
+                subscriber.start()
+
+    async def stop(self):
+        for subscriber in self._subscribers:
+            subscriber.stop()
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def publish(self, tick):
+        self.latest = tick
+        self.history.append(tick)
+        self._first_tick.set()
+        for subscriber in self._subscribers:
+            subscriber.notify(tick)
+
+    async def _run(self):
+        while True:
+            try:
+                async for tick in self.source.stream():
+                    self.publish(tick)
+                logger.info("Price source exhausted")
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Price feed failed, restarting")
+                await asyncio.sleep(1)
+
+
+def build_source():
+    if PRICE_FEED_SOURCE == 'simulated':
+        return SimulatedSource()
+    if PRICE_FEED_SOURCE == 'replay':
+        return ReplaySource(path=PRICE_FEED_REPLAY_FILE, interval=1.0, loop=True)
+    return ExchangeStreamSource(PRICE_FEED_URL)
+
+
+price_feed = PriceFeed(build_source(), history=PRICE_FEED_HISTORY)
@@ -0,0 +1,83 @@
+import asyncio
+import heapq
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Scheduler:
+    """
+    Планировщик на куче: одна запись на ключ (например, на пользователя)
+    и одна фоновая задача, которая спит до ближайшего срока.
+    Отмена и перенос - O(1) в словаре, устаревшие записи кучи пропускаются при извлечении.
+    callback вызывается синхронно со списком ключей, срок которых наступил.
+    """
+    def __init__(self, callback):
+        self._callback = callback
+        self._deadlines = {}  # key -> deadline
+        self._heap = []  # (deadline, key)
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def deadline(self, key):
+        return self._deadlines.get(key)
+
+    def schedule_at(self, key, deadline):
+        self._deadlines[key] = deadline
+        heapq.heappush(self._heap, (deadline, key))
+        if self._heap[0] == (deadline, key):
+            self._wakeup.set()
+        self._compact()
+
+    def schedule(self, key, delay):
+        self.schedule_at(key, time.time() + delay)
+
+    def cancel(self, key):
+        if self._deadlines.pop(key, None) is not None:
+            self._compact()
+
+    def _compact(self):
+        if len(self._heap) > 2 * len(self._deadlines) + 64:
+            self._heap = [(deadline, key) for key, deadline in self._deadlines.items()]
+            heapq.heapify(self._heap)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    def pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, key = heapq.heappop(self._heap)
+            if self._deadlines.get(key) == deadline:
+                del self._deadlines[key]
+                due.append(key)
+        return due
+
+    async def _run(self):
+        while True:
+            now = time.time()
+            due = self.pop_due(now)
+            if due:
+                try:
+                    self._callback(due)
+                except Exception:
+                    logger.exception("Scheduler callback failed")
+            self._wakeup.clear()
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,92 @@
+from collections import defaultdict
+from datetime import date
+from typing import NamedTuple
+
+from sqlalchemy import select, func
+from sqlalchemy.dialects.postgresql import insert
+
+from app.models import PositionLot, UserDailyStats
+
+# Остаток лота меньше этого объёма считается закрытым
+DUST = 1e-12
+
+
+class Fill(NamedTuple):
+    user_id: int
+    order_type: str
+    amount: float  # BTC
+    price: float
+    day: date
+
+
+async def record_fills(session, fills):
+    """
+    Обновляет дневную статистику по исполненным ордерам в текущей транзакции.
+    Покупки открывают лоты, продажи закрывают их по FIFO и дают реализованную прибыль.
+    """
+    rollups = defaultdict(lambda: [0, 0.0, 0.0])  # (user_id, day) -> [сделки, объём, прибыль]
+    sellers = {fill.user_id for fill in fills if fill.order_type == 'sell'}
+    lots = defaultdict(list)
+    if sellers:
+        result = await session.execute(
+            select(PositionLot)
+            .where(PositionLot.user_id.in_(sellers))
+            .order_by(PositionLot.user_id, PositionLot.id)
+            .with_for_update()
+        )
+        for lot in result.scalars():
+            lots[lot.user_id].append(lot)
+    for fill in fills:
+        rollup = rollups[(fill.user_id, fill.day)]
+        rollup[0] += 1
+        rollup[1] += fill.amount * fill.price
+        if fill.order_type == 'buy':
+            lot = PositionLot(user_id=fill.user_id, amount=fill.amount, price=fill.price)
+            session.add(lot)
+            lots[fill.user_id].append(lot)
+            continue
+        remaining = fill.amount
+        user_lots = lots[fill.user_id]
+        while remaining > DUST and user_lots:
+            lot = user_lots[0]
+            take = min(lot.amount, remaining)
+            rollup[2] += take * (fill.price - lot.price)
+            lot.amount -= take
+            remaining -= take
+            if lot.amount <= DUST:
+                user_lots.pop(0)
+                if lot in session.new:
+                    # Лот открыт и закрыт в этом же пакете - в базу не попадает
+                    session.expunge(lot)
+                else:
+                    await session.delete(lot)
+    if not rollups:
+        return
+    stmt = insert(UserDailyStats).values([
+        {'user_id': user_id, 'day': day, 'trade_count': count, 'volume': volume, 'realized_pnl': pnl}
+        for (user_id, day), (count, volume, pnl) in rollups.items()
+    ])
+    await session.execute(stmt.on_conflict_do_update(
+        index_elements=[UserDailyStats.user_id, UserDailyStats.day],
+        set_={
+            'trade_count': UserDailyStats.trade_count + stmt.excluded.trade_count,
+            'volume': UserDailyStats.volume + stmt.excluded.volume,
+            'realized_pnl': UserDailyStats.realized_pnl + stmt.excluded.realized_pnl,
+        },
+    ))
+
+
+async def period_stats(session, user_id, since=None):
+    """
+    Сделки, объём и прибыль пользователя с даты since (включительно) - одно агрегирующее чтение.
+    """
+    query = select(
+        func.coalesce(func.sum(UserDailyStats.trade_count), 0),
+        func.coalesce(func.sum(UserDailyStats.volume), 0.0),
+        func.coalesce(func.sum(UserDailyStats.realized_pnl), 0.0),
+    ).where(UserDailyStats.user_id == user_id)
+    if since is not None:
+        query = query.where(UserDailyStats.day >= since)
+    result = await session.execute(query)
+    return result.one()
+
@@ -0,0 +1,135 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+
+from sqlalchemy import select, update, func
+
+from app.models import User
+from app.utils.db import get_session
+from app.utils.locale import catalog
+from app.utils.commands import command_scopes
+from app.utils.user_cache import user_cache
+from app.services.autotrade import autotrade_engine
+from app.services.delivery import PRIORITY_DEFAULT, PRIORITY_REMINDER
+from app.services import outbox
+
+logger = logging.getLogger(__name__)
+
+REMINDER_DAYS = 5
+# Напоминание уходит, когда до окончания остаётся меньше REMINDER_DAYS + 1 суток,
+# то есть целых дней остаётся ровно REMINDER_DAYS
+REMINDER_AHEAD = timedelta(days=REMINDER_DAYS + 1)
+MAX_SLEEP = 3600
+
+
+class SubscriptionChecker:
+    """
+    Снимает истёкшие подписки одним UPDATE ... RETURNING и рассылает напоминания
+    о скором окончании. Просыпается к ближайшему сроку окончания или напоминания,
+    а не раз в сутки.
+    """
+    def __init__(self):
+        self._wakeup = asyncio.Event()
+        self._reminded_until = None
+        self._lease = None
+        self._task = None
+
+    def notify_changed(self):
+        # Вызывается при выдаче или продлении подписки: пересчитать время пробуждения
+        self._wakeup.set()
+
+    def start(self, bot, lease=None):
+        # lease - аренда ведущей реплики: изменения фиксируются только под её токеном
+        self._lease = lease
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot))
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self, bot):
+        while True:
+            try:
+                next_run = await self.run_once(bot)
+            except Exception:
+                logger.exception("Subscription check failed")
+                next_run = None
+            timeout = MAX_SLEEP
+            if next_run:
+                timeout = min(MAX_SLEEP, max(0.0, (next_run - datetime.utcnow()).total_seconds()))
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def run_once(self, bot):
+        """
+        Один проход проверки. Возвращает время следующего события.
+        """
+        now = datetime.utcnow()
+        # При первом запуске напоминаем всем, у кого осталось REMINDER_DAYS дней,
+        # дальше - только тем, чей срок пересёк границу с прошлого прохода
+        window_start = self._reminded_until or now + timedelta(days=REMINDER_DAYS)
+        window_end = now + REMINDER_AHEAD
+        async with get_session() as session:
+            result = await session.execute(
+                update(User)
+                .where(User.subscription == True, User.subscription_expires <= now)
+                .values(subscription=False)
+                .returning(User.id, User.language, User.subscription_expires)
+                .execution_options(synchronize_session=False)
+            )
+            expired = result.all()
+            result = await session.execute(
+                select(User.id, User.language, User.subscription_expires)
+                .where(
+                    User.subscription == True,
+                    User.subscription_expires > window_start,
+                    User.subscription_expires <= window_end,
+                )
+            )
+            expiring = result.all()
+            result = await session.execute(
+                select(
+                    func.min(User.subscription_expires).filter(User.subscription_expires > now),
+                    func.min(User.subscription_expires).filter(User.subscription_expires > window_end),
+                ).where(User.subscription == True)
+            )
+            next_expiry, next_reminder = result.one()
+            # Уведомления фиксируются вместе со снятием подписки; ключ по сроку окончания
+            # не даёт повторить напоминание после перезапуска
+            await outbox.enqueue_many(session, [
+                outbox.Message(user_id, catalog.render(language, "subscription_expired"), PRIORITY_DEFAULT,
+                               f"subscription_expired:{user_id}:{expires:%Y%m%d%H%M%S}")
+                for user_id, language, expires in expired
+            ] + [
+                outbox.Message(user_id, catalog.render(language, "subscription_expiring", days=REMINDER_DAYS), PRIORITY_REMINDER,
+                               f"subscription_expiring:{user_id}:{expires:%Y%m%d%H%M%S}")
+                for user_id, language, expires in expiring
+            ])
+            # Новые наборы команд сохраняются в той же транзакции: перезапуск их не потеряет
+            await command_scopes.persist(session, [(user_id, language, False) for user_id, language, _ in expired])
+            if self._lease:
+                await self._lease.fence(session)
+            await session.commit()
+        self._reminded_until = window_end
+
+        user_cache.invalidate_many(user_id for user_id, _, _ in expired)
+        for user_id, _, _ in expired:
+            autotrade_engine.remove(user_id)
+        # Команды меняются фоновым обработчиком с ограничением частоты, чтобы массовое
+        # истечение не упёрлось в лимиты Bot API
+        for user_id, language, _ in expired:
+            command_scopes.schedule(user_id, language, False)
+        if expired or expiring:
+            logger.info("Subscriptions: %d expired, %d reminded", len(expired), len(expiring))
+
+        candidates = [next_expiry, next_reminder - REMINDER_AHEAD if next_reminder else None]
+        candidates = [candidate for candidate in candidates if candidate]
+        return min(candidates) if candidates else None
+
+
+subscription_checker = SubscriptionChecker()
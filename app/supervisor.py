@@ -0,0 +1,192 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+
+import aiohttp
+from aiohttp import web
+
+from app.config import WORKER_SOCKET_DIR
+from app.services.price_feed import PriceFeed, build_source
+from app.utils.metrics import add_labels, merge_expositions
+
+logger = logging.getLogger(__name__)
+
+
+def socket_path(index):
+    return os.path.join(WORKER_SOCKET_DIR, f'sctb-worker-{index}.sock')
+
+
+def ticks_socket_path():
+    return os.path.join(WORKER_SOCKET_DIR, 'sctb-ticks.sock')
+
+
+def extract_user_id(update):
+    """
+    Telegram id пользователя, от которого пришло обновление.
+    Для обновлений без пользователя - id чата, в крайнем случае update_id.
+    """
+    for key, value in update.items():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        message = value.get('message')
+        chat = value.get('chat') or (message.get('chat') if isinstance(message, dict) else None)
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return update.get('update_id', 0)
+
+
+def _tick_message(tick):
+    return json.dumps([tick.price, tick.timestamp])
+
+
+class Supervisor:
+    """
+    Принимает вебхук на одном порту и пересылает каждое обновление рабочему процессу
+    user_id % workers через unix-сокет, так что обновления одного пользователя
+    всегда попадают в один процесс. Упавшие рабочие перезапускаются.
+    Источник цены читает только супервизор и рассылает тики рабочим по WebSocket
+    на unix-сокете ticks_socket_path(): одно подключение к бирже вместо одного на процесс.
+    """
+    def __init__(self, workers, target, webhook_path):
+        self.workers = workers
+        self.target = target
+        self.webhook_path = webhook_path
+        # spawn: рабочий начинает с чистого интерпретатора, а не с копии супервизора
+        # с его циклом событий, сессиями aiohttp и сокетами ленты цен
+        self._context = multiprocessing.get_context('spawn')
+        self._processes = [None] * workers
+        self._sessions = []
+        self._monitor = None
+        # Собственная лента, а не общий price_feed: у рабочих своя лента с источником SupervisorSource
+        self._feed = PriceFeed(build_source(), history=1)
+        self._tick_sockets = set()
+        self._ticks_runner = None
+
+    def _spawn(self, index):
+        path = socket_path(index)
+        if os.path.exists(path):
+            os.unlink(path)
+        process = self._context.Process(target=self.target, args=(index, self.workers, path), name=f'sctb-worker-{index}')
+        process.start()
+        self._processes[index] = process
+        logger.info("Started worker %d (pid %d)", index, process.pid)
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(1)
+            for index, process in enumerate(self._processes):
+                if not process.is_alive():
+                    logger.warning("Worker %d exited with code %s, restarting", index, process.exitcode)
+                    self._spawn(index)
+
+    async def _forward(self, index, method, path, body=None, headers=None):
+        async with self._sessions[index].request(method, f'http://worker{path}', data=body, headers=headers) as response:
+            return web.Response(body=await response.read(), status=response.status, content_type=response.content_type)
+
+    async def handle_update(self, request):
+        body = await request.read()
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return web.Response(status=400)
+        index = extract_user_id(update) % self.workers
+        headers = {name: value for name, value in request.headers.items() if name.startswith('X-Telegram')}
+        headers['Content-Type'] = 'application/json'
+        try:
+            return await self._forward(index, 'POST', self.webhook_path, body, headers)
+        except aiohttp.ClientError as e:
+            # Telegram повторит доставку
+            logger.warning("Worker %d unavailable: %s", index, e)
+            return web.Response(status=503)
+
+    async def handle_health(self, request):
+        for index in range(self.workers):
+            try:
+                response = await self._forward(index, 'GET', '/health')
+            except aiohttp.ClientError:
+                response = None
+            if response is None or response.status >= 500:
+                return web.Response(status=503, text=f'worker {index} unavailable')
+        return web.json_response({'status': 'ok', 'workers': self.workers})
+
+    async def handle_metrics(self, request):
+        texts = []
+        for index in range(self.workers):
+            try:
+                response = await self._forward(index, 'GET', '/metrics')
+            except aiohttp.ClientError:
+                continue
+            if response.status == 200:
+                texts.append(add_labels(response.body.decode(), worker=index))
+        return web.Response(text=merge_expositions(texts), content_type='text/plain')
+
+    async def handle_ticks(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self._tick_sockets.add(ws)
+        try:
+            if self._feed.latest:
+                await ws.send_str(_tick_message(self._feed.latest))
+            async for _ in ws:
+                pass
+        finally:
+            self._tick_sockets.discard(ws)
+        return ws
+
+    async def _broadcast(self, tick):
+        message = _tick_message(tick)
+        for ws in list(self._tick_sockets):
+            try:
+                await ws.send_str(message)
+            except (ConnectionError, RuntimeError):
+                self._tick_sockets.discard(ws)
+
+    async def _start_ticks(self):
+        path = ticks_socket_path()
+        if os.path.exists(path):
+            os.unlink(path)
+        app = web.Application()
+        app.router.add_get('/ticks', self.handle_ticks)
+        self._ticks_runner = web.AppRunner(app)
+        await self._ticks_runner.setup()
+        await web.UnixSite(self._ticks_runner, path).start()
+        self._feed.subscribe(self._broadcast)
+        self._feed.start()
+
+    async def on_startup(self, app):
+        self._sessions = [
+            aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=socket_path(index)))
+            for index in range(self.workers)
+        ]
+        self._monitor = asyncio.create_task(self._watch())
+        await self._start_ticks()
+
+    async def on_shutdown(self, app):
+        self._monitor.cancel()
+        await self._feed.stop()
+        if self._ticks_runner:
+            await self._ticks_runner.cleanup()
+        for session in self._sessions:
+            await session.close()
+        for process in self._processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for process in self._processes:
+            process.join(10)
+
+    def run(self, host, port, ssl_context=None):
+        for index in range(self.workers):
+            self._spawn(index)
+        app = web.Application()
+        app.router.add_post(self.webhook_path, self.handle_update)
+        app.router.add_get('/health', self.handle_health)
+        app.router.add_get('/metrics', self.handle_metrics)
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        web.run_app(app, host=host, port=port, ssl_context=ssl_context)
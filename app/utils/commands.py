@@ -1,4 +1,21 @@
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramAPIError
 from aiogram.types import BotCommand, BotCommandScopeChat, BotCommandScopeDefault
+from sqlalchemy import select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+from app.config import COMMANDS_RATE
+from app.models import ChatCommandScope
+from app.utils.db import get_session
+from app.utils.rate_limit import TokenBucket
+from app.utils.sharding import user_filter
+
+logger = logging.getLogger(__name__)
 
 commands_ru = [
     BotCommand(command="/autobuy", description="🤖 Автопокупка"),
@@ -9,6 +26,8 @@ commands_ru = [
     BotCommand(command="/stats", description="ℹ️ Статистика"),
     BotCommand(command="/balance", description="💰 Баланс"),
     BotCommand(command="/price", description="📈 Текущая цена"),
+    BotCommand(command="/alert", description="🔔 Уведомления о цене"),
+    BotCommand(command="/backtest", description="🧪 Бэктест"),
     BotCommand(command="/subscription", description="✨ Подписка"),
     BotCommand(command="/help", description="📖 Помощь"),
 ]
@@ -22,6 +41,8 @@ commands_en = [
     BotCommand(command="/stats", description="ℹ️ Stats"),
     BotCommand(command="/balance", description="💰 Balance"),
     BotCommand(command="/price", description="📈 Current Price"),
+    BotCommand(command="/alert", description="🔔 Price alerts"),
+    BotCommand(command="/backtest", description="🧪 Backtest"),
     BotCommand(command="/subscription", description="✨ Subscription"),
     BotCommand(command="/help", description="📖 Help"),
 ]
@@ -38,22 +59,234 @@ default_commands_en = [
     BotCommand(command="/subscription", description="✨ Subscription"),
 ]
 
+def _digest(*command_lists):
+    payload = json.dumps([[(c.command, c.description) for c in commands] for commands in command_lists], ensure_ascii=False)
+    return hashlib.sha1(payload.encode()).hexdigest()[:16]
+
+def _commands_for(language, has_subscription):
+    if has_subscription:
+        return commands_ru if language == 'ru' else commands_en
+    return default_commands_ru if language == 'ru' else default_commands_en
+
+def _fingerprint(language_code, has_subscription):
+    # Язык приводится к набору, который реально устанавливается: 'ru' или 'en'
+    language = 'ru' if language_code == 'ru' else 'en'
+    has_subscription = bool(has_subscription)
+    return language, has_subscription, _digest(_commands_for(language, has_subscription))
+
+DEFAULT_SCOPE = 0
+
+async def _applied(chat_ids):
+    async with get_session() as session:
+        result = await session.execute(
+            select(ChatCommandScope.chat_id, ChatCommandScope.language, ChatCommandScope.subscribed, ChatCommandScope.digest)
+            .where(ChatCommandScope.chat_id.in_(chat_ids))
+        )
+        return {chat_id: (language, subscribed, digest) for chat_id, language, subscribed, digest in result}
+
+async def _save(fingerprints):
+    statement = pg_insert(ChatCommandScope).values([
+        {'chat_id': chat_id, 'language': language, 'subscribed': subscribed, 'digest': digest}
+        for chat_id, (language, subscribed, digest) in fingerprints.items()
+    ])
+    statement = statement.on_conflict_do_update(
+        index_elements=[ChatCommandScope.chat_id],
+        set_={
+            'language': statement.excluded.language,
+            'subscribed': statement.excluded.subscribed,
+            'digest': statement.excluded.digest,
+            'updated_at': statement.excluded.updated_at,
+            'pending_language': None,
+            'pending_subscribed': None,
+        },
+    )
+    async with get_session() as session:
+        await session.execute(statement)
+        await session.commit()
+
+async def _clear_pending(chat_ids):
+    async with get_session() as session:
+        await session.execute(
+            update(ChatCommandScope)
+            .where(ChatCommandScope.chat_id.in_(chat_ids), ChatCommandScope.pending_language.is_not(None))
+            .values(pending_language=None, pending_subscribed=None)
+        )
+        await session.commit()
+
+async def _load_pending():
+    async with get_session() as session:
+        result = await session.execute(
+            select(ChatCommandScope.chat_id, ChatCommandScope.pending_language, ChatCommandScope.pending_subscribed)
+            .where(ChatCommandScope.pending_language.is_not(None), user_filter(ChatCommandScope.chat_id))
+        )
+        return result.all()
+
 async def set_default_commands(bot):
     """
-    Устанавливает команды по умолчанию для всех пользователей.
+    Устанавливает команды по умолчанию для всех пользователей, если они изменились с прошлого запуска.
     """
+    fingerprint = ('*', False, _digest(default_commands_ru, default_commands_en))
+    applied = await _applied([DEFAULT_SCOPE])
+    if applied.get(DEFAULT_SCOPE) == fingerprint:
+        return
     await bot.set_my_commands(default_commands_ru, scope=BotCommandScopeDefault(), language_code='ru')
     await bot.set_my_commands(default_commands_en, scope=BotCommandScopeDefault())
+    await _save({DEFAULT_SCOPE: fingerprint})
 
 async def set_user_commands(bot, user_id, language_code, has_subscription):
     """
     Устанавливает команды для конкретного пользователя в зависимости от наличия подписки.
     """
-    print(user_id)
-    print(has_subscription)
-    if has_subscription:
-        commands = commands_ru if language_code == 'ru' else commands_en
-    else:
-        commands = default_commands_ru if language_code == 'ru' else default_commands_en
-    scope = BotCommandScopeChat(chat_id=user_id)
-    await bot.set_my_commands(commands=commands, scope=scope)
+    return await command_scopes.apply(bot, user_id, language_code, has_subscription)
+
+class CommandScopeSync:
+    """
+    Команды чатов по отпечатку (язык, подписка, хеш команд), сохранённому в chat_command_scopes:
+    set_my_commands вызывается, только если отпечаток изменился.
+    apply устанавливает команды сразу (ответ на действие пользователя), schedule ставит
+    в очередь фоновому обработчику: он читает отпечатки пакетом одним запросом
+    и вызывает Bot API не чаще rate раз в секунду.
+    Чтобы очередь пережила перезапуск, вызывающий код сохраняет её через persist в своей
+    транзакции; при запуске сохранённые и ещё не установленные наборы загружаются обратно.
+    """
+    def __init__(self, rate=COMMANDS_RATE, batch_size=200, concurrency=5):
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self._bucket = TokenBucket(rate)
+        self._pending = {}  # chat_id -> отпечаток; повторная постановка заменяет прежний
+        self._wakeup = asyncio.Event()
+        self._task = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def start(self, bot):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self._pending:
+            logger.info("Left %d command scope updates for the next start", len(self._pending))
+
+    async def persist(self, session, updates):
+        """
+        Сохраняет наборы команд [(chat_id, language_code, has_subscription)] как ожидающие
+        в транзакции session. После фиксации их нужно передать в schedule.
+        """
+        if not updates:
+            return
+        rows = []
+        for chat_id, language_code, has_subscription in updates:
+            language, subscribed, _ = _fingerprint(language_code, has_subscription)
+            # Для чата без записи пустой хеш означает, что ничего ещё не установлено
+            rows.append({'chat_id': chat_id, 'language': language, 'subscribed': subscribed, 'digest': '',
+                         'pending_language': language, 'pending_subscribed': subscribed})
+        statement = pg_insert(ChatCommandScope).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[ChatCommandScope.chat_id],
+            set_={
+                'pending_language': statement.excluded.pending_language,
+                'pending_subscribed': statement.excluded.pending_subscribed,
+            },
+        )
+        await session.execute(statement)
+
+    def schedule(self, chat_id, language_code, has_subscription):
+        self._pending[chat_id] = _fingerprint(language_code, has_subscription)
+        self._wakeup.set()
+
+    async def apply(self, bot, chat_id, language_code, has_subscription):
+        """
+        Устанавливает команды чата сразу. Возвращает False, если они уже были установлены.
+        """
+        # Прямая установка заменяет поставленную в очередь
+        self._pending.pop(chat_id, None)
+        fingerprint = _fingerprint(language_code, has_subscription)
+        async with get_session() as session:
+            result = await session.execute(
+                select(ChatCommandScope.language, ChatCommandScope.subscribed, ChatCommandScope.digest,
+                       ChatCommandScope.pending_language)
+                .where(ChatCommandScope.chat_id == chat_id)
+            )
+            row = result.first()
+        if row is not None and tuple(row[:3]) == fingerprint:
+            if row.pending_language is not None:
+                # Сохранённый устаревший набор не должен примениться после перезапуска
+                await _clear_pending([chat_id])
+            return False
+        await self._bucket.acquire()
+        await self._set(bot, chat_id, fingerprint)
+        await _save({chat_id: fingerprint})
+        return True
+
+    async def _set(self, bot, chat_id, fingerprint):
+        language, has_subscription, _ = fingerprint
+        await bot.set_my_commands(commands=_commands_for(language, has_subscription), scope=BotCommandScopeChat(chat_id=chat_id))
+
+    async def _restore(self):
+        while True:
+            try:
+                rows = await _load_pending()
+            except Exception:
+                logger.exception("Failed to load pending command scope updates")
+                await asyncio.sleep(1)
+                continue
+            for chat_id, language, subscribed in rows:
+                self._pending.setdefault(chat_id, _fingerprint(language, subscribed))
+            if rows:
+                logger.info("Restored %d pending command scope updates", len(rows))
+            return
+
+    async def _run(self, bot):
+        await self._restore()
+        while True:
+            if not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            batch = {chat_id: self._pending.pop(chat_id) for chat_id in list(itertools.islice(self._pending, self.batch_size))}
+            try:
+                await self._apply_batch(bot, batch)
+            except Exception:
+                logger.exception("Command scope update failed")
+                for chat_id, fingerprint in batch.items():
+                    self._pending.setdefault(chat_id, fingerprint)
+                await asyncio.sleep(1)
+
+    async def _apply_batch(self, bot, batch):
+        applied = await _applied(list(batch))
+        changed = iter([(chat_id, fingerprint) for chat_id, fingerprint in batch.items() if applied.get(chat_id) != fingerprint])
+        done = {}
+
+        async def worker():
+            for chat_id, fingerprint in changed:
+                await self._bucket.acquire()
+                try:
+                    await self._set(bot, chat_id, fingerprint)
+                except TelegramRetryAfter as e:
+                    logger.warning("Flood limit hit, pausing command updates for %s s", e.retry_after)
+                    self._bucket.pause(e.retry_after)
+                    self._pending.setdefault(chat_id, fingerprint)
+                    continue
+                except TelegramNetworkError:
+                    self._pending.setdefault(chat_id, fingerprint)
+                    continue
+                except TelegramAPIError as e:
+                    # Например, пользователь заблокировал бота: повтор не поможет
+                    logger.warning("Failed to set commands for chat %s: %s", chat_id, e)
+                    continue
+                done[chat_id] = fingerprint
+
+        await asyncio.gather(*(worker() for _ in range(self.concurrency)))
+        if done:
+            await _save(done)
+        # Уже установленные и безнадёжные больше не ждут; повторяемые остались в очереди
+        settled = [chat_id for chat_id in batch if chat_id not in done and chat_id not in self._pending]
+        if settled:
+            await _clear_pending(settled)
+
+command_scopes = CommandScopeSync()
@@ -0,0 +1,188 @@
+import asyncio
+import copy
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+from sqlalchemy import delete
+from sqlalchemy.dialects.postgresql import insert
+
+from app.models import FsmState
+from app.utils.db import get_session
+
+logger = logging.getLogger(__name__)
+
+
+class _Record:
+    __slots__ = ('state', 'data', 'touched')
+
+    def __init__(self, state=None, data=None, touched=None):
+        self.state = state
+        self.data = data or {}
+        self.touched = touched or time.monotonic()
+
+
+class PostgresStorage(BaseStorage):
+    """
+    Хранилище FSM в Postgres с кэшем чтения и отложенной записью.
+    Переход состояния меняет запись в памяти, а фоновая задача раз в flush_interval
+    сохраняет накопленные изменения одной транзакцией.
+    Состояния, не менявшиеся дольше ttl секунд, считаются устаревшими и удаляются.
+    """
+    def __init__(self, ttl=86400, flush_interval=0.2, cache_size=10000):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.cache_size = cache_size
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_business_connection_id=True, with_destiny=True)
+        self._cache = OrderedDict()  # key -> _Record
+        self._dirty = set()
+        self._flushing = set()  # ключи, запись которых сейчас идёт: вытеснять их нельзя
+        self._loading = {}  # key -> Future, чтобы параллельные промахи читали БД один раз
+        self._tasks = []
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [
+                asyncio.create_task(self._flush_loop()),
+                asyncio.create_task(self._expire_loop()),
+            ]
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        await self.flush()
+
+    def state_counts(self):
+        counts = {}
+        for record in self._cache.values():
+            if record.state:
+                counts[record.state] = counts.get(record.state, 0) + 1
+        return counts
+
+    async def _record(self, key):
+        storage_key = self.key_builder.build(key)
+        record = self._cache.get(storage_key)
+        if record is not None:
+            if time.monotonic() - record.touched > self.ttl:
+                record.state, record.data = None, {}
+            self._cache.move_to_end(storage_key)
+            return storage_key, record
+        future = self._loading.get(storage_key)
+        if future is None:
+            future = asyncio.get_running_loop().create_future()
+            self._loading[storage_key] = future
+            try:
+                record = await self._load(storage_key)
+                future.set_result(record)
+            except Exception as e:
+                future.set_exception(e)
+                future.exception()
+                raise
+            finally:
+                del self._loading[storage_key]
+            self._cache[storage_key] = record
+            self._evict()
+            return storage_key, record
+        return storage_key, await future
+
+    async def _load(self, storage_key):
+        async with get_session() as session:
+            row = await session.get(FsmState, storage_key)
+        if row is None or row.updated_at < datetime.utcnow() - timedelta(seconds=self.ttl):
+            return _Record()
+        age = (datetime.utcnow() - row.updated_at).total_seconds()
+        return _Record(row.state, row.data, time.monotonic() - age)
+
+    def _evict(self):
+        while len(self._cache) > self.cache_size:
+            for storage_key in self._cache:
+                if storage_key not in self._dirty and storage_key not in self._flushing:
+                    del self._cache[storage_key]
+                    break
+            else:
+                return
+
+    def _touch(self, storage_key, record):
+        record.touched = time.monotonic()
+        self._dirty.add(storage_key)
+
+    async def set_state(self, key, state=None):
+        storage_key, record = await self._record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._touch(storage_key, record)
+
+    async def get_state(self, key):
+        _, record = await self._record(key)
+        return record.state
+
+    async def set_data(self, key, data):
+        storage_key, record = await self._record(key)
+        record.data = copy.deepcopy(data)
+        self._touch(storage_key, record)
+
+    async def get_data(self, key):
+        _, record = await self._record(key)
+        return copy.deepcopy(record.data)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        # Ключи без записи в кэше отбрасываются: писать по ним нечего
+        dirty = {storage_key for storage_key in self._dirty if storage_key in self._cache}
+        self._dirty = set()
+        self._flushing |= dirty
+        now = datetime.utcnow()
+        rows, removed = [], []
+        for storage_key in dirty:
+            record = self._cache[storage_key]
+            if record.state is None and not record.data:
+                removed.append(storage_key)
+            else:
+                rows.append({'key': storage_key, 'state': record.state, 'data': record.data, 'updated_at': now})
+        try:
+            async with get_session() as session:
+                if rows:
+                    stmt = insert(FsmState)
+                    await session.execute(
+                        stmt.on_conflict_do_update(
+                            index_elements=[FsmState.key],
+                            set_={'state': stmt.excluded.state, 'data': stmt.excluded.data, 'updated_at': stmt.excluded.updated_at},
+                        ),
+                        rows,
+                    )
+                if removed:
+                    await session.execute(delete(FsmState).where(FsmState.key.in_(removed)))
+                await session.commit()
+        except Exception:
+            # Повторим на следующем проходе, записи остаются в кэше
+            self._dirty |= dirty
+            raise
+        finally:
+            self._flushing -= dirty
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("FSM storage flush failed")
+
+    async def _expire_loop(self):
+        while True:
+            await asyncio.sleep(min(self.ttl / 10, 600))
+            try:
+                async with get_session() as session:
+                    await session.execute(
+                        delete(FsmState).where(FsmState.updated_at < datetime.utcnow() - timedelta(seconds=self.ttl))
+                    )
+                    await session.commit()
+                deadline = time.monotonic() - self.ttl
+                for storage_key in [k for k, record in self._cache.items() if record.touched < deadline and k not in self._dirty and k not in self._flushing]:
+                    del self._cache[storage_key]
+            except Exception:
+                logger.exception("FSM storage expiry failed")
@@ -1,8 +1,92 @@
+import asyncio
 import json
+import logging
 import os
+from string import Formatter
+from types import MappingProxyType
+
+logger = logging.getLogger(__name__)
+
+LOCALE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'locale')
+DEFAULT_LANGUAGE = 'en'
+
+
+class Template:
+    __slots__ = ('text', 'fields')
+
+    def __init__(self, text):
+        self.text = text
+        # Разбор шаблона при загрузке: ошибка формата всплывёт на старте, а не в обработчике
+        self.fields = frozenset(field for _, field, _, _ in Formatter().parse(text) if field)
+
+    def render(self, **kwargs):
+        return self.text.format_map(kwargs) if self.fields else self.text
+
+
+class LocaleCatalog:
+    """
+    Каталог переводов: все языки читаются с диска один раз.
+    Для каждого языка заранее собрана таблица с подстановкой ключей из en,
+    неизвестный язык отдаётся как en. Поиск ключа - O(1) без ввода-вывода.
+    """
+    def __init__(self, directory=LOCALE_DIR, default=DEFAULT_LANGUAGE):
+        self.directory = directory
+        self.default = default
+        self._tables = {}
+        self._templates = {}
+        self._mtimes = {}
+        self.version = 0  # растёт при каждой загрузке: по нему сбрасываются производные кеши
+        self.load()
+
+    @property
+    def languages(self):
+        return tuple(self._tables)
+
+    def _scan(self):
+        return {
+            name[:-5]: os.stat(os.path.join(self.directory, name)).st_mtime
+            for name in os.listdir(self.directory)
+            if name.endswith('.json')
+        }
+
+    def load(self):
+        mtimes = self._scan()
+        raw = {}
+        for language in mtimes:
+            with open(os.path.join(self.directory, f'{language}.json'), 'r', encoding='utf-8') as f:
+                raw[language] = json.load(f)
+        base = raw.get(self.default, {})
+        tables = {language: MappingProxyType({**base, **strings}) for language, strings in raw.items()}
+        templates = {language: {key: Template(text) for key, text in table.items()} for language, table in tables.items()}
+        # Подменяем целиком, чтобы читатели не видели полузагруженный каталог
+        self._tables, self._templates, self._mtimes = tables, templates, mtimes
+        self.version += 1
+
+    def get(self, language):
+        return self._tables.get(language) or self._tables[self.default]
+
+    def render(self, language, key, **kwargs):
+        templates = self._templates.get(language) or self._templates[self.default]
+        return templates[key].render(**kwargs)
+
+    def reload_if_changed(self):
+        if self._scan() == self._mtimes:
+            return False
+        self.load()
+        logger.info("Locale catalog reloaded: %s", ", ".join(self.languages))
+        return True
+
+    async def watch(self, interval=5.0):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(self.reload_if_changed)
+            except (OSError, ValueError):
+                logger.exception("Locale reload failed, keeping previous catalog")
+
+
+catalog = LocaleCatalog()
+
 
 def load_locale(language_code):
-    current_dir = os.path.dirname(os.path.abspath(__file__))
-    file_path = os.path.join(current_dir, '..', 'locale', f'{language_code}.json')
-    with open(file_path, 'r', encoding='utf-8') as f:
-        return json.load(f)
+    return catalog.get(language_code)
@@ -0,0 +1,278 @@
+import asyncio
+import re
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+
+# Границы корзин по умолчанию, секунды
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric(ABC):
+    """
+    Метрика с дочерними значениями по кортежу меток; вид значения задаёт подкласс в _new_child.
+    """
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def labels(self, *values):
+        # Дочерний объект кэшируется: на горячем пути - один поиск в словаре
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"{self.name} expects labels {self.labelnames}, got {values}")
+            child = self._children[values] = self._new_child()
+        return child
+
+    @abstractmethod
+    def _new_child(self):
+        """
+        Новое дочернее значение для очередного набора меток.
+        """
+
+    def _samples(self):
+        for values, child in list(self._children.items()):
+            yield from child.samples(self.name, self.labelnames, values)
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in self._samples())
+        return '\n'.join(lines)
+
+
+class _Value:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labelnames, values):
+        yield name, _format_labels(labelnames, values), self.value
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(_Metric):
+    """
+    Gauge со значениями, выставляемыми вручную, или с функцией,
+    которая вызывается при сборе и возвращает {кортеж меток: значение}.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def _new_child(self):
+        return _Value()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def set_function(self, function):
+        self.function = function
+
+    def _samples(self):
+        if self.function is None:
+            yield from super()._samples()
+            return
+        for values, value in self.function().items():
+            values = values if isinstance(values, tuple) else (values,)
+            yield self.name, _format_labels(self.labelnames, values), value
+
+
+class _HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum', 'count')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labelnames, values):
+        cumulative = 0
+        for bound, count in zip((*self.bounds, float('inf')), self.counts):
+            cumulative += count
+            yield f'{name}_bucket', _format_labels(labelnames, values, (('le', _format_value(bound)),)), cumulative
+        yield f'{name}_sum', _format_labels(labelnames, values), self.sum
+        yield f'{name}_count', _format_labels(labelnames, values), self.count
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(float(bound) for bound in buckets))
+
+    def _new_child(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), function=None):
+        return self.register(Gauge(name, documentation, labelnames, function))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self):
+        return '\n'.join(metric.expose() for metric in self._metrics.values()) + '\n'
+
+
+_SAMPLE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})? (.*)$')
+
+
+def add_labels(text, **labels):
+    """
+    Добавляет метки ко всем строкам значений в тексте формата Prometheus
+    (супервизор так помечает метрики рабочих процессов номером процесса).
+    """
+    extra = ','.join(f'{name}="{_escape(value)}"' for name, value in labels.items())
+    lines = []
+    for line in text.splitlines():
+        match = _SAMPLE.match(line) if line and not line.startswith('#') else None
+        if match is None:
+            lines.append(line)
+            continue
+        name, existing, value = match.groups()
+        existing = existing[1:-1] + ',' if existing else ''
+        lines.append(f'{name}{{{existing}{extra}}} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+def merge_expositions(texts):
+    """
+    Объединяет выводы нескольких процессов: строки одного семейства метрик
+    должны идти подряд, HELP и TYPE - по одному разу.
+    """
+    families = {}  # имя -> [заголовки, строки значений]
+    current = None
+    for text in texts:
+        for line in text.splitlines():
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                current = line.split(' ', 3)[2]
+                family = families.setdefault(current, [[], []])
+                if line not in family[0]:
+                    family[0].append(line)
+            elif line and current is not None:
+                families[current][1].append(line)
+    return '\n'.join(line for headers, samples in families.values() for line in headers + samples) + '\n'
+
+
+registry = Registry()
+
+handler_duration = registry.histogram(
+    'sctb_handler_duration_seconds', 'Handler execution time', ('router', 'handler'))
+handler_errors = registry.counter(
+    'sctb_handler_errors_total', 'Handlers that raised an exception', ('router', 'handler'))
+update_duration = registry.histogram(
+    'sctb_update_duration_seconds', 'Time to process an update, middlewares included', ('type',))
+update_db_queries = registry.histogram(
+    'sctb_update_db_queries', 'Database queries per update', buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50))
+update_db_duration = registry.histogram(
+    'sctb_update_db_duration_seconds', 'Database time per update')
+db_query_duration = registry.histogram(
+    'sctb_db_query_duration_seconds', 'Database statement execution time')
+bot_api_duration = registry.histogram(
+    'sctb_bot_api_duration_seconds', 'Telegram Bot API request time', ('method',))
+bot_api_errors = registry.counter(
+    'sctb_bot_api_errors_total', 'Failed Telegram Bot API requests', ('method', 'error'))
+exchange_request_duration = registry.histogram(
+    'sctb_exchange_request_duration_seconds', 'Exchange REST request time', ('endpoint',))
+exchange_errors = registry.counter(
+    'sctb_exchange_errors_total', 'Failed or retried exchange requests', ('endpoint', 'reason'))
+fsm_states = registry.gauge(
+    'sctb_fsm_states', 'Cached FSM contexts per state', ('state',))
+event_loop_lag = registry.gauge(
+    'sctb_event_loop_lag_seconds', 'Delay of the last event loop lag probe')
+event_loop_lag_histogram = registry.histogram(
+    'sctb_event_loop_lag_probe_seconds', 'Event loop lag probes', buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0))
+
+
+class EventLoopMonitor:
+    """
+    Спит interval и измеряет, насколько позже цикл событий вернул управление.
+    """
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - started - self.interval)
+            event_loop_lag.set(lag)
+            event_loop_lag_histogram.observe(lag)
+
+
+loop_monitor = EventLoopMonitor()
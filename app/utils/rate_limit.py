@@ -0,0 +1,40 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не более capacity накопленных.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n=1):
+        """
+        Забирает n токенов. Возвращает 0, если получилось, иначе сколько секунд ждать.
+        """
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return 0.0
+        return (n - self.tokens) / self.rate
+
+    async def acquire(self, n=1):
+        while (wait := self.try_take(n)) > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        # Например, после ответа 429 с retry_after
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
@@ -0,0 +1,125 @@
+from functools import lru_cache
+from types import MappingProxyType
+
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+from pydantic import ConfigDict
+
+from app.utils.locale import catalog, DEFAULT_LANGUAGE
+
+HELP_PAGES = MappingProxyType({
+    'en': (
+        "Help Page 1: Overview\n\nThis bot allows you to trade BTC/USDT automatically, create orders, view balance, statistics, and more.",
+        "Help Page 2: Commands\n\n/autobuy - Start or stop autotrading\n/buy - Purchase cryptocurrency\n/orders - View open orders\n/params - Set autotrading parameters\n/stop - Stop autotrading\n/stats - View statistics\n/balance - View balance\n/price - View current price\n/alert - Price alerts\n/backtest - Test your parameters on historical data\n/subscription - Manage your subscription\n/help - View help pages",
+        "Help Page 3: FAQ\n\nQ: How do I start trading?\nA: First, purchase a subscription via /subscription, then set your parameters via /params, and start autotrading with /autobuy.",
+    ),
+    'ru': (
+        "Страница помощи 1: Обзор\n\nЭтот бот позволяет автоматически торговать парой BTC/USDT, создавать ордера, просматривать баланс, статистику и многое другое.",
+        "Страница помощи 2: Команды\n\n/autobuy - Запустить или остановить автоторговлю\n/buy - Купить криптовалюту\n/orders - Просмотреть открытые ордера\n/params - Настроить параметры автоторговли\n/stop - Остановить автоторговлю\n/stats - Просмотреть статистику\n/balance - Просмотреть баланс\n/price - Просмотреть текущую цену\n/alert - Уведомления о цене\n/backtest - Проверить параметры на исторических данных\n/subscription - Управлять подпиской\n/help - Просмотреть страницы помощи",
+        "Страница помощи 3: Часто задаваемые вопросы\n\nВ: Как начать торговлю?\nО: Сначала приобретите подписку через /subscription, затем настройте параметры через /params и запустите автоторговлю с помощью /autobuy.",
+    ),
+})
+
+
+class ReadOnlyList(list):
+    """
+    Список, который нельзя изменить на месте. Остаётся list, поэтому aiogram и pydantic
+    сериализуют его как обычно; копия (copy, deepcopy, model_copy) - обычный список.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("Shared keyboard markup is read-only; use model_copy(deep=True) to change it")
+
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+
+    def __reduce_ex__(self, protocol):
+        return list, (list(self),)
+
+
+class FrozenInlineKeyboardButton(InlineKeyboardButton):
+    model_config = ConfigDict(frozen=True)
+
+
+class FrozenInlineKeyboardMarkup(InlineKeyboardMarkup):
+    """
+    Клавиатура, которую нельзя изменить: ни поля, ни строки, ни кнопки.
+    Остаётся InlineKeyboardMarkup, поэтому принимается методами aiogram без перепроверки.
+    """
+    model_config = ConfigDict(frozen=True)
+
+
+def _markup(rows):
+    markup = FrozenInlineKeyboardMarkup(inline_keyboard=[
+        [FrozenInlineKeyboardButton(text=text, callback_data=callback_data) for text, callback_data in row]
+        for row in rows
+    ])
+    # frozen запрещает присваивание полей, но списки строк остаются изменяемыми - заменяем их
+    object.__setattr__(markup, 'inline_keyboard', ReadOnlyList(ReadOnlyList(row) for row in markup.inline_keyboard))
+    return markup
+
+
+# Клавиатуры без языка и состояния - общие объекты, собранные при импорте
+LANGUAGE_KEYBOARD = _markup([[("Русский язык", "lang_ru")], [("English", "lang_en")]])
+STATS_PERIOD_KEYBOARD = _markup([[("Daily", "stats_daily")], [("Monthly", "stats_monthly")], [("Full", "stats_full")]])
+SELL_ORDER_KEYBOARD = _markup([[("Create Sell Order", "create_sell_order")]])
+
+
+@lru_cache(maxsize=2)
+def autobuy_keyboard(running):
+    # Клавиатура зависит только от того, запущена ли автопокупка
+    return _markup([
+        [("Stop", "autobuy_stop") if running else ("Start", "autobuy_start")],
+        [("Change parameters", "change_params")],
+    ])
+
+
+class RenderCache:
+    """
+    Клавиатуры и тексты, зависящие от языка: собираются один раз на каждый язык
+    и пересобираются только после перезагрузки каталога переводов.
+    Отдаются общие неизменяемые объекты: для правки нужна копия model_copy(deep=True).
+    """
+    def __init__(self):
+        self._version = None
+        self._views = {}
+
+    def build(self):
+        views = {}
+        for language in catalog.languages:
+            locale = catalog.get(language)
+            options = [
+                [(locale["subscription_option_service"], "subscribe_service")],
+                [(locale["subscription_option_stars"], "subscribe_stars")],
+                [(locale["subscription_option_direct"], "subscribe_direct")],
+                [(locale["subscription_option_test"], "subscribe_test")],
+            ]
+            views['subscription', language, False] = _markup(options)
+            views['subscription', language, True] = _markup(options + [[(locale["subscription_option_extend"], "extend_subscription")]])
+        for language, pages in HELP_PAGES.items():
+            for page, text in enumerate(pages):
+                buttons = []
+                if page > 0:
+                    buttons.append(("Previous", f"help_prev_{page}"))
+                if page < len(pages) - 1:
+                    buttons.append(("Next", f"help_next_{page}"))
+                views['help', language, page] = (text, _markup([buttons]))
+        self._views, self._version = views, catalog.version
+
+    def _get(self, kind, language, *key):
+        if self._version != catalog.version:
+            self.build()
+        view = self._views.get((kind, language, *key))
+        if view is None:
+            view = self._views[kind, DEFAULT_LANGUAGE, *key]
+        return view
+
+    def subscription_keyboard(self, language, renew=False):
+        return self._get('subscription', language, renew)
+
+    def help_page(self, language, page):
+        """
+        Текст и клавиатура страницы помощи: (text, reply_markup).
+        """
+        return self._get('help', language, page)
+
+
+render = RenderCache()
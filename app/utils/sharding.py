@@ -0,0 +1,29 @@
+from sqlalchemy import true
+
+# Номер текущего рабочего процесса и их общее число.
+# Обновления и фоновая работа по пользователю выполняются в процессе user_id % worker_count.
+worker_index = 0
+worker_count = 1
+
+
+def configure(index, count):
+    global worker_index, worker_count
+    worker_index = index
+    worker_count = count
+
+
+def shard_of(user_id):
+    return user_id % worker_count
+
+
+def owns_user(user_id):
+    return shard_of(user_id) == worker_index
+
+
+def user_filter(column):
+    """
+    Условие SQL для выборки только пользователей текущего процесса.
+    """
+    if worker_count == 1:
+        return true()
+    return column % worker_count == worker_index
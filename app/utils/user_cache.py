@@ -0,0 +1,70 @@
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from app.config import USER_CACHE_SIZE, USER_CACHE_TTL
+
+
+@dataclass(frozen=True)
+class UserSnapshot:
+    id: int
+    language: Optional[str]
+    subscription: bool
+    subscription_expires: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, user):
+        return cls(user.id, user.language, bool(user.subscription), user.subscription_expires)
+
+    @property
+    def has_subscription(self):
+        # Срок проверяется по снимку, поэтому истечение видно и до инвалидации кэша
+        if not self.subscription:
+            return False
+        return not (self.subscription_expires and self.subscription_expires <= datetime.utcnow())
+
+
+class UserCache:
+    """
+    LRU-кэш снимков пользователей по Telegram id с ограничением размера и TTL.
+    Код, меняющий язык или подписку, вызывает invalidate.
+    """
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (snapshot, expires_at)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        snapshot, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return snapshot
+
+    def put(self, snapshot):
+        self._entries[snapshot.id] = (snapshot, time.monotonic() + self.ttl)
+        self._entries.move_to_end(snapshot.id)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        self._entries.pop(user_id, None)
+
+    def invalidate_many(self, user_ids):
+        for user_id in user_ids:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        self._entries.clear()
+
+
+user_cache = UserCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
@@ -0,0 +1,70 @@
+import heapq
+from dataclasses import asdict
+from types import SimpleNamespace
+
+import numpy as np
+
+from app.services.autotrade import AutotradeEngine
+from app.services.backtest import BacktestParams, Candles, run_backtest
+
+
+def _candles(close, high=None):
+    close = np.asarray(close, dtype=float)
+    high = close if high is None else np.asarray(high, dtype=float)
+    timestamp = np.arange(len(close), dtype=float) * 60
+    return Candles(timestamp, close, high, close, close, np.zeros(len(close)))
+
+
+def _engine_buys(candles, params, initial_usdt):
+    """
+    Те же свечи через AutotradeEngine: evaluate на цене закрытия, purchased после покупки,
+    rearm после пропущенной, паузы - через планировщик движка.
+    """
+    engine = AutotradeEngine()
+    engine.upsert(SimpleNamespace(user_id=1, **asdict(params)))
+    cash = initial_usdt
+    sales = []  # (индекс исполнения продажи, выручка)
+    buys = []
+    for i, (timestamp, price) in enumerate(zip(candles.timestamp, candles.close)):
+        while sales and sales[0][0] <= i:
+            cash += heapq.heappop(sales)[1]
+        engine.rearm(engine.scheduler.pop_due(timestamp))
+        if not engine.evaluate(price).size:
+            continue
+        if cash < params.purchase_amount:
+            engine.rearm([1])
+            continue
+        cash -= params.purchase_amount
+        buys.append(timestamp)
+        engine.purchased([1], price, timestamp)
+        target = round(price * (1 + params.profit_percentage / 100), 2)
+        filled = np.flatnonzero(candles.high[i + 1:] >= target)
+        if filled.size:
+            heapq.heappush(sales, (i + 1 + int(filled[0]), params.purchase_amount / price * target))
+    return buys
+
+
+def test_skipped_purchase_keeps_reference_price():
+    # 103: покупка на все средства; 105.1: порог от 103 пройден, но денег нет;
+    # 107: продажа по цели; 105.2: порог от 103 снова пройден - покупка
+    candles = _candles([100, 103, 105.1, 105, 105.2], high=[100, 103, 105.1, 107, 105.2])
+    params = BacktestParams(purchase_amount=1000, profit_percentage=3, purchase_delay=0,
+                            growth_percentage=2, autobuy_on_fall=False)
+    result = run_backtest(candles, params, initial_usdt=1000)
+    assert [trade.buy_price for trade in result.trades] == [103, 105.2]
+    assert [trade.buy_time for trade in result.trades] == _engine_buys(candles, params, 1000)
+
+
+def test_backtest_matches_engine():
+    rng = np.random.default_rng(1)
+    close = np.round(30000 * np.exp(np.cumsum(rng.normal(0, 0.004, 5000))), 2)
+    high = close * (1 + rng.uniform(0, 0.003, len(close)))
+    candles = _candles(close, high)
+    for params in (
+        BacktestParams(purchase_amount=1000, profit_percentage=1, purchase_delay=300,
+                       growth_percentage=0.5, fall_percentage=0.8),
+        BacktestParams(purchase_amount=2500, profit_percentage=3, purchase_delay=0,
+                       growth_percentage=1, fall_percentage=1),
+    ):
+        result = run_backtest(candles, params, initial_usdt=10000)
+        assert [trade.buy_time for trade in result.trades] == _engine_buys(candles, params, 10000)
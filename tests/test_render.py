@@ -0,0 +1,43 @@
+import pytest
+from aiogram.types import InlineKeyboardButton
+from pydantic import ValidationError
+
+from app.utils.locale import catalog
+from app.utils.render import (render, autobuy_keyboard, LANGUAGE_KEYBOARD, STATS_PERIOD_KEYBOARD,
+                              SELL_ORDER_KEYBOARD, HELP_PAGES)
+
+
+def _cached_markups():
+    markups = [LANGUAGE_KEYBOARD, STATS_PERIOD_KEYBOARD, SELL_ORDER_KEYBOARD, autobuy_keyboard(True), autobuy_keyboard(False)]
+    for language in catalog.languages:
+        markups += [render.subscription_keyboard(language), render.subscription_keyboard(language, renew=True)]
+    for language, pages in HELP_PAGES.items():
+        markups += [render.help_page(language, page)[1] for page in range(len(pages))]
+    return markups
+
+
+@pytest.mark.parametrize('markup', _cached_markups())
+def test_cached_markup_is_read_only(markup):
+    before = markup.model_dump()
+    button = InlineKeyboardButton(text="Extra", callback_data="extra")
+    with pytest.raises(TypeError):
+        markup.inline_keyboard.append([button])
+    for row in markup.inline_keyboard:
+        with pytest.raises(TypeError):
+            row.append(button)
+        with pytest.raises(TypeError):
+            row[:] = []
+    with pytest.raises(ValidationError):
+        markup.inline_keyboard = []
+    if markup.inline_keyboard and markup.inline_keyboard[0]:
+        with pytest.raises(ValidationError):
+            markup.inline_keyboard[0][0].text = "Changed"
+    assert markup.model_dump() == before
+
+
+def test_copy_of_cached_markup_is_editable():
+    markup = SELL_ORDER_KEYBOARD.model_copy(deep=True)
+    markup.inline_keyboard.append([InlineKeyboardButton(text="Extra", callback_data="extra")])
+    assert len(markup.inline_keyboard) == len(SELL_ORDER_KEYBOARD.inline_keyboard) + 1
+    assert SELL_ORDER_KEYBOARD.model_dump_json(exclude_none=True) == \
+        '{"inline_keyboard":[[{"text":"Create Sell Order","callback_data":"create_sell_order"}]]}'